@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmark scripts: synthetic subtitle corpora,
+timing, peak memory measurement, and a local HTTP stand-in for imgur.
+"""
+from __future__ import unicode_literals, print_function
+import os
+import io
+import json
+import time
+import random
+import resource
+import traceback
+import threading
+import multiprocessing
+import six
+
+WORDS = [
+  "that's", "what", "she", "said", "michael", "dwight", "jim", "pam", "paper", "scranton",
+  "beet", "farm", "office", "party", "sales", "regional", "manager", "assistant", "to", "the",
+  "i", "am", "not", "superstition", "but", "a", "little", "stitious", "bears", "beets",
+  "battlestar", "galactica", "identity", "theft", "is", "joke", "jim", "millions", "of",
+  "families", "suffer", "every", "year"
+]
+
+def srt_timestamp(milliseconds):
+  """
+  Formats milliseconds as an SRT timestamp, HH:MM:SS,mmm.
+  """
+  return "{0:02d}:{1:02d}:{2:02d},{3:03d}".format(
+    milliseconds // 3600000,
+    milliseconds // 60000 % 60,
+    milliseconds // 1000 % 60,
+    milliseconds % 1000
+  )
+
+def write_srt(path, count, seed = 0):
+  """
+  Writes a synthetic SRT file of count subtitles, one or two lines each.
+
+  Parameters
+  ----------
+  path : string
+    The file to write.
+  count : int
+    The number of subtitles.
+  seed : int
+    The random seed, so the same arguments always write the same file.
+  """
+  generator = random.Random(seed)
+  milliseconds = 1000
+  with io.open(path, "w", encoding = "UTF-8") as handler:
+    for index in range(1, count + 1):
+      duration = generator.randint(800, 4000)
+      lines = [
+        " ".join(generator.choice(WORDS) for i in range(generator.randint(2, 8))).capitalize()
+        for j in range(generator.randint(1, 2))
+      ]
+      handler.write("{0:d}\n{1} --> {2}\n{3}\n\n".format(
+        index,
+        srt_timestamp(milliseconds),
+        srt_timestamp(milliseconds + duration),
+        "\n".join(lines)
+      ))
+      milliseconds += duration + generator.randint(0, 1500)
+
+def write_corpus(directory, seasons = 9, episodes = 24, count = 350):
+  """
+  Writes a synthetic series of SRT files, laid out as <directory>/S<n>/E<m>.srt.
+
+  Returns
+  -------
+  list
+    The paths written.
+  """
+  paths = []
+  for season in range(1, seasons + 1):
+    season_directory = os.path.join(directory, "S{0:02d}".format(season))
+    if not os.path.isdir(season_directory):
+      os.makedirs(season_directory)
+    for episode in range(1, episodes + 1):
+      path = os.path.join(season_directory, "E{0:02d}.srt".format(episode))
+      write_srt(path, count, season * 100 + episode)
+      paths.append(path)
+  return paths
+
+def best_time(function, repeat = 3):
+  """
+  The fastest of several calls of a function, in seconds.
+  """
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    function()
+    times.append(time.time() - start)
+  return min(times)
+
+def _measure(connection, function, args):
+  """
+  Internal. Runs a function in a child process, sending back its result and peak memory growth.
+  """
+  start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  try:
+    result = function(*args)
+  except Exception:
+    connection.send((None, traceback.format_exc()))
+  else:
+    connection.send((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start))
+  connection.close()
+
+def peak_memory(function, *args):
+  """
+  Calls a function in a fresh child process, measuring how far it raises the peak resident size.
+
+  Parameters
+  ----------
+  function : function
+    The function to call. Its result must be picklable.
+  *args : list
+    The arguments to call it with.
+
+  Returns
+  -------
+  tuple
+    What the function returned, and the growth in peak resident size in KiB (bytes on macOS).
+  """
+  parent, child = multiprocessing.Pipe()
+  process = multiprocessing.Process(target = _measure, args = (child, function, args))
+  process.start()
+  result, growth = parent.recv()
+  process.join()
+  if isinstance(growth, six.string_types):
+    raise RuntimeError("Child process failed.\n{0}".format(growth))
+  return result, growth
+
+class StandInHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  Answers every POST like imgur would: the token endpoint with a token, anything else with an
+  image link. Request bodies are read and discarded in chunks.
+  """
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def read_body(self):
+    remaining = int(self.headers.get("Content-Length", 0))
+    while remaining > 0:
+      remaining -= len(self.rfile.read(min(remaining, 65536)))
+
+  def respond(self, status, data, headers = {}):
+    body = json.dumps(data).encode("UTF-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in six.iteritems(headers):
+      self.send_header(name, str(value))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    self.read_body()
+    if self.path.endswith("/token"):
+      self.respond(200, {"access_token": "token", "refresh_token": "refresh", "expires_in": 3600})
+    else:
+      self.respond(200, {"data": {"link": "https://i.imgur.com/benchmark.gif"}})
+
+class StandInServer(six.moves.socketserver.ThreadingMixIn, six.moves.BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+def start_stand_in(handler_class = StandInHandler):
+  """
+  Starts a local HTTP stand-in for imgur on a free port, in a daemon thread.
+
+  Returns
+  -------
+  tuple
+    The server, and its base URL.
+  """
+  server = StandInServer(("127.0.0.1", 0), handler_class)
+  thread = threading.Thread(target = server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, "http://127.0.0.1:{0:d}".format(server.server_address[1])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how many subtitle rows per second a full crawl of a synthetic series inserts with each
+of SubtitleDatabase's insert methods: "row" (one INSERT per row, as before bulk ingest), "batch"
+(multi-row INSERTs) and "copy" (COPY FROM STDIN).
+
+Needs a PostgreSQL database the user may create extensions in. Use a scratch database: its
+subtitles and srt tables are emptied before each run.
+
+Usage: python benchmarks/crawl_insert.py <host> <port> <database> <username> <password>
+         [--depth 2] [--seasons 9] [--episodes 24] [--count 350] [--workers 1]
+"""
+from __future__ import unicode_literals, print_function
+import time
+import shutil
+import argparse
+import tempfile
+
+from common import write_corpus
+from dundergifflin.database import Database, SubtitleDatabase
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks subtitle insert methods.")
+  parser.add_argument("host")
+  parser.add_argument("port", type = int)
+  parser.add_argument("database")
+  parser.add_argument("username")
+  parser.add_argument("password")
+  parser.add_argument("--depth", type = int, default = 2, help = "The concatenation depth.")
+  parser.add_argument("--seasons", type = int, default = 9)
+  parser.add_argument("--episodes", type = int, default = 24, help = "Episodes per season.")
+  parser.add_argument("--count", type = int, default = 350, help = "Subtitles per episode.")
+  parser.add_argument("--workers", type = int, default = 1, help = "Crawl worker processes.")
+  parser.add_argument("--methods", default = ",".join(SubtitleDatabase.INSERT_METHODS), help = "Comma-separated insert methods to run.")
+  args = parser.parse_args()
+  connection = (args.host, args.port, args.database, args.username, args.password)
+
+  empty_directory = tempfile.mkdtemp()
+  corpus_directory = tempfile.mkdtemp()
+  try:
+    paths = write_corpus(corpus_directory, args.seasons, args.episodes, args.count)
+    with SubtitleDatabase(*(connection + (empty_directory,))):
+      pass
+
+    baseline = None
+    for method in args.methods.split(","):
+      with Database(*connection) as database:
+        cursor = database.get_connection().cursor()
+        cursor.execute("TRUNCATE subtitles, srt")
+        cursor.connection.commit()
+      start = time.time()
+      with SubtitleDatabase(*(connection + (corpus_directory, args.depth, method, args.workers))) as database:
+        elapsed = time.time() - start
+        cursor = database.get_connection().cursor()
+        cursor.execute("SELECT COUNT(*) FROM subtitles")
+        rows = cursor.fetchone()[0]
+      baseline = baseline or elapsed
+      print("{0:<6s} {1:d} episodes, {2:d} rows in {3:.2f}s: {4:10.0f} rows/s {5:6.2f}x".format(
+        method,
+        len(paths),
+        rows,
+        elapsed,
+        rows / elapsed,
+        baseline / elapsed
+      ))
+  finally:
+    shutil.rmtree(empty_directory)
+    shutil.rmtree(corpus_directory)
+
+if __name__ == "__main__":
+  main()
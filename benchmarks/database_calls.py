@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the per-call overhead of getting a cursor and running a trivial query through
+Database, with:
+
+- a single connection and a new cursor per call, as every method did before pooling (each
+  get_connection() also runs a SELECT 1 health check);
+- a single connection, reusing the thread's cursor;
+- the connection pool, where no health check is run.
+
+Usage: python benchmarks/database_calls.py <host> <port> <database> <username> <password>
+         [--calls 5000] [--pool-size 4]
+"""
+from __future__ import unicode_literals, print_function
+import time
+import argparse
+
+from dundergifflin.database import Database
+
+def measure(call, calls):
+  call()
+  start = time.time()
+  for i in range(calls):
+    call()
+  return (time.time() - start) / calls
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks Database per-call overhead.")
+  parser.add_argument("host")
+  parser.add_argument("port", type = int)
+  parser.add_argument("database")
+  parser.add_argument("username")
+  parser.add_argument("password")
+  parser.add_argument("--calls", type = int, default = 5000)
+  parser.add_argument("--pool-size", type = int, default = 4)
+  args = parser.parse_args()
+  connection = (args.host, args.port, args.database, args.username, args.password)
+
+  def query(cursor):
+    cursor.execute("SELECT 1")
+    cursor.fetchone()
+
+  with Database(*connection) as database:
+    single_new = measure(lambda: query(database.get_connection().cursor()), args.calls)
+    single_reused = measure(lambda: query(database.get_cursor()), args.calls)
+  with Database(*(connection + (args.pool_size,))) as database:
+    pooled = measure(lambda: query(database.get_cursor()), args.calls)
+
+  for name, seconds in [
+    ("single, new cursor", single_new),
+    ("single, reused cursor", single_reused),
+    ("pooled", pooled)
+  ]:
+    print("{0:<22s} {1:8.1f} us/call {2:6.2f}x".format(name, seconds * 1e6, single_new / seconds))
+
+if __name__ == "__main__":
+  main()
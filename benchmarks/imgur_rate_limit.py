@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs uploads from several forked processes through UploadExecutor against a local stand-in for
+imgur that enforces a user rate limit, to show how many requests are refused with a 429:
+
+- "separate", each process with its own Imgur client, as before rate limits were shared, so
+  a process only learns credits are used up once it is refused itself;
+- "shared", one Imgur client created before the fork, whose rate limits every process reads
+  and records.
+
+The stand-in allows --limit uploads every --window seconds, reporting them in the
+X-RateLimit-User* headers, and answers 429 with a Retry-After once they are used up.
+
+Usage: python benchmarks/imgur_rate_limit.py [--processes 3] [--uploads 20] [--workers 2]
+         [--limit 10] [--window 2]
+"""
+from __future__ import unicode_literals, print_function
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from common import StandInHandler, start_stand_in
+from dundergifflin.imgur import Imgur, UploadExecutor
+from dundergifflin.util import url_join, logger
+
+class RateLimitedHandler(StandInHandler):
+  """
+  A stand-in that allows a limited number of uploads per window, across every client.
+  """
+  limit = 10
+  window = 2.0
+  lock = threading.Lock()
+  remaining = 0
+  reset = 0
+  accepted = 0
+  refused = 0
+
+  @classmethod
+  def configure(cls, limit, window):
+    with cls.lock:
+      cls.limit = limit
+      cls.window = window
+      cls.remaining = limit
+      cls.reset = time.time() + window
+      cls.accepted = 0
+      cls.refused = 0
+
+  def do_POST(self):
+    if self.path.endswith("/token"):
+      return StandInHandler.do_POST(self)
+    self.read_body()
+    cls = RateLimitedHandler
+    with cls.lock:
+      now = time.time()
+      if now >= cls.reset:
+        cls.remaining = cls.limit
+        cls.reset = now + cls.window
+      allowed = cls.remaining > 0
+      if allowed:
+        cls.remaining -= 1
+        cls.accepted += 1
+      else:
+        cls.refused += 1
+      headers = {
+        "X-RateLimit-UserLimit": cls.limit,
+        "X-RateLimit-UserRemaining": cls.remaining,
+        "X-RateLimit-UserReset": int(cls.reset + 1)
+      }
+    if allowed:
+      self.respond(200, {"data": {"link": "https://i.imgur.com/benchmark.gif"}}, headers)
+    else:
+      headers["Retry-After"] = int(headers["X-RateLimit-UserReset"] - now + 1)
+      self.respond(429, {"data": {"error": "Rate limited."}}, headers)
+
+def connect(url):
+  return Imgur("client", "secret", "127.0.0.1", 0, refresh_token = "refresh", api_endpoint = url, auth_endpoint = url_join(url, "oauth2"))
+
+def upload(imgur, url, path, uploads, workers, results):
+  if imgur is None:
+    imgur = connect(url).__enter__()
+  executor = UploadExecutor(imgur, workers)
+  jobs = [executor.submit(path, "Benchmark", "Benchmark") for i in range(uploads)]
+  failed = 0
+  for job in jobs:
+    try:
+      job.result()
+    except Exception:
+      failed += 1
+  results.put((len(jobs) - failed, failed, executor.metrics()))
+
+def run(url, path, shared, args):
+  RateLimitedHandler.configure(args.limit, args.window)
+  imgur = connect(url).__enter__() if shared else None
+  results = multiprocessing.Queue()
+  processes = [
+    multiprocessing.Process(target = upload, args = (imgur, url, path, args.uploads, args.workers, results))
+    for i in range(args.processes)
+  ]
+  start = time.time()
+  for process in processes:
+    process.start()
+  outcomes = [results.get() for process in processes]
+  elapsed = time.time() - start
+  for process in processes:
+    process.join()
+  print("{0:<9s} {1:5.1f}s, {2:d} uploaded, {3:d} failed, {4:d} refused with 429, mean upload {5:.2f}s".format(
+    "shared" if shared else "separate",
+    elapsed,
+    sum(completed for completed, failed, metrics in outcomes),
+    sum(failed for completed, failed, metrics in outcomes),
+    RateLimitedHandler.refused,
+    sum(metrics["run"] for completed, failed, metrics in outcomes) / len(outcomes)
+  ))
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks imgur rate limiting across processes.")
+  parser.add_argument("--processes", type = int, default = 3)
+  parser.add_argument("--uploads", type = int, default = 20, help = "Uploads per process.")
+  parser.add_argument("--workers", type = int, default = 2, help = "Upload threads per process.")
+  parser.add_argument("--limit", type = int, default = 10, help = "Uploads allowed per window.")
+  parser.add_argument("--window", type = float, default = 2, help = "The rate limit window, in seconds.")
+  args = parser.parse_args()
+  logging.basicConfig()
+  logger.setLevel(logging.ERROR)
+
+  server, url = start_stand_in(RateLimitedHandler)
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, "benchmark.gif")
+    with open(path, "wb") as image_file:
+      image_file.write(os.urandom(65536))
+    print("{0:d} processes x {1:d} uploads, {2:d} allowed every {3:.1f}s".format(args.processes, args.uploads, args.limit, args.window))
+    run(url, path, False, args)
+    run(url, path, True, args)
+  finally:
+    server.shutdown()
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares imgur upload latency and peak memory against a local HTTP stand-in for imgur:
+
+- "base64", as uploads were sent before: the file read into memory, base64 encoded, and
+  URL encoded into a fresh requests.post() per upload;
+- "multipart", Imgur.upload(): the file streamed from disk in a multipart body, over the
+  client's pooled session.
+
+Each method runs in its own child process, so peak memory is measured separately.
+
+Usage: python benchmarks/imgur_upload.py [--size 8] [--uploads 20]
+"""
+from __future__ import unicode_literals, print_function
+import os
+import time
+import logging
+import base64
+import shutil
+import argparse
+import tempfile
+import requests
+
+from common import start_stand_in, peak_memory
+from dundergifflin.imgur import Imgur
+from dundergifflin.util import url_join, url_encode, logger
+
+def upload_base64(url, path, uploads):
+  latencies = []
+  for i in range(uploads):
+    start = time.time()
+    with open(path, "rb") as image_file:
+      encoded_image = base64.b64encode(image_file.read())
+    response = requests.post(
+      url_join(url, "image"),
+      headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Authorization": "Bearer token"
+      },
+      data = url_encode(
+        name = os.path.basename(path),
+        description = "Benchmark",
+        title = "Benchmark",
+        image = encoded_image,
+        type = "base64"
+      )
+    )
+    response.json()["data"]["link"]
+    latencies.append(time.time() - start)
+  return latencies
+
+def upload_multipart(url, path, uploads):
+  latencies = []
+  with Imgur("client", "secret", "127.0.0.1", 0, refresh_token = "refresh", api_endpoint = url, auth_endpoint = url_join(url, "oauth2")) as imgur:
+    for i in range(uploads):
+      start = time.time()
+      imgur.upload(path, "Benchmark", "Benchmark")
+      latencies.append(time.time() - start)
+  return latencies
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks imgur uploads against a local stand-in.")
+  parser.add_argument("--size", type = float, default = 8, help = "The image size, in MiB.")
+  parser.add_argument("--uploads", type = int, default = 20)
+  args = parser.parse_args()
+  logging.basicConfig()
+  logger.setLevel(logging.WARNING)
+
+  server, url = start_stand_in()
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, "benchmark.gif")
+    with open(path, "wb") as image_file:
+      image_file.write(os.urandom(int(args.size * 1048576)))
+    print("{0:d} uploads of {1:.1f} MiB to {2}".format(args.uploads, args.size, url))
+    for name, method in [("base64", upload_base64), ("multipart", upload_multipart)]:
+      latencies, kib = peak_memory(method, url, path, args.uploads)
+      latencies.sort()
+      print("{0:<10s} median {1:7.1f} ms, max {2:7.1f} ms, {3:8.1f} MiB peak".format(
+        name,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[-1] * 1000,
+        kib / 1024.0
+      ))
+  finally:
+    server.shutdown()
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
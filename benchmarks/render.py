@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares GIF size and render time for SubtitleConverter settings: without and with a generated
+palette, with the "shadow" and "border" text stroke methods, at a narrow and a wide stroke. The
+first row (no palette, shadow stroke) is how GIFs were rendered before. With --max-size, a
+final row renders with the palette and border stroke down the size ladder, to fit that size.
+
+Needs ffmpeg on the PATH.
+
+Usage: python benchmarks/render.py <video> <font> [--start 00:01:00,000] [--end 00:01:04,000]
+         [--text "That's what she said."] [--width 480] [--max-size 2097152] [--repeat 1]
+"""
+from __future__ import unicode_literals, print_function
+import os
+import time
+import logging
+import argparse
+
+from dundergifflin.ffmpeg import Converter, SubtitleConverter
+from dundergifflin.util import MillisecondTimestamp, logger
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks GIF render settings.")
+  parser.add_argument("video")
+  parser.add_argument("font")
+  parser.add_argument("--start", default = "00:01:00,000")
+  parser.add_argument("--end", default = "00:01:04,000")
+  parser.add_argument("--text", default = "That's what she said.")
+  parser.add_argument("--width", type = int, default = 480)
+  parser.add_argument("--max-size", type = int, default = 0, help = "Also render to fit this many bytes.")
+  parser.add_argument("--repeat", type = int, default = 1, help = "Renders per setting; the best time is reported.")
+  args = parser.parse_args()
+  logging.basicConfig()
+  logger.setLevel(logging.WARNING)
+  start = MillisecondTimestamp.from_string(args.start)
+  end = MillisecondTimestamp.from_string(args.end)
+
+  settings = [
+    (palette, method, stroke_width, None)
+    for palette in [False, True]
+    for method in ["shadow", "border"]
+    for stroke_width in [2, 6]
+  ]
+  if args.max_size:
+    settings.append((True, "border", 2, args.max_size))
+
+  baseline = None
+  for palette, method, stroke_width, max_size in settings:
+    times = []
+    for i in range(args.repeat):
+      converter = SubtitleConverter(
+        os.path.abspath(args.video),
+        Converter.PIPE,
+        True,
+        start,
+        end,
+        args.text,
+        args.width,
+        os.path.abspath(args.font),
+        "white",
+        36,
+        20,
+        stroke_width,
+        None,
+        palette,
+        max_size,
+        method
+      )
+      render_start = time.time()
+      size = len(converter.execute())
+      times.append(time.time() - render_start)
+    baseline = baseline or size
+    print("palette {0:<5s} {1:<6s} stroke {2:d} {3:>10s}: {4:9d} bytes {5:5.2f}x, {6:6.2f}s, {7:d} attempt(s)".format(
+      "on" if palette else "off",
+      method,
+      stroke_width,
+      "max {0:d}".format(max_size) if max_size else "",
+      size,
+      baseline / float(size),
+      min(times),
+      len(converter.attempts)
+    ))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the memory used to hold a full series of subtitles as Subtitles objects and as
+SubtitleColumns. Each layout is loaded in a fresh child process, and the growth in its peak
+resident size is reported.
+
+Usage: python benchmarks/srt_memory.py [--seasons 9] [--episodes 24] [--count 350]
+
+Run under Python 2; the Subtitles class reads files as bytes.
+"""
+from __future__ import unicode_literals, print_function
+import shutil
+import argparse
+import tempfile
+
+from common import write_corpus, peak_memory
+from dundergifflin.srt import Subtitles, SubtitleColumns
+
+def load_objects(paths):
+  episodes = [Subtitles(path).subtitles for path in paths]
+  return sum(len(subtitles) for subtitles in episodes)
+
+def load_columns(paths):
+  episodes = [SubtitleColumns.from_file(path) for path in paths]
+  return sum(len(columns) for columns in episodes), sum(columns.nbytes() for columns in episodes)
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks the memory used by subtitle layouts.")
+  parser.add_argument("--seasons", type = int, default = 9)
+  parser.add_argument("--episodes", type = int, default = 24, help = "Episodes per season.")
+  parser.add_argument("--count", type = int, default = 350, help = "Subtitles per episode.")
+  args = parser.parse_args()
+
+  directory = tempfile.mkdtemp()
+  try:
+    paths = write_corpus(directory, args.seasons, args.episodes, args.count)
+    subtitles, objects_kib = peak_memory(load_objects, paths)
+    (subtitles, nbytes), columns_kib = peak_memory(load_columns, paths)
+    print("{0:d} episodes, {1:d} subtitles".format(len(paths), subtitles))
+    print("{0:<16s} {1:8.1f} MiB peak".format("Subtitles", objects_kib / 1024.0))
+    print("{0:<16s} {1:8.1f} MiB peak, {2:.1f} MiB in arrays and text".format("SubtitleColumns", columns_kib / 1024.0, nbytes / 1048576.0))
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
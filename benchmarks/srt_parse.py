@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the time to parse a large synthetic SRT file with the Subtitles class, the streaming
+iter_subtitles() parser, and SubtitleColumns.
+
+Usage: python benchmarks/srt_parse.py [--count 50000] [--repeat 3]
+
+Run under Python 2; the Subtitles class reads files as bytes.
+"""
+from __future__ import unicode_literals, print_function
+import os
+import shutil
+import argparse
+import tempfile
+
+from common import write_srt, best_time
+from dundergifflin.srt import Subtitles, SubtitleColumns, iter_subtitles
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmarks the SRT parsers.")
+  parser.add_argument("--count", type = int, default = 50000, help = "The number of subtitles in the file.")
+  parser.add_argument("--repeat", type = int, default = 3, help = "How many times to parse; the best time is reported.")
+  args = parser.parse_args()
+
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, "benchmark.srt")
+    write_srt(path, args.count)
+    print("{0:d} subtitles, {1:.1f} MiB".format(args.count, os.path.getsize(path) / 1048576.0))
+
+    parsers = [
+      ("Subtitles", lambda: Subtitles(path).subtitles),
+      ("iter_subtitles", lambda: list(iter_subtitles(path))),
+      ("SubtitleColumns", lambda: SubtitleColumns.from_file(path))
+    ]
+    baseline = None
+    for name, parse in parsers:
+      seconds = best_time(parse, args.repeat)
+      baseline = baseline or seconds
+      print("{0:<16s} {1:8.3f}s {2:10.0f} subtitles/s {3:6.2f}x".format(name, seconds, args.count / seconds, baseline / seconds))
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
@@ -14,6 +14,7 @@ from dundergifflin.config import Configuration
 from dundergifflin.util import process_is_alive
 from dundergifflin.monitor import BotMonitor
 from dundergifflin.color import Color
+from dundergifflin.ffmpeg import proxy_path, find_proxy, build_proxy
 
 def color_success(msg):
   """
@@ -235,6 +236,32 @@ def shutdown(args):
         return
     print(color_success("Bot monitor stopped."))
         
+def proxy(args):
+  """
+  Build low-resolution proxies of every episode in a media directory.
+  """
+  for season in sorted(os.listdir(args.directory)):
+    season_directory = os.path.join(args.directory, season)
+    if not season.lower().startswith("s") or not os.path.isdir(season_directory):
+      continue
+    for filename in sorted(os.listdir(season_directory)):
+      if not filename.lower().startswith("e") or not filename.endswith(".mkv") or filename.endswith(".proxy.mkv"):
+        continue
+      episode_path = os.path.join(season_directory, filename)
+      if find_proxy(episode_path) is not None and not args.force:
+        print("{0}: {1}".format(color_info("Proxy up to date"), episode_path))
+        continue
+      partial_path = "{0}.partial.mkv".format(os.path.splitext(proxy_path(episode_path))[0])
+      start = time.time()
+      try:
+        build_proxy(episode_path, partial_path, args.width, args.gop)
+        os.rename(partial_path, proxy_path(episode_path))
+        print("{0}: {1} ({2:.1f} seconds)".format(color_success("Proxy built"), episode_path, time.time() - start))
+      except IOError as ex:
+        if os.path.exists(partial_path):
+          os.remove(partial_path)
+        print("{0}: {1}\n{2}".format(color_failure("Proxy failed"), episode_path, str(ex)))
+
 parser = argparse.ArgumentParser(description = "Starts, stops, and monitors dundergifflin-configured reddit bots.")
 parser.add_argument("-c", "--config", help="The configuration file for the bot monitor. Defaults to $HOME/dundergifflin.cfg.", default = os.path.join(os.path.expanduser("~"), "dundergifflin.cfg"))
 
@@ -262,6 +289,13 @@ subparser_shutdown.set_defaults(func=shutdown)
 subparser_status = subparsers.add_parser("status", description = "Retrieve the status of the monitor and any bot scripts, as well as the peg count for each script.")
 subparser_status.set_defaults(func=status)
 
+subparser_proxy = subparsers.add_parser("proxy", description = "Transcode each S<n>/E<m>.mkv in a media directory into a small, short-GOP E<m>.proxy.mkv that renders prefer.")
+subparser_proxy.add_argument("directory", type=str, help="The media directory, containing S<n> season directories.")
+subparser_proxy.add_argument("-w", "--width", type=int, help="The width of the proxies. Should match the width GIFs are rendered at. Defaults to 480.", default = 480)
+subparser_proxy.add_argument("-g", "--gop", type=int, help="The number of frames between keyframes. 1 makes every frame a keyframe. Defaults to 12.", default = 12)
+subparser_proxy.add_argument("-f", "--force", action="store_true", help="Rebuild proxies that are already up to date.")
+subparser_proxy.set_defaults(func=proxy)
+
 def main():
   args = parser.parse_args(sys.argv[1:])
   args.func(args)
@@ -3,18 +3,291 @@
 from __future__ import unicode_literals, print_function
 import csv
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 import re
 import os
+import time
 import traceback
-from dundergifflin.util import md5sum, logger
-from dundergifflin.srt import Subtitles
+import multiprocessing
+import threading
+import collections
+import six
+from dundergifflin.util import md5sum, stat_signature, unique, LRUCache, logger
+from dundergifflin.srt import SubtitleColumns
+from dundergifflin.trigram import TrigramIndex, normalize
+from dundergifflin.ffmpeg import probe_keyframes
+
+def subtitle_rows(season_number, episode_number, columns, concatenation_depth):
+  """
+  Generates the rows to insert into the subtitles table for one episode.
+
+  Parameters
+  ----------
+  season_number : int
+    The season of the episode.
+  episode_number : int
+    The episode number.
+  columns : dundergifflin.srt.SubtitleColumns
+    The parsed subtitles of the episode.
+  concatenation_depth : int
+    How many lines to concatenate together, at most.
+
+  Returns
+  -------
+  generator
+    Tuples of (season, episode, start_index, end_index, start_time, end_time, subtitle).
+  """
+  for start_index, end_index, start, end, text in columns.windows(concatenation_depth):
+    yield (
+      season_number,
+      episode_number,
+      start_index,
+      end_index,
+      start / 1000.0,
+      end / 1000.0,
+      text
+    )
+
+def crawl_episode(task):
+  """
+  Hashes and parses one .srt file, generating its rows if it is new or has changed.
+
+  This is module-level so it can be sent to a multiprocessing pool. It never raises, instead
+  returning the formatted exception so one bad file does not stop the crawl.
+
+  Parameters
+  ----------
+  task : tuple
+    subtitle_path : string
+      The path to the .srt file.
+    season_number : int
+      The season of the episode.
+    episode_number : int
+      The episode number.
+    known_md5 : string
+      The md5sum last recorded for this path, or None.
+    concatenation_depth : int
+      How many lines to concatenate together, at most.
+    signature : tuple
+      The (mtime, size, inode) of the file when the crawl started.
+
+  Returns
+  -------
+  tuple
+    subtitle_path : string
+    season_number : int
+    episode_number : int
+    md5 : string
+      The md5sum of the file. None if an error occurred.
+    signature : tuple
+    rows : list
+      The rows to insert, or None if the file is unchanged.
+    error : string
+      The formatted exception, or None.
+  """
+  subtitle_path, season_number, episode_number, known_md5, concatenation_depth, signature = task
+  try:
+    md5 = md5sum(subtitle_path)
+    if md5 == known_md5:
+      return subtitle_path, season_number, episode_number, md5, signature, None, None
+    rows = list(subtitle_rows(season_number, episode_number, SubtitleColumns.from_file(subtitle_path), concatenation_depth))
+    return subtitle_path, season_number, episode_number, md5, signature, rows, None
+  except Exception as ex:
+    return subtitle_path, season_number, episode_number, None, signature, None, "{0}(): {1}\n{2}".format(
+      type(ex).__name__,
+      str(ex),
+      traceback.format_exc()
+    )
+
+class CopyStream(object):
+  """
+  A file-like object that lazily formats rows for PostgreSQL's COPY FROM STDIN, in the
+  default text format. Only as many rows as are needed to satisfy each read() are formatted.
+
+  Parameters
+  ----------
+  rows : iterable
+    An iterable of tuples. None is written as NULL, all other values are formatted as strings.
+  """
+  ESCAPES = [
+    ("\\", "\\\\"),
+    ("\n", "\\n"),
+    ("\r", "\\r"),
+    ("\t", "\\t")
+  ]
+
+  def __init__(self, rows):
+    self.rows = iter(rows)
+    self.buffer = ""
+
+  @staticmethod
+  def format_value(value):
+    """
+    Formats a single value for the COPY text format.
+    """
+    if value is None:
+      return "\\N"
+    value = value if isinstance(value, six.text_type) else six.text_type(value)
+    for character, escaped in CopyStream.ESCAPES:
+      value = value.replace(character, escaped)
+    return value
+
+  def read(self, size = -1):
+    """
+    Reads up to `size` characters of formatted rows. Reads everything if size is negative.
+    """
+    while size < 0 or len(self.buffer) < size:
+      try:
+        row = next(self.rows)
+      except StopIteration:
+        break
+      self.buffer += "\t".join([CopyStream.format_value(value) for value in row]) + "\n"
+    if size < 0:
+      size = len(self.buffer)
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+  def readline(self, size = -1):
+    return self.read(size)
+
+class WriteBehindBuffer(object):
+  """
+  Buffers writes in memory, coalescing them by key, and flushes them together.
+
+  A flush happens when the buffer holds `size` keys, every `interval` seconds from a
+  background thread, or when flush() is called (e.g. on shutdown). The background thread
+  is started by start(), or lazily by the first write in each process, so a buffer inherited
+  through fork() keeps flushing in the child. The lock is likewise per process, so a child never
+  inherits it held by a thread of its parent. Writes still buffered when a process is killed are lost.
+
+  Parameters
+  ----------
+  flush_function : function(list)
+    Called with the latest value for each buffered key, in the order the keys were first written.
+    If it raises, the values are kept and retried on the next flush.
+  size : int
+    The number of buffered keys that triggers a flush.
+  interval : float
+    The maximum number of seconds a write is buffered for.
+  tick_function : function()
+    Optional. Called from the background thread after every interval, for other periodic
+    housekeeping. If it raises, the error is logged and it is called again next interval.
+  """
+  def __init__(self, flush_function, size = 250, interval = 60, tick_function = None):
+    self.flush_function = flush_function
+    self.tick_function = tick_function
+    self.size = size
+    self.interval = interval
+    self.pending = collections.OrderedDict()
+    self.writes = 0
+    self.flushes = 0
+    self._pid = None
+    self._locks = {}
+
+  def __len__(self):
+    return len(self.pending)
+
+  @property
+  def lock(self):
+    """
+    This process's lock over the buffer. dict.setdefault() is atomic, so threads agree on the lock.
+    """
+    pid = os.getpid()
+    lock = self._locks.get(pid)
+    if lock is None:
+      lock = self._locks.setdefault(pid, threading.RLock())
+    return lock
+
+  def put(self, key, value):
+    """
+    Buffers a value, replacing any value still buffered for the same key.
+
+    Parameters
+    ----------
+    key : object
+      A hashable key to coalesce writes on.
+    value : object
+      The value to pass to the flush function.
+    """
+    self.start()
+    with self.lock:
+      self.pending[key] = value
+      self.writes += 1
+      full = len(self.pending) >= self.size
+    if full:
+      self.flush()
+
+  def flush(self):
+    """
+    Writes everything buffered through the flush function.
+
+    Returns
+    -------
+    int
+      The number of values flushed.
+    """
+    with self.lock:
+      if not self.pending:
+        return 0
+      pending, self.pending = self.pending, collections.OrderedDict()
+      try:
+        self.flush_function(list(pending.values()))
+      except:
+        pending.update(self.pending)
+        self.pending = pending
+        raise
+      self.flushes += 1
+      return len(pending)
+
+  def start(self):
+    """
+    Starts the background flushing thread, if not already running in this process.
+    """
+    if self._pid == os.getpid():
+      return
+    with self.lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      thread = threading.Thread(target = self._run)
+      thread.daemon = True
+      thread.start()
+
+  def _run(self):
+    """
+    Internal. The background thread's loop.
+    """
+    pid = os.getpid()
+    while self._pid == pid:
+      time.sleep(self.interval)
+      try:
+        self.flush()
+      except Exception as ex:
+        logger.error("Could not flush buffered writes, will retry.\n{0}(): {1}\n{2}".format(
+          type(ex).__name__,
+          str(ex),
+          traceback.format_exc()
+        ))
+      if self.tick_function is not None:
+        try:
+          self.tick_function()
+        except Exception as ex:
+          logger.error("Background task failed, will retry.\n{0}(): {1}\n{2}".format(
+            type(ex).__name__,
+            str(ex),
+            traceback.format_exc()
+          ))
 
 class Database(object):
   """
   A small database wrapper around a PostgreSQL database.
 
-  Builds only one database connection, not a pool.
-  Uses a context manager to open/close the connection on enter/exit.
+  Builds only one database connection unless a pool size is given, in which case each thread
+  checks out its own connection from a pool. Background work, such as flushing buffered writes,
+  gets a connection of its own in either mode; see get_background_cursor().
+  Uses a context manager to open/close the connection(s) on enter/exit.
 
   Parameters
   ----------
@@ -28,13 +301,80 @@ class Database(object):
     The username of the user. Should be a superuser of the target database.
   password : string
     The password for said user.
+  pool_size : int
+    The maximum number of pooled connections per process. With 0 (the default), a single
+    connection is used.
   """
-  def __init__(self, host, port, database_name, username, password):
+  def __init__(self, host, port, database_name, username, password, pool_size = 0):
     self.host = host
     self.port = port
     self.database_name = database_name
     self.username = username
     self.password = password
+    self.pool_size = int(pool_size or 0)
+    self._inherited = []
+    self._locks = {}
+    self._reset_connections()
+
+  def _reset_connections(self):
+    """
+    Internal. Forgets all connections, pooled or not, and remembers which process they belong to.
+    """
+    self._pid = os.getpid()
+    self._local = threading.local()
+    self.pool = None
+    self._background_lock = threading.RLock()
+    self.background_connection = None
+    self.background_cursor = None
+    if hasattr(self, "connection"):
+      del self.connection
+
+  def _lock(self):
+    """
+    Internal. This process's lock over the connection state.
+
+    Each process gets its own lock, so one held by another thread at the moment of a fork is
+    never inherited held. dict.setdefault() is atomic, so threads agree on the lock.
+    """
+    pid = os.getpid()
+    lock = self._locks.get(pid)
+    if lock is None:
+      lock = self._locks.setdefault(pid, threading.RLock())
+    return lock
+
+  @property
+  def background_lock(self):
+    """
+    The lock to hold while using the background cursor. Forks are checked for first, so a child
+    process gets a fresh lock rather than one a thread of its parent held at the moment of the fork.
+    """
+    self._check_fork()
+    return self._background_lock
+
+  def _check_fork(self):
+    """
+    Internal. If this process was forked after connections were opened, abandons them.
+
+    Closing an inherited connection (explicitly, or by letting it be garbage collected)
+    would terminate the parent's session, so references to them are kept but never used.
+    """
+    if self._pid != os.getpid():
+      with self._lock():
+        if self._pid != os.getpid():
+          self._inherited.append((self.pool, getattr(self, "connection", None), self._local, self.background_connection))
+          self._reset_connections()
+
+  def _connect(self):
+    """
+    Internal. Opens a new connection with the configured parameters.
+    """
+    return psycopg2.connect(
+      dbname = self.database_name, 
+      user = self.username, 
+      password = self.password, 
+      host = self.host, 
+      port = int(self.port)
+    )
 
   def test_connection(self):
     """
@@ -58,31 +398,133 @@ class Database(object):
     """
     Retrieve a connection to the database.
 
-    Will test the connection if one already exists, or recreate it if it has been closed.
+    Without a pool, will test the connection if one already exists, or recreate it if it has been closed.
+
+    With a pool, each thread checks out its own connection and keeps it until release_connection()
+    is called. No test query is run; a connection is only replaced once psycopg2 has marked it
+    closed after an error, and a transaction left failed by an error is rolled back.
+
+    In either mode, connections opened before a fork are never used by the child process.
 
     Returns
     -------
     psycopg2.connection
       A psycopg2 connection object to the database.
     """
+    self._check_fork()
+    if self.pool_size > 0:
+      return self._get_pooled_connection()
     if hasattr(self, "connection") and not self.connection.closed:
       if self.test_connection():
         return self.connection
-    self.connection = psycopg2.connect(
-      dbname = self.database_name, 
-      user = self.username, 
-      password = self.password, 
-      host = self.host, 
-      port = int(self.port)
-    )
+    self.connection = self._connect()
     return self.connection
 
+  def _get_pooled_connection(self):
+    """
+    Internal. Checks out (or reuses) this thread's connection from the pool.
+    """
+    if self.pool is None:
+      with self._lock():
+        if self.pool is None:
+          self.pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            self.pool_size,
+            dbname = self.database_name, 
+            user = self.username, 
+            password = self.password, 
+            host = self.host, 
+            port = int(self.port)
+          )
+    connection = getattr(self._local, "connection", None)
+    if connection is not None and connection.closed:
+      self.release_connection()
+      connection = None
+    if connection is None:
+      connection = self.pool.getconn()
+      if connection.closed:
+        self.pool.putconn(connection, close = True)
+        connection = self.pool.getconn()
+      self._local.connection = connection
+    elif connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+      connection.rollback()
+    return connection
+
+  def release_connection(self):
+    """
+    Returns this thread's pooled connection to the pool. Should be called by threads that use the
+    database when they finish. Does nothing without a pool.
+    """
+    connection = getattr(self._local, "connection", None)
+    if connection is None or self.pool is None:
+      return
+    self._local.connection = None
+    self._local.cursor = None
+    try:
+      self.pool.putconn(connection, close = bool(connection.closed))
+    except psycopg2.pool.PoolError:
+      pass
+
+  def get_cursor(self):
+    """
+    Retrieve a cursor on the current connection.
+
+    Cursors are reused for as long as their connection is, rather than created for every query.
+
+    Returns
+    -------
+    psycopg2.cursor
+      A psycopg2 cursor object.
+    """
+    connection = self.get_connection()
+    cursor = getattr(self._local, "cursor", None)
+    if cursor is None or cursor.closed or cursor.connection is not connection:
+      cursor = connection.cursor()
+      self._local.cursor = cursor
+    return cursor
+
+  def get_background_cursor(self):
+    """
+    Retrieve a cursor for background work, such as flushing buffered writes from another thread.
+
+    Without a pool, the cursor is on a second connection, so background commits never interleave
+    with a transaction the main thread has open on its own. With a pool, it is on the calling
+    thread's pooled connection, as get_cursor() would be. Hold background_lock for as long as the
+    cursor is in use.
+
+    Returns
+    -------
+    psycopg2.cursor
+      A psycopg2 cursor object.
+    """
+    if self.pool_size > 0:
+      return self.get_cursor()
+    self._check_fork()
+    if self.background_connection is None or self.background_connection.closed:
+      self.background_connection = self._connect()
+      self.background_cursor = None
+    elif self.background_connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+      self.background_connection.rollback()
+    if self.background_cursor is None or self.background_cursor.closed:
+      self.background_cursor = self.background_connection.cursor()
+    return self.background_cursor
+
   def __enter__(self):
     return self
 
   def __exit__(self, *args):
+    if self._pid != os.getpid():
+      return
     try:
-      self.connection.close()
+      if self.pool is not None:
+        self.pool.closeall()
+      else:
+        self.connection.close()
+    except:
+      pass
+    try:
+      if self.background_connection is not None:
+        self.background_connection.close()
     except:
       pass
 
@@ -121,7 +563,31 @@ class SubtitleDatabase(Database):
 
     This will multiply the storage required and lookup time of each episode by the number
     passed in.
+  insert_method : string
+    How to insert crawled subtitles. One of "copy" (COPY FROM STDIN, the fastest),
+    "batch" (multi-row INSERT statements) or "row" (one INSERT per row).
+  crawl_workers : int
+    The number of processes used to hash and parse .srt files while crawling. With 1 (the default),
+    the crawl is done serially in this process.
+  search_backend : string
+    Where to run subtitle searches. Either "postgres" (the default), which uses pg_trgm's GIST
+    index, or "memory", which loads all subtitles into an in-process TrigramIndex after crawling.
+    Either way, results are cached in search_cache, keyed by the normalized text and limit,
+    until subtitles or comments change.
+  pool_size : int
+    The maximum number of pooled connections per process. With 0 (the default), a single
+    connection is used.
+
+  Keyframe indexes of video files are stored in the keyframes table by get_keyframes(),
+  alongside the subtitles, and kept until the file's (mtime, size, inode) signature changes.
   """
+  SEARCH_BACKENDS = ["postgres", "memory"]
+  SEARCH_CACHE_SIZE = 1000
+  KEYFRAME_CACHE_SIZE = 100
+  KEYFRAME_MISS_TTL = 60 * 10
+  KEYFRAME_PROBE_TIMEOUT = 60 * 10
+  INSERT_METHODS = ["copy", "batch", "row"]
+  INSERT_BATCH_SIZE = 1000
   
   SUBTITLE_MIGRATION = """
   BEGIN;
@@ -147,16 +613,42 @@ class SubtitleDatabase(Database):
     PRIMARY KEY (path)
   );
 
+  ALTER TABLE srt
+    ADD COLUMN IF NOT EXISTS mtime DOUBLE PRECISION,
+    ADD COLUMN IF NOT EXISTS size BIGINT,
+    ADD COLUMN IF NOT EXISTS inode BIGINT;
+
+  CREATE TABLE IF NOT EXISTS keyframes (
+    path VARCHAR NOT NULL,
+    mtime DOUBLE PRECISION NOT NULL,
+    size BIGINT NOT NULL,
+    inode BIGINT NOT NULL,
+    keyframes INT[] NOT NULL,
+    PRIMARY KEY (path)
+  );
+
   CREATE INDEX IF NOT EXISTS trigram_index ON subtitles USING GIST (subtitle gist_trgm_ops);
 
   COMMIT;
   """
-  def __init__(self, host, port, database_name, username, password, directory, concatenation_depth = 2):
-    super(SubtitleDatabase, self).__init__(host, port, database_name, username, password)
+  def __init__(self, host, port, database_name, username, password, directory, concatenation_depth = 2, insert_method = "copy", crawl_workers = 1, search_backend = "postgres", pool_size = 0):
+    super(SubtitleDatabase, self).__init__(host, port, database_name, username, password, pool_size)
+    if insert_method not in SubtitleDatabase.INSERT_METHODS:
+      raise ValueError("Unknown insert method '{0}', expected one of {1}.".format(insert_method, ", ".join(SubtitleDatabase.INSERT_METHODS)))
+    if search_backend not in SubtitleDatabase.SEARCH_BACKENDS:
+      raise ValueError("Unknown search backend '{0}', expected one of {1}.".format(search_backend, ", ".join(SubtitleDatabase.SEARCH_BACKENDS)))
     self.directory = directory
     self.concatenation_depth = concatenation_depth
+    self.insert_method = insert_method
+    self.crawl_workers = max(1, int(crawl_workers))
+    self.search_backend = search_backend
+    self.search_cache = LRUCache(SubtitleDatabase.SEARCH_CACHE_SIZE)
+    self.search_generation = multiprocessing.Value("i", 0)
+    self.keyframe_cache = LRUCache(SubtitleDatabase.KEYFRAME_CACHE_SIZE)
     self._migrate()
     self._crawl_subtitles()
+    if self.search_backend == "memory":
+      self._build_search_index()
   
   def find_subtitles(self, text, limit = 10):
     """
@@ -193,7 +685,70 @@ class SubtitleDatabase(Database):
         The likeness of this line, between 1 (~exact match) and 0 (no match).
     
     """
-    cursor = self.get_connection().cursor()
+    key = (normalize(text), limit, self.search_generation.value)
+    found_subtitles = self.search_cache.get(key)
+    if found_subtitles is None:
+      found_subtitles = self._query_subtitles(text, limit)
+      self.search_cache.put(key, found_subtitles)
+    return list(found_subtitles)
+
+  def find_subtitles_many(self, texts, limit = 10):
+    """
+    Find the closest subtitles to each of several lines of text, in one query.
+
+    Parameters
+    ----------
+    texts : list<string>
+      The texts to search for. Duplicates are only searched once.
+    limit : int
+      The number of rows to return per text.
+
+    Returns
+    -------
+    dict
+      text => list, where each list is the same as would be returned by find_subtitles(text, limit).
+    """
+    generation = self.search_generation.value
+    results = {}
+    missing = []
+    for text in unique(texts):
+      found_subtitles = self.search_cache.get((normalize(text), limit, generation))
+      if found_subtitles is None:
+        missing.append(text)
+      else:
+        results[text] = list(found_subtitles)
+    if missing:
+      for text, found_subtitles in six.iteritems(self._query_subtitles_many(missing, limit)):
+        self.search_cache.put((normalize(text), limit, generation), found_subtitles)
+        results[text] = list(found_subtitles)
+    return results
+
+  def invalidate_search_cache(self):
+    """
+    Invalidates every cached search result, in this process and all processes forked from
+    the one that created this database. Called whenever subtitles or comments change.
+    """
+    with self.search_generation.get_lock():
+      self.search_generation.value += 1
+    self.search_cache.clear()
+
+  def _search_memory(self, text, limit):
+    """
+    Internal. Searches the in-memory TrigramIndex.
+    """
+    return [
+      row + (likeness,)
+      for row, likeness
+      in self.search_index.search(text, limit)
+    ]
+
+  def _query_subtitles(self, text, limit):
+    """
+    Internal. Runs find_subtitles() against the search backend, bypassing the cache.
+    """
+    if self.search_backend == "memory":
+      return self._search_memory(text, limit)
+    cursor = self.get_cursor()
     cursor.execute(
       """
       SELECT subtitles.season, 
@@ -203,7 +758,7 @@ class SubtitleDatabase(Database):
              subtitles.start_time,
              subtitles.end_time,
              subtitles.subtitle,
-             (1 - (subtitles.subtitle <-> %s)) AS likeness,
+             (1 - (subtitles.subtitle <-> %s)) AS likeness
       FROM subtitles
       WHERE subtitles.subtitle %% %s 
       ORDER BY subtitles.subtitle <-> %s ASC
@@ -211,116 +766,381 @@ class SubtitleDatabase(Database):
       """.format(limit), (text, text, text)
     )
     return cursor.fetchall()
+
+  def _query_subtitles_many(self, texts, limit):
+    """
+    Internal. Runs find_subtitles_many() against the search backend, bypassing the cache.
+    """
+    texts = unique(texts)
+    if self.search_backend == "memory":
+      return dict([(text, self._search_memory(text, limit)) for text in texts])
+    results = dict([(text, []) for text in texts])
+    if not texts:
+      return results
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      SELECT queries.position,
+             found.*
+      FROM unnest(%s::TEXT[]) WITH ORDINALITY AS queries (text, position)
+      CROSS JOIN LATERAL (
+        SELECT subtitles.season, 
+               subtitles.episode, 
+               subtitles.start_index, 
+               subtitles.end_index,
+               subtitles.start_time,
+               subtitles.end_time,
+               subtitles.subtitle,
+               (1 - (subtitles.subtitle <-> queries.text)) AS likeness
+        FROM subtitles
+        WHERE subtitles.subtitle %% queries.text
+        ORDER BY subtitles.subtitle <-> queries.text ASC
+        LIMIT {0}
+      ) AS found
+      ORDER BY queries.position ASC,
+               found.likeness DESC
+      """.format(limit), (texts,)
+    )
+    for row in cursor.fetchall():
+      results[texts[row[0] - 1]].append(tuple(row[1:]))
+    return results
   
+  def get_keyframes(self, path, probe = True, signature = None):
+    """
+    Get the keyframe timestamps of a video file.
+
+    The index is read from the keyframes table, or built with ffprobe and stored there if the
+    file is new or has changed. Indexes are also cached in memory, in keyframe_cache. When
+    there is no stored index and probe is False, that is cached too, for KEYFRAME_MISS_TTL
+    seconds, so it is not looked up again until another process may have built one.
+
+    Parameters
+    ----------
+    path : string
+      The path to the video file.
+    probe : boolean
+      Whether or not to run ffprobe when there is no stored index. Probing reads the
+      whole file, so callers in a hurry should pass False.
+    signature : tuple
+      The file's stat_signature(), if the caller already has it. Saves a stat.
+
+    Returns
+    -------
+    list
+      The keyframe timestamps in milliseconds, in ascending order, or None if the
+      file does not exist, or there is no stored index and probe is False.
+    """
+    if signature is None:
+      try:
+        signature = stat_signature(path)
+      except OSError:
+        return None
+    keyframes = self.keyframe_cache.get((path, signature))
+    if keyframes is not None:
+      return keyframes
+    if not probe and self.keyframe_cache.get(("missing", path, signature)):
+      return None
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      SELECT keyframes
+      FROM keyframes
+      WHERE path = %s
+      AND mtime = %s
+      AND size = %s
+      AND inode = %s
+      """, (path,) + signature
+    )
+    row = cursor.fetchone()
+    if row is not None:
+      keyframes = list(row[0])
+    elif not probe:
+      self.keyframe_cache.put(("missing", path, signature), True, SubtitleDatabase.KEYFRAME_MISS_TTL)
+      return None
+    else:
+      logger.info("Indexing keyframes of {0}.".format(path))
+      keyframes = probe_keyframes(path, SubtitleDatabase.KEYFRAME_PROBE_TIMEOUT)
+      cursor.execute(
+        """
+        INSERT INTO keyframes (
+          path,
+          mtime,
+          size,
+          inode,
+          keyframes
+        ) VALUES (
+          %s,
+          %s,
+          %s,
+          %s,
+          %s::INT[]
+        )
+        ON CONFLICT (path) DO UPDATE
+        SET mtime = EXCLUDED.mtime,
+            size = EXCLUDED.size,
+            inode = EXCLUDED.inode,
+            keyframes = EXCLUDED.keyframes
+        """, (path,) + signature + (keyframes,)
+      )
+      cursor.connection.commit()
+    self.keyframe_cache.put((path, signature), keyframes)
+    return keyframes
+
+  def _build_search_index(self):
+    """
+    Loads every crawled subtitle into an in-memory TrigramIndex, used by the "memory" search backend.
+    """
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      SELECT season,
+             episode,
+             start_index,
+             end_index,
+             start_time,
+             end_time,
+             subtitle
+      FROM subtitles
+      """
+    )
+    self.search_index = TrigramIndex(cursor)
+    logger.info("Built in-memory search index of {0} subtitles.".format(len(self.search_index)))
+
   def _migrate(self):
     """
     Runs the default migration against the database. Checked on instantiation.
     """
-    cursor = self.get_connection().cursor()
+    cursor = self.get_cursor()
     cursor.execute(SubtitleDatabase.SUBTITLE_MIGRATION)
-    self.get_connection().commit()
-    self.get_connection().close()
+    cursor.connection.commit()
+    cursor.connection.close()
 
-  def _crawl_subtitles(self):
+  def _find_subtitle_files(self):
     """
-    Crawl through the directory for subtitles and update the database accordingly. Called on instantiation.
+    Walks the configured directory for .srt files.
+
+    Returns
+    -------
+    generator
+      Tuples of (subtitle_path, season_number, episode_number).
     """
-    cursor = self.get_connection().cursor()
     for season in os.listdir(self.directory):
       if season.lower().startswith("s") and os.path.isdir(os.path.join(self.directory, season)):
         season_directory = os.path.join(self.directory, season)
         try:
           season_number = int(re.sub(r"\D", "", season))
-          for filename in os.listdir(season_directory):
-            if filename.endswith(".srt") and filename.lower().startswith("e"):
-              subtitle_path = os.path.join(season_directory, filename)
-              try:
-                md5 = md5sum(subtitle_path)
-                episode_number = int(re.sub(r"\D", "", filename))
-                cursor.execute("SELECT md5sum FROM srt WHERE path = %s", (subtitle_path,))
-                row = cursor.fetchone()
-                if not row or row[0] != md5:
-                  logger.info("New or changed subtitle file '{0}' found (season {1}, episode {2}), crawling.".format(
-                    subtitle_path,
-                    season_number,
-                    episode_number
-                  ))
-                  cursor.execute(
-                    """
-                    DELETE FROM subtitles 
-                    WHERE season = %s 
-                    AND episode = %s
-                    """, (season_number, episode_number)
-                  )
-                  cursor.execute(
-                    """
-                    DELETE FROM srt 
-                    WHERE path = %s
-                    """, (subtitle_path,)
-                  )
-                  self.get_connection().commit()
-                  subtitles = Subtitles(subtitle_path)
-                  for j in range(self.concatenation_depth):
-                    for i in range(len(subtitles.subtitles) - j):
-                      start_subtitle = subtitles.subtitles[i]
-                      end_subtitle = subtitles.subtitles[i+j]
-                      text = "\n".join([
-                        subtitle.text 
-                        for subtitle 
-                        in subtitles.subtitles[i:i+j+1]
-                      ])
-                      cursor.execute(
-                        """
-                        INSERT INTO subtitles (
-                          season, 
-                          episode, 
-                          start_index, 
-                          end_index,
-                          start_time, 
-                          end_time, 
-                          subtitle
-                        ) VALUES (
-                          %s, 
-                          %s, 
-                          %s, 
-                          %s, 
-                          %s, 
-                          %s,
-                          E%s
-                        )""", (
-                          season_number, 
-                          episode_number, 
-                          i, 
-                          i + j,
-                          start_subtitle.start.total_seconds(),
-                          end_subtitle.end.total_seconds(),
-                          text
-                        )
-                      )
-                  cursor.execute(
-                    """
-                    INSERT INTO srt (
-                      path, 
-                      md5sum
-                    ) VALUES (
-                      %s, 
-                      %s
-                    )""", (subtitle_path, md5)
-                  )
-                  self.get_connection().commit()
-              except Exception as ex:
-                logger.error("Could not parse SRT file at path '{0}', reason: {1}(): {2}".format(
-                  subtitle_path,
-                  type(ex).__name__,
-                  str(ex)  
-                ))
-                logger.error(traceback.format_exc(ex))
-                cursor = self.get_connection().cursor()
-                continue
         except Exception as ex:
           logger.error("Could not find season number in directory '{0}', continuing.".format(season_directory))
-          cursor = self.get_connection().cursor()
           continue
+        for filename in os.listdir(season_directory):
+          if filename.endswith(".srt") and filename.lower().startswith("e"):
+            subtitle_path = os.path.join(season_directory, filename)
+            try:
+              episode_number = int(re.sub(r"\D", "", filename))
+            except Exception as ex:
+              logger.error("Could not find episode number in SRT file at path '{0}', continuing.".format(subtitle_path))
+              continue
+            yield subtitle_path, season_number, episode_number
+
+  def _crawl_subtitles(self):
+    """
+    Crawl through the directory for subtitles and update the database accordingly. Called on instantiation.
+
+    Files whose (mtime, size, inode) signature matches the one recorded in the srt table are skipped
+    without being opened. Only the remaining files are hashed, and only those whose md5sum changed
+    are parsed.
+
+    When more than one crawl worker is configured, hashing and parsing each episode is done in a
+    process pool, while all results are written through this process' connection.
+    """
+    cursor = self.get_cursor()
+    cursor.execute("SELECT path, md5sum, mtime, size, inode FROM srt")
+    manifest = dict([(row[0], (row[1], tuple(row[2:]))) for row in cursor.fetchall()])
+    tasks = []
+    for subtitle_path, season_number, episode_number in self._find_subtitle_files():
+      signature = stat_signature(subtitle_path)
+      known_md5, known_signature = manifest.get(subtitle_path, (None, None))
+      if known_signature == signature:
+        continue
+      tasks.append((subtitle_path, season_number, episode_number, known_md5, self.concatenation_depth, signature))
+    if self.crawl_workers > 1 and len(tasks) > 1:
+      pool = multiprocessing.Pool(min(self.crawl_workers, len(tasks)))
+      try:
+        for result in pool.imap_unordered(crawl_episode, tasks):
+          cursor = self._store_crawled_episode(cursor, *result)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for task in tasks:
+        cursor = self._store_crawled_episode(cursor, *crawl_episode(task))
+
+  def _store_crawled_episode(self, cursor, subtitle_path, season_number, episode_number, md5, signature, rows, error):
+    """
+    Writes the result of crawl_episode() to the database.
+
+    Returns
+    -------
+    psycopg2.cursor
+      The cursor to continue with. A new one is created after an error.
+    """
+    try:
+      if error is not None:
+        raise IOError(error)
+      if rows is None:
+        cursor.execute(
+          """
+          UPDATE srt
+          SET mtime = %s,
+              size = %s,
+              inode = %s
+          WHERE path = %s
+          """, signature + (subtitle_path,)
+        )
+        cursor.connection.commit()
+        return cursor
+      logger.info("New or changed subtitle file '{0}' found (season {1}, episode {2}), crawling.".format(
+        subtitle_path,
+        season_number,
+        episode_number
+      ))
+      self._store_episode(cursor, subtitle_path, md5, signature, season_number, episode_number, rows)
+    except Exception as ex:
+      logger.error("Could not parse SRT file at path '{0}', reason: {1}(): {2}".format(
+        subtitle_path,
+        type(ex).__name__,
+        str(ex)  
+      ))
+      logger.error(traceback.format_exc())
+      try:
+        self.get_connection().rollback()
+      except:
+        pass
+      cursor = self.get_cursor()
+    return cursor
+
+  def _store_episode(self, cursor, subtitle_path, md5, signature, season_number, episode_number, rows):
+    """
+    Replaces all subtitles of an episode with the supplied rows, and records the .srt file's md5sum.
+
+    Everything is done in a single transaction, so a failure part way through an episode
+    will never leave it half-populated.
+
+    Parameters
+    ----------
+    cursor : psycopg2.cursor
+      The cursor to execute against.
+    subtitle_path : string
+      The path to the .srt file.
+    md5 : string
+      The md5sum of the .srt file.
+    signature : tuple
+      The (mtime, size, inode) of the .srt file, as returned by stat_signature().
+    season_number : int
+      The season of the episode.
+    episode_number : int
+      The episode number.
+    rows : iterable
+      The rows to insert, as generated by subtitle_rows().
+    """
+    cursor.execute(
+      """
+      DELETE FROM subtitles 
+      WHERE season = %s 
+      AND episode = %s
+      """, (season_number, episode_number)
+    )
+    cursor.execute(
+      """
+      DELETE FROM srt 
+      WHERE path = %s
+      """, (subtitle_path,)
+    )
+    self._insert_subtitles(cursor, rows)
+    cursor.execute(
+      """
+      INSERT INTO srt (
+        path, 
+        md5sum,
+        mtime,
+        size,
+        inode
+      ) VALUES (
+        %s, 
+        %s,
+        %s,
+        %s,
+        %s
+      )""", (subtitle_path, md5) + signature
+    )
+    cursor.connection.commit()
+    self.invalidate_search_cache()
+
+  def _insert_subtitles(self, cursor, rows):
+    """
+    Inserts subtitle rows using the configured insert method.
+
+    "copy" streams the rows through COPY FROM STDIN, "batch" uses multi-row INSERT statements
+    of INSERT_BATCH_SIZE rows, and "row" issues one INSERT per row.
+
+    Parameters
+    ----------
+    cursor : psycopg2.cursor
+      The cursor to execute against.
+    rows : iterable
+      The rows to insert, as generated by subtitle_rows().
+    """
+    if self.insert_method == "copy":
+      cursor.copy_expert(
+        """
+        COPY subtitles (
+          season,
+          episode,
+          start_index,
+          end_index,
+          start_time,
+          end_time,
+          subtitle
+        ) FROM STDIN
+        """, CopyStream(rows)
+      )
+    elif self.insert_method == "batch":
+      psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO subtitles (
+          season, 
+          episode, 
+          start_index, 
+          end_index,
+          start_time, 
+          end_time, 
+          subtitle
+        ) VALUES %s
+        """, rows, page_size = SubtitleDatabase.INSERT_BATCH_SIZE
+      )
+    else:
+      for row in rows:
+        cursor.execute(
+          """
+          INSERT INTO subtitles (
+            season, 
+            episode, 
+            start_index, 
+            end_index,
+            start_time, 
+            end_time, 
+            subtitle
+          ) VALUES (
+            %s, 
+            %s, 
+            %s, 
+            %s, 
+            %s, 
+            %s,
+            E%s
+          )""", row
+        )
 
 class DunderDatabase(SubtitleDatabase):
   """
@@ -328,7 +1148,31 @@ class DunderDatabase(SubtitleDatabase):
 
   Parameters are the same as above, but also creates tables for tracking users and comments,
   as well as a generic key-value store.
+
+  Comment counts and scores per line are kept in the subtitle_stats table, which a trigger
+  on the comments table maintains, so searches never need to aggregate comments.
+
+  Comment score updates made through buffer_comment() are written behind, in batches.
+
+  Rendered GIFs are recorded in the renders table, keyed by their line range and the hash of
+  the settings they were rendered with, so a line is only rendered and uploaded once.
+
+  Rows of the users table are cached in user_cache, and key/value pairs in key_cache, which
+  both report their hits and misses.
+  Writes in this process update the cache immediately. Ignoring a user also invalidates the
+  user cache of every process forked from the one that created this database (such as the
+  forked crawlers), as invalidate_search_cache() does for searches, so an ignored user is never
+  replied to again. Other writes made by other processes are seen once the entry expires after
+  USER_CACHE_TTL (or KV_CACHE_TTL) seconds. Expired key/value pairs are swept every
+  KV_SWEEP_INTERVAL seconds by a background thread.
   """
+  COMMENT_BUFFER_SIZE = 250
+  COMMENT_BUFFER_INTERVAL = 60
+  USER_CACHE_SIZE = 10000
+  USER_CACHE_TTL = 300
+  KV_CACHE_SIZE = 1000
+  KV_CACHE_TTL = 300
+  KV_SWEEP_INTERVAL = 60 * 60
 
   DUNDER_MIGRATION = """
   BEGIN;
@@ -356,25 +1200,134 @@ class DunderDatabase(SubtitleDatabase):
     key VARCHAR NOT NULL,
     value VARCHAR NOT NULL,
     mod_time TIMESTAMP DEFAULT NOW(),
-    exp_time TIMESTAMP DEFAULT NOW(),
+    exp_time TIMESTAMP,
     PRIMARY KEY (key)
   );
 
+  ALTER TABLE kv_store ALTER COLUMN exp_time DROP DEFAULT;
+
   CREATE TABLE IF NOT EXISTS episodes (
     season SMALLINT NOT NULL,
     episode SMALLINT NOT NULL,
     title VARCHAR NOT NULL,
     PRIMARY KEY (season, episode)
   );
+
+  CREATE TABLE IF NOT EXISTS subtitle_stats (
+    season SMALLINT NOT NULL,
+    episode SMALLINT NOT NULL,
+    start_index INT NOT NULL,
+    end_index INT NOT NULL,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    score_total BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (season, episode, start_index, end_index)
+  );
+
+  CREATE OR REPLACE FUNCTION update_subtitle_stats() RETURNS TRIGGER AS $$
+  BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      UPDATE subtitle_stats
+      SET comment_count = comment_count - 1,
+          score_total = score_total - OLD.score
+      WHERE season = OLD.season
+      AND episode = OLD.episode
+      AND start_index = OLD.start_index
+      AND end_index = OLD.end_index;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+      INSERT INTO subtitle_stats (
+        season,
+        episode,
+        start_index,
+        end_index,
+        comment_count,
+        score_total
+      ) VALUES (
+        NEW.season,
+        NEW.episode,
+        NEW.start_index,
+        NEW.end_index,
+        1,
+        NEW.score
+      )
+      ON CONFLICT (season, episode, start_index, end_index) DO UPDATE
+      SET comment_count = subtitle_stats.comment_count + 1,
+          score_total = subtitle_stats.score_total + EXCLUDED.score_total;
+    END IF;
+    RETURN NULL;
+  END;
+  $$ LANGUAGE plpgsql;
+
+  DROP TRIGGER IF EXISTS comments_subtitle_stats ON comments;
+
+  DELETE FROM subtitle_stats;
+
+  INSERT INTO subtitle_stats (
+    season,
+    episode,
+    start_index,
+    end_index,
+    comment_count,
+    score_total
+  )
+  SELECT season,
+         episode,
+         start_index,
+         end_index,
+         COUNT(*),
+         SUM(score)
+  FROM comments
+  GROUP BY season,
+           episode,
+           start_index,
+           end_index;
+
+  CREATE TRIGGER comments_subtitle_stats
+  AFTER INSERT OR UPDATE OR DELETE ON comments
+  FOR EACH ROW EXECUTE PROCEDURE update_subtitle_stats();
+
+  CREATE TABLE IF NOT EXISTS renders (
+    season SMALLINT NOT NULL,
+    episode SMALLINT NOT NULL,
+    start_index INT NOT NULL,
+    end_index INT NOT NULL,
+    settings_hash VARCHAR NOT NULL,
+    digest VARCHAR,
+    link VARCHAR,
+    mod_time TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (season, episode, start_index, end_index, settings_hash)
+  );
   
   CREATE INDEX IF NOT EXISTS trigram_index ON subtitles USING GIST (subtitle gist_trgm_ops);
 
   COMMIT;
   """
   
-  def __init__(self, host, port, database_name, username, password, directory, concatenation_depth = 2):
-    super(DunderDatabase, self).__init__(host, port, database_name, username, password, directory, concatenation_depth)
+  def __init__(self, host, port, database_name, username, password, directory, concatenation_depth = 2, insert_method = "copy", crawl_workers = 1, search_backend = "postgres", pool_size = 0):
+    self.user_cache = LRUCache(DunderDatabase.USER_CACHE_SIZE, DunderDatabase.USER_CACHE_TTL)
+    self.user_generation = multiprocessing.Value("i", 0)
+    self.key_cache = LRUCache(DunderDatabase.KV_CACHE_SIZE, DunderDatabase.KV_CACHE_TTL)
+    self._last_key_sweep = 0
+    super(DunderDatabase, self).__init__(host, port, database_name, username, password, directory, concatenation_depth, insert_method, crawl_workers, search_backend, pool_size)
     self._crawl_titles()
+    self.comment_buffer = WriteBehindBuffer(
+      self._write_comments,
+      DunderDatabase.COMMENT_BUFFER_SIZE,
+      DunderDatabase.COMMENT_BUFFER_INTERVAL,
+      self._sweep_keys_if_due
+    )
+    self.comment_buffer.start()
+
+  def __exit__(self, *args):
+    try:
+      if self._pid == os.getpid():
+        self.flush_comments()
+    except Exception as ex:
+      logger.error("Could not flush buffered comments on exit.\n{0}(): {1}".format(
+        type(ex).__name__,
+        str(ex)
+      ))
+    super(DunderDatabase, self).__exit__(*args)
   
   def find_subtitles(self, text, limit = 10):
     """
@@ -417,7 +1370,21 @@ class DunderDatabase(SubtitleDatabase):
         The episode title, if found.
     
     """
-    cursor = self.get_connection().cursor()
+    return super(DunderDatabase, self).find_subtitles(text, limit)
+
+  def _query_subtitles(self, text, limit):
+    """
+    Internal. Runs find_subtitles() against the search backend, bypassing the cache.
+    """
+    if self.search_backend == "memory":
+      found_subtitles = super(DunderDatabase, self)._query_subtitles(text, limit)
+      details = self._subtitle_details([found_subtitle[:4] for found_subtitle in found_subtitles])
+      return [
+        found_subtitle + details.get(tuple(found_subtitle[:4]), (0, None, None))
+        for found_subtitle
+        in found_subtitles
+      ]
+    cursor = self.get_cursor()
     cursor.execute(
       """
       SELECT subtitles.season, 
@@ -428,33 +1395,128 @@ class DunderDatabase(SubtitleDatabase):
              subtitles.end_time,
              subtitles.subtitle,
              (1 - (subtitles.subtitle <-> %s)) AS likeness,
-             COUNT(comments.comment_id) AS comment_count,
-             AVG(comments.score) AS comment_score,
+             COALESCE(subtitle_stats.comment_count, 0) AS comment_count,
+             subtitle_stats.score_total::NUMERIC / NULLIF(subtitle_stats.comment_count, 0) AS comment_score,
              episodes.title
       FROM subtitles
-      LEFT OUTER JOIN comments
-      ON comments.season = subtitles.season
-      AND comments.episode = subtitles.episode
-      AND comments.start_index = subtitles.start_index
-      AND comments.end_index = subtitles.end_index
+      LEFT OUTER JOIN subtitle_stats
+      ON subtitle_stats.season = subtitles.season
+      AND subtitle_stats.episode = subtitles.episode
+      AND subtitle_stats.start_index = subtitles.start_index
+      AND subtitle_stats.end_index = subtitles.end_index
       LEFT OUTER JOIN episodes
       ON episodes.season = subtitles.season
       AND episodes.episode = subtitles.episode
       WHERE subtitles.subtitle %% %s 
-      GROUP BY subtitles.season, 
-               subtitles.episode, 
-               subtitles.start_index, 
-               subtitles.end_index, 
-               subtitles.start_time, 
-               subtitles.end_time, 
-               subtitles.subtitle,
-               episodes.title
       ORDER BY subtitles.subtitle <-> %s ASC
       LIMIT {0}
       """.format(limit), (text, text, text)
     )
     return cursor.fetchall()
 
+  def _query_subtitles_many(self, texts, limit):
+    """
+    Internal. Runs find_subtitles_many() against the search backend, bypassing the cache.
+    """
+    texts = unique(texts)
+    if self.search_backend == "memory":
+      results = super(DunderDatabase, self)._query_subtitles_many(texts, limit)
+      details = self._subtitle_details(unique([
+        tuple(found_subtitle[:4])
+        for found_subtitles in results.values()
+        for found_subtitle in found_subtitles
+      ]))
+      return dict([
+        (text, [
+          found_subtitle + details.get(tuple(found_subtitle[:4]), (0, None, None))
+          for found_subtitle
+          in found_subtitles
+        ])
+        for text, found_subtitles
+        in six.iteritems(results)
+      ])
+    results = dict([(text, []) for text in texts])
+    if not texts:
+      return results
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      SELECT queries.position,
+             found.*
+      FROM unnest(%s::TEXT[]) WITH ORDINALITY AS queries (text, position)
+      CROSS JOIN LATERAL (
+        SELECT subtitles.season, 
+               subtitles.episode, 
+               subtitles.start_index, 
+               subtitles.end_index,
+               subtitles.start_time,
+               subtitles.end_time,
+               subtitles.subtitle,
+               (1 - (subtitles.subtitle <-> queries.text)) AS likeness,
+               COALESCE(subtitle_stats.comment_count, 0) AS comment_count,
+               subtitle_stats.score_total::NUMERIC / NULLIF(subtitle_stats.comment_count, 0) AS comment_score,
+               episodes.title
+        FROM subtitles
+        LEFT OUTER JOIN subtitle_stats
+        ON subtitle_stats.season = subtitles.season
+        AND subtitle_stats.episode = subtitles.episode
+        AND subtitle_stats.start_index = subtitles.start_index
+        AND subtitle_stats.end_index = subtitles.end_index
+        LEFT OUTER JOIN episodes
+        ON episodes.season = subtitles.season
+        AND episodes.episode = subtitles.episode
+        WHERE subtitles.subtitle %% queries.text
+        ORDER BY subtitles.subtitle <-> queries.text ASC
+        LIMIT {0}
+      ) AS found
+      ORDER BY queries.position ASC,
+               found.likeness DESC
+      """.format(limit), (texts,)
+    )
+    for row in cursor.fetchall():
+      results[texts[row[0] - 1]].append(tuple(row[1:]))
+    return results
+
+  def _subtitle_details(self, keys):
+    """
+    Looks up comment statistics and episode titles for subtitles found in memory.
+
+    Parameters
+    ----------
+    keys : list
+      (season, episode, start_index, end_index) tuples.
+
+    Returns
+    -------
+    dict
+      (season, episode, start_index, end_index) => (comment_count, comment_score, title)
+    """
+    if not keys:
+      return {}
+    cursor = self.get_cursor()
+    rows = psycopg2.extras.execute_values(
+      cursor,
+      """
+      SELECT keys.season,
+             keys.episode,
+             keys.start_index,
+             keys.end_index,
+             COALESCE(subtitle_stats.comment_count, 0) AS comment_count,
+             subtitle_stats.score_total::NUMERIC / NULLIF(subtitle_stats.comment_count, 0) AS comment_score,
+             episodes.title
+      FROM (VALUES %s) AS keys (season, episode, start_index, end_index)
+      LEFT OUTER JOIN subtitle_stats
+      ON subtitle_stats.season = keys.season
+      AND subtitle_stats.episode = keys.episode
+      AND subtitle_stats.start_index = keys.start_index
+      AND subtitle_stats.end_index = keys.end_index
+      LEFT OUTER JOIN episodes
+      ON episodes.season = keys.season
+      AND episodes.episode = keys.episode
+      """, keys, fetch = True
+    )
+    return dict([(tuple(row[:4]), tuple(row[4:])) for row in rows])
+
   def get_user_ignored(self, username):
     """
     Get whether or not a user has requested to be ignored.
@@ -469,18 +1531,7 @@ class DunderDatabase(SubtitleDatabase):
     boolean
       Whether or not the user has requested to be ignored.      
     """
-    cursor = self.get_connection().cursor()
-    cursor.execute(
-      """
-      SELECT ignore
-      FROM users
-      WHERE username = %s
-      """, (username,)
-    )
-    row = cursor.fetchone()
-    if not row:
-      return False
-    return row[0]
+    return self._get_user(username)[0]
   
   def get_user_uses(self, username):
     """
@@ -496,18 +1547,34 @@ class DunderDatabase(SubtitleDatabase):
     int
       How many times the user has used the service.
     """
-    cursor = self.get_connection().cursor()
-    cursor.execute(
-      """
-      SELECT uses
-      FROM users
-      WHERE username = %s
-      """, (username,)
-    )
-    row = cursor.fetchone()
-    if not row:
-      return 0
-    return row[0]
+    return self._get_user(username)[1]
+
+  def _get_user(self, username):
+    """
+    Internal. Reads a user through the user cache.
+
+    Returns
+    -------
+    tuple
+      ignore : boolean
+      uses : int
+    """
+    key = (username, self.user_generation.value)
+    user = self.user_cache.get(key)
+    if user is None:
+      cursor = self.get_cursor()
+      cursor.execute(
+        """
+        SELECT ignore,
+               uses
+        FROM users
+        WHERE username = %s
+        """, (username,)
+      )
+      row = cursor.fetchone()
+      user = tuple(row) if row else (False, 0)
+      self.user_cache.put(key, user)
+    return user
 
   def ignore_user(self, username):
     """
@@ -518,33 +1585,30 @@ class DunderDatabase(SubtitleDatabase):
     username : string
       The username of the requested user.
     """
-    cursor = self.get_connection().cursor()
+    cursor = self.get_cursor()
     cursor.execute(
       """
-      SELECT EXISTS (
-        SELECT 1
-        FROM users
-        WHERE username = %s
-      )
+      INSERT INTO users (username, ignore)
+      VALUES (%s, TRUE)
+      ON CONFLICT (username) DO UPDATE
+      SET ignore = TRUE
+      RETURNING ignore,
+                uses
       """, (username,)
     )
-    if cursor.fetchone()[0]:
-      cursor.execute(
-        """
-        UPDATE users
-        SET ignore = TRUE
-        WHERE username = %s
-        """, (username,)
-      )
-      self.get_connection().commit()
-    else:
-      cursor.execute(
-        """
-        INSERT INTO users (username, ignore)
-        VALUES (%s, TRUE)
-        """, (username,)
-      )
-      self.get_connection().commit()
+    user = tuple(cursor.fetchone())
+    cursor.connection.commit()
+    self.invalidate_user_cache()
+    self.user_cache.put((username, self.user_generation.value), user)
+
+  def invalidate_user_cache(self):
+    """
+    Invalidates every cached user, in this process and all processes forked from the one that
+    created this database. Called whenever a user is ignored.
+    """
+    with self.user_generation.get_lock():
+      self.user_generation.value += 1
+    self.user_cache.clear()
 
   def increment_user_uses(self, username):
     """
@@ -554,39 +1618,35 @@ class DunderDatabase(SubtitleDatabase):
     ----------
     username : string
       The username of the requested user.
+
+    Returns
+    -------
+    int
+      How many times the user has used the service, including this use.
     """
-    cursor = self.get_connection().cursor()
+    cursor = self.get_cursor()
     cursor.execute(
       """
-      SELECT EXISTS (
-        SELECT 1
-        FROM users
-        WHERE username = %s
-      )
+      INSERT INTO users (username)
+      VALUES (%s)
+      ON CONFLICT (username) DO UPDATE
+      SET uses = users.uses + 1
+      RETURNING ignore,
+                uses
       """, (username,)
     )
-    if cursor.fetchone()[0]:
-      cursor.execute(
-        """
-        UPDATE users
-        SET uses = uses + 1
-        WHERE username = %s
-        """, (username,)
-      )
-      self.get_connection().commit()
-    else:
-      cursor.execute(
-        """
-        INSERT INTO users (username)
-        VALUES (%s)
-        """, (username,)
-      )
-      self.get_connection().commit()
+    user = tuple(cursor.fetchone())
+    cursor.connection.commit()
+    self.user_cache.put((username, self.user_generation.value), user)
+    return user[1]
 
   def get_key(self, key):
     """
     Get the value from the key/value store.
 
+    Expired keys are treated as missing. Values are cached in memory for up to KV_CACHE_TTL
+    seconds, and never past their expiration time.
+
     Parameters
     ----------
     key : string
@@ -602,20 +1662,51 @@ class DunderDatabase(SubtitleDatabase):
       mod_time : datetime.datetime
         The last time this value was modified. Can be None.
     """
-    cursor = self.get_connection().cursor()
-    cursor.execute(
-      """
-      SELECT value,
-             exp_time,
-             mod_time
-      FROM kv_store
-      WHERE key = %s
-      """, (key,)
-    )
-    row = cursor.fetchone()
-    if not row:
-      return [None, None, None]
-    return row
+    return self.get_many([key])[key]
+
+  def get_many(self, keys):
+    """
+    Get several values from the key/value store, querying the database at most once.
+
+    Parameters
+    ----------
+    keys : list<string>
+      The keys to search against.
+
+    Returns
+    -------
+    dict
+      key => list, where each list is the same as would be returned by get_key(key).
+    """
+    results = {}
+    missing = []
+    for key in unique(keys):
+      cached = self.key_cache.get(key)
+      if cached is None:
+        missing.append(key)
+      else:
+        results[key] = list(cached)
+    if missing:
+      cursor = self.get_cursor()
+      cursor.execute(
+        """
+        SELECT key,
+               value,
+               exp_time,
+               mod_time,
+               EXTRACT(EPOCH FROM exp_time - NOW())
+        FROM kv_store
+        WHERE key = ANY(%s)
+        AND (exp_time IS NULL OR exp_time > NOW())
+        """, (missing,)
+      )
+      for row in cursor.fetchall():
+        results[row[0]] = self._cache_key_row(row)
+      for key in missing:
+        if key not in results:
+          results[key] = [None, None, None]
+          self.key_cache.put(key, (None, None, None))
+    return results
 
   def upsert_key(self, key, value, exp_time = None):
     """
@@ -628,46 +1719,269 @@ class DunderDatabase(SubtitleDatabase):
     value : string
       An unbounded value - what to store.
     exp_time : datetime.datetime:
-      The time to expire this key. Purely for informational purposes, does not
-      influence the store itself. Can be None.
+      The time to expire this key, in the database's time zone. Once passed, the key is
+      no longer returned and will be deleted by the next sweep. Can be None, to never expire.
     """
-    cursor = self.get_connection().cursor()
-    cursor.execute(
+    self.set_many({key: value}, exp_time)
+
+  def set_many(self, values, exp_time = None):
+    """
+    Set several key/value pairs in the key/value store, in one statement.
+
+    Parameters
+    ----------
+    values : dict
+      key => value pairs to store.
+    exp_time : datetime.datetime:
+      The time to expire these keys, as in upsert_key(). Can be None.
+    """
+    if not values:
+      return
+    cursor = self.get_cursor()
+    rows = psycopg2.extras.execute_values(
+      cursor,
       """
-      SELECT EXISTS (
-        SELECT 1 
-        FROM kv_store
-        WHERE key = %s
-      )
-      """, (key,)
+      INSERT INTO kv_store (
+        key,
+        value,
+        exp_time
+      ) VALUES %s
+      ON CONFLICT (key) DO UPDATE
+      SET value = EXCLUDED.value,
+          mod_time = NOW(),
+          exp_time = EXCLUDED.exp_time
+      RETURNING key,
+                value,
+                exp_time,
+                mod_time,
+                EXTRACT(EPOCH FROM exp_time - NOW())
+      """, [
+        (key, value, exp_time)
+        for key, value
+        in six.iteritems(values)
+      ], fetch = True
     )
-    if cursor.fetchone()[0]:
+    cursor.connection.commit()
+    for row in rows:
+      self._cache_key_row(row)
+
+  def sweep_keys(self):
+    """
+    Deletes every expired key from the key/value store.
+
+    Called every KV_SWEEP_INTERVAL seconds from the comment buffer's background thread, so it
+    runs on the background connection.
+
+    Returns
+    -------
+    int
+      The number of keys deleted.
+    """
+    self._last_key_sweep = time.time()
+    with self.background_lock:
+      cursor = self.get_background_cursor()
       cursor.execute(
         """
-        UPDATE kv_store
-        SET value = %s,
-            mod_time = NOW(),
-            exp_time = %s
-        WHERE key = %s
-        """, (value, exp_time, key)
-      )
-      self.get_connection().commit()
-    else:
-      cursor.execute(
+        DELETE FROM kv_store
+        WHERE exp_time <= NOW()
+        RETURNING key
         """
-        INSERT INTO kv_store (
-          key,
-          value,
-          exp_time
-        ) VALUES (
-          %s, 
-          %s, 
-          %s
-        )
-        """, (key, value, exp_time)
       )
-      self.get_connection().commit()
+      keys = [row[0] for row in cursor.fetchall()]
+      cursor.connection.commit()
+    for key in keys:
+      self.key_cache.invalidate(key)
+    if keys:
+      logger.debug("Swept {0} expired key(s) from the key/value store.".format(len(keys)))
+    return len(keys)
+
+  def _sweep_keys_if_due(self):
+    """
+    Internal. Runs sweep_keys() if KV_SWEEP_INTERVAL seconds have passed since the last sweep.
+    """
+    if time.time() - self._last_key_sweep >= DunderDatabase.KV_SWEEP_INTERVAL:
+      self.sweep_keys()
+
+  def _cache_key_row(self, row):
+    """
+    Internal. Caches a (key, value, exp_time, mod_time, seconds_remaining) row until it expires.
+
+    Returns
+    -------
+    list
+      [value, exp_time, mod_time]
+    """
+    key, value, exp_time, mod_time, seconds_remaining = row
+    ttl = DunderDatabase.KV_CACHE_TTL
+    if seconds_remaining is not None:
+      ttl = max(0, min(ttl, float(seconds_remaining)))
+    self.key_cache.put(key, (value, exp_time, mod_time), ttl)
+    return [value, exp_time, mod_time]
   
+  def get_render(self, season, episode, start_index, end_index, settings_hash):
+    """
+    Get a previously rendered GIF of a line range.
+
+    Parameters
+    ----------
+    season : int
+      The season of the line range.
+    episode : int
+      The episode of the line range.
+    start_index : int
+      The starting line index.
+    end_index : int
+      The ending line index.
+    settings_hash : string
+      The hash of the settings the GIF was rendered with.
+
+    Returns
+    -------
+    tuple
+      digest : string
+        The digest of the GIF in the GIF store, or None.
+      link : string
+        The uploaded link of the GIF, or None.
+      Or None, if this line range has never been rendered with these settings.
+    """
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      SELECT digest,
+             link
+      FROM renders
+      WHERE season = %s
+      AND episode = %s
+      AND start_index = %s
+      AND end_index = %s
+      AND settings_hash = %s
+      """, (season, episode, start_index, end_index, settings_hash)
+    )
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+  def upsert_render(self, season, episode, start_index, end_index, settings_hash, digest = None, link = None):
+    """
+    Record a rendered GIF of a line range. Values that are not passed are left as they were.
+
+    Parameters
+    ----------
+    season : int
+      The season of the line range.
+    episode : int
+      The episode of the line range.
+    start_index : int
+      The starting line index.
+    end_index : int
+      The ending line index.
+    settings_hash : string
+      The hash of the settings the GIF was rendered with.
+    digest : string
+      The digest of the GIF in the GIF store.
+    link : string
+      The uploaded link of the GIF.
+    """
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      INSERT INTO renders (
+        season,
+        episode,
+        start_index,
+        end_index,
+        settings_hash,
+        digest,
+        link
+      ) VALUES (
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s
+      )
+      ON CONFLICT (season, episode, start_index, end_index, settings_hash) DO UPDATE
+      SET digest = COALESCE(EXCLUDED.digest, renders.digest),
+          link = COALESCE(EXCLUDED.link, renders.link),
+          mod_time = NOW()
+      """, (season, episode, start_index, end_index, settings_hash, digest, link)
+    )
+    cursor.connection.commit()
+
+  def get_popular_subtitles(self, limit, settings_hash):
+    """
+    Get the most popular line ranges that have not been uploaded with a set of render settings.
+
+    Line ranges are ranked by how many comments quoted them, then by their average score.
+    The top ranges are taken first, then those already uploaded are left out, so this
+    returns nothing once all of the top ranges are uploaded.
+
+    Parameters
+    ----------
+    limit : int
+      How many of the top line ranges to consider.
+    settings_hash : string
+      The hash of the render settings to check for uploads with.
+
+    Returns
+    -------
+    list
+      A list of tuples, most popular first:
+        season : int
+        episode : int
+        start_index : int
+        end_index : int
+        start_time : float
+        end_time : float
+        subtitle : string
+    """
+    cursor = self.get_cursor()
+    cursor.execute(
+      """
+      WITH popular AS (
+        SELECT season,
+               episode,
+               start_index,
+               end_index,
+               comment_count,
+               score_total::NUMERIC / comment_count AS comment_score
+        FROM subtitle_stats
+        WHERE comment_count > 0
+        ORDER BY comment_count DESC,
+                 comment_score DESC
+        LIMIT %s
+      )
+      SELECT popular.season,
+             popular.episode,
+             popular.start_index,
+             popular.end_index,
+             subtitles.start_time,
+             subtitles.end_time,
+             subtitles.subtitle
+      FROM popular
+      INNER JOIN subtitles
+      ON subtitles.season = popular.season
+      AND subtitles.episode = popular.episode
+      AND subtitles.start_index = popular.start_index
+      AND subtitles.end_index = popular.end_index
+      LEFT OUTER JOIN renders
+      ON renders.season = popular.season
+      AND renders.episode = popular.episode
+      AND renders.start_index = popular.start_index
+      AND renders.end_index = popular.end_index
+      AND renders.settings_hash = %s
+      WHERE renders.link IS NULL
+      ORDER BY popular.comment_count DESC,
+               popular.comment_score DESC
+      """, (limit, settings_hash)
+    )
+    return [
+      (season, episode, start_index, end_index, float(start_time), float(end_time), subtitle)
+      for season, episode, start_index, end_index, start_time, end_time, subtitle
+      in cursor.fetchall()
+    ]
+
   def upsert_comment(self, comment_id, score, season, episode, start_index, end_index):
     """
     Insert or update a comment into the comment database.
@@ -687,27 +2001,64 @@ class DunderDatabase(SubtitleDatabase):
     end_index : int
       The ending line index of the responded image / comment.
     """
-    cursor = self.get_connection().cursor()
+    cursor = self.get_cursor()
     cursor.execute(
       """
-      SELECT EXISTS (
-        SELECT 1 
-        FROM comments 
-        WHERE comment_id = %s
+      INSERT INTO comments (
+        comment_id,
+        season,
+        episode,
+        start_index,
+        end_index,
+        score
+      ) VALUES (
+        %s, 
+        %s, 
+        %s, 
+        %s, 
+        %s,
+        %s
       )
-      """, (comment_id,)
+      ON CONFLICT (comment_id) DO UPDATE
+      SET score = EXCLUDED.score
+      """, (comment_id, season, episode, start_index, end_index, score)
     )
-    if cursor.fetchone()[0]:
-      cursor.execute(
-        """
-        UPDATE comments
-        SET score = %s
-        WHERE comment_id = %s
-        """, (score, comment_id)
-      )
-      self.get_connection().commit()
-    else:
-      cursor.execute(
+    cursor.connection.commit()
+    self.invalidate_search_cache()
+
+  def buffer_comment(self, comment_id, score, season, episode, start_index, end_index):
+    """
+    Insert or update a comment into the comment database, without waiting for it to be written.
+
+    Updates to the same comment are coalesced, and all buffered comments are written in a
+    single transaction every COMMENT_BUFFER_INTERVAL seconds, once COMMENT_BUFFER_SIZE comments
+    are buffered, or on flush_comments().
+
+    Parameters are the same as upsert_comment().
+    """
+    self.comment_buffer.put(comment_id, (comment_id, season, episode, start_index, end_index, score))
+
+  def flush_comments(self):
+    """
+    Writes all comments buffered by buffer_comment().
+
+    Returns
+    -------
+    int
+      The number of comments written.
+    """
+    return self.comment_buffer.flush()
+
+  def _write_comments(self, rows):
+    """
+    Internal. Upserts many comments in one transaction. Unchanged scores are not rewritten.
+
+    Runs on the background connection, as it is usually called from the buffer's flush thread.
+    """
+    with self.background_lock:
+      cursor = self.get_background_cursor()
+      changed = psycopg2.extras.execute_values(
+        cursor,
         """
         INSERT INTO comments (
           comment_id,
@@ -716,69 +2067,54 @@ class DunderDatabase(SubtitleDatabase):
           start_index,
           end_index,
           score
-        ) VALUES (
-          %s, 
-          %s, 
-          %s, 
-          %s, 
-          %s,
-          %s
-        )
-        """, (comment_id, season, episode, start_index, end_index, score)
+        ) VALUES %s
+        ON CONFLICT (comment_id) DO UPDATE
+        SET score = EXCLUDED.score
+        WHERE comments.score <> EXCLUDED.score
+        RETURNING comment_id
+        """, rows, page_size = DunderDatabase.COMMENT_BUFFER_SIZE, fetch = True
       )
-      self.get_connection().commit()
+      cursor.connection.commit()
+    logger.debug("Wrote {0} buffered comment(s), {1} changed.".format(len(rows), len(changed)))
+    if changed:
+      self.invalidate_search_cache()
 
   def _crawl_titles(self):
     """
     Searches for titles in "episodes.csv".
     """
-    connection = self.get_connection()
-    cursor = connection.cursor()
     if os.path.exists(os.path.join(self.directory, "episodes.csv")):
+      cursor = self.get_cursor()
       with open(os.path.join(self.directory, "episodes.csv",), "r") as episodes:
-        reader = csv.reader(episodes)
-        for season, episode, title in reader:
-          cursor.execute(
-            """
-            SELECT EXISTS (
-              SELECT 1
-              FROM episodes
-              WHERE season = %s
-              AND episode = %s
-            )
-            """, (season, episode)
-          )
-          if cursor.fetchone()[0]:
-            cursor.execute(
-              """
-              UPDATE episodes
-              SET title = %s
-              WHERE season = %s
-              AND episode = %s
-              """, (title, season, episode)
-            )
-          else:
-            cursor.execute(
-              """
-              INSERT INTO episodes (
-                title,
-                season,
-                episode
-              ) VALUES (
-                %s,
-                %s,
-                %s
-              )
-              """, (title, season, episode)
-            )
-      connection.commit()
+        titles = dict([
+          ((int(season), int(episode)), title)
+          for season, episode, title
+          in csv.reader(episodes)
+        ])
+      psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO episodes (
+          season,
+          episode,
+          title
+        ) VALUES %s
+        ON CONFLICT (season, episode) DO UPDATE
+        SET title = EXCLUDED.title
+        """, [
+          (season, episode, title)
+          for (season, episode), title
+          in six.iteritems(titles)
+        ]
+      )
+      cursor.connection.commit()
 
   def _migrate(self):
     """
     Runs the default migration against the database. Checked on instantiation.
     """
     super(DunderDatabase, self)._migrate()
-    cursor = self.get_connection().cursor()
+    cursor = self.get_cursor()
     cursor.execute(DunderDatabase.DUNDER_MIGRATION)
-    self.get_connection().commit()
-    self.get_connection().close()
+    cursor.connection.commit()
+    cursor.connection.close()
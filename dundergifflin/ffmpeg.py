@@ -1,16 +1,247 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function
-from util import logger, flatten
+from dundergifflin.util import logger, flatten, unique, MillisecondTimestamp, WorkerPool
 
 import subprocess
 import sys
 import os
+import time
+import errno
 import itertools
+import hashlib
+import bisect
+import threading
+import multiprocessing
 import six
 
 FONT = "/home/thrall/downloads/impact.ttf"
 
+def probe_keyframes(input_file, timeout = None):
+  """
+  Finds the timestamps of every keyframe in the first video stream of a file.
+
+  Reads packet flags with ffprobe, so nothing is decoded; this still reads the whole file.
+
+  Parameters
+  ----------
+  input_file : string
+    The video file.
+  timeout : float
+    The number of seconds to let ffprobe run for. None waits forever.
+
+  Returns
+  -------
+  list
+    The keyframe timestamps in milliseconds, in ascending order.
+  """
+  command = [
+    "ffprobe",
+    "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "packet=pts_time,flags",
+    "-of", "csv=print_section=0",
+    input_file
+  ]
+  logger.debug("Executing command {0}".format(" ".join(command)))
+  p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+  timer = threading.Timer(timeout, p.kill) if timeout else None
+  if timer is not None:
+    timer.daemon = True
+    timer.start()
+  try:
+    out, err = p.communicate()
+  finally:
+    if timer is not None:
+      timer.cancel()
+  if p.returncode != 0:
+    raise IOError("FFProbe returned an error code. Stderr was:\n{0}".format(err))
+  keyframes = set()
+  for line in out.decode("UTF-8").splitlines():
+    fields = line.strip().split(",")
+    if len(fields) < 2 or "K" not in fields[1]:
+      continue
+    try:
+      keyframes.add(int(round(float(fields[0]) * 1000)))
+    except ValueError:
+      continue
+  return sorted(keyframes)
+
+def keyframe_window(keyframes, start, end):
+  """
+  Finds the keyframes surrounding a span of time, which a clip can be cut at without re-encoding.
+
+  Parameters
+  ----------
+  keyframes : list
+    Keyframe timestamps in milliseconds, in ascending order, as from probe_keyframes().
+  start : int
+    The start of the span in milliseconds.
+  end : int
+    The end of the span in milliseconds.
+
+  Returns
+  -------
+  tuple
+    clip_start : int
+      The last keyframe at or before start, or 0.
+    clip_end : int
+      The first keyframe at or after end, or None if the span runs past the last keyframe.
+  """
+  i = bisect.bisect_right(keyframes, start)
+  j = bisect.bisect_left(keyframes, end)
+  return (keyframes[i-1] if i > 0 else 0, keyframes[j] if j < len(keyframes) else None)
+
+def extract_clip(input_file, output_file, clip_start, clip_end = None, timeout = None):
+  """
+  Copies the video between two keyframes into a file of its own, without re-encoding.
+
+  Audio and subtitle streams are dropped. The clip's timestamps start at zero.
+
+  Parameters
+  ----------
+  input_file : string
+    The video file.
+  output_file : string
+    The file to write the clip to. Overwritten if it exists.
+  clip_start : int
+    The keyframe to start at, in milliseconds.
+  clip_end : int
+    The keyframe to end at, in milliseconds. None copies to the end of the file.
+  timeout : float
+    The number of seconds to let ffmpeg run for. None waits forever.
+
+  Returns
+  -------
+  string
+    The output of the command.
+  """
+  converter = Converter(input_file, output_file, True)
+  converter.add_input_flag("-ss", MillisecondTimestamp(clip_start))
+  if clip_end is not None:
+    converter.add_output_flag("-t", (clip_end - clip_start) / 1000.0)
+  converter.add_output_flag("-map", "0:v:0")
+  converter.add_output_flag("-c", "copy")
+  converter.add_output_flag("-avoid_negative_ts", "make_zero")
+  return converter.execute(timeout)
+
+def prune_clips(directory, size):
+  """
+  Removes the least recently used clips under a directory until they fit in a size.
+
+  A clip's modification time is its last use, so callers should touch clips as they use them.
+  The most recently used clip is always kept.
+
+  Parameters
+  ----------
+  directory : string
+    The directory the clips are kept in, searched recursively for .mkv files.
+  size : int
+    The maximum number of bytes of clips to keep.
+
+  Returns
+  -------
+  int
+    The number of clips removed.
+  """
+  found = []
+  for root, directories, filenames in os.walk(directory):
+    for filename in filenames:
+      if not filename.endswith(".mkv"):
+        continue
+      path = os.path.join(root, filename)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      found.append((stat.st_mtime, path, stat.st_size))
+  found.sort()
+  total_size = sum(file_size for mtime, path, file_size in found)
+  removed = 0
+  for mtime, path, file_size in found[:-1]:
+    if total_size <= size:
+      break
+    logger.debug("Removing clip {0} ({1} bytes).".format(path, file_size))
+    try:
+      os.remove(path)
+    except OSError as ex:
+      if ex.errno != errno.ENOENT:
+        raise
+    total_size -= file_size
+    removed += 1
+  return removed
+
+def proxy_path(input_file):
+  """
+  The path a proxy of a video file is built at, next to the file: E01.mkv becomes E01.proxy.mkv.
+
+  Parameters
+  ----------
+  input_file : string
+    The video file.
+
+  Returns
+  -------
+  string
+    The path to the proxy, whether or not it exists.
+  """
+  return "{0}.proxy.mkv".format(os.path.splitext(input_file)[0])
+
+def find_proxy(input_file):
+  """
+  Finds a usable proxy of a video file.
+
+  Parameters
+  ----------
+  input_file : string
+    The video file.
+
+  Returns
+  -------
+  string
+    The path to the proxy, or None if it does not exist or is older than the video file.
+  """
+  path = proxy_path(input_file)
+  if os.path.exists(path) and os.path.exists(input_file) and os.path.getmtime(path) >= os.path.getmtime(input_file):
+    return path
+  return None
+
+def build_proxy(input_file, output_file, image_width, gop = 12, timeout = None):
+  """
+  Transcodes a video file into a small proxy that is quick to seek in and decode.
+
+  The proxy is scaled down to the width GIFs are rendered at, keyframed every gop frames,
+  and has no audio or subtitle streams.
+
+  Parameters
+  ----------
+  input_file : string
+    The video file.
+  output_file : string
+    The file to write the proxy to. Overwritten if it exists.
+  image_width : int
+    The width of the proxy. Will scale height proportionately.
+  gop : int
+    The number of frames between keyframes. 1 makes every frame a keyframe.
+  timeout : float
+    The number of seconds to let ffmpeg run for. None waits forever.
+
+  Returns
+  -------
+  string
+    The output of the command.
+  """
+  converter = Converter(input_file, output_file, True)
+  converter.add_output_flag("-map", "0:v:0")
+  converter.add_filter(scale = "{0}:-2".format(image_width))
+  converter.add_output_flag("-c:v", "libx264")
+  converter.add_output_flag("-preset", "fast")
+  converter.add_output_flag("-crf", 18)
+  converter.add_output_flag("-pix_fmt", "yuv420p")
+  converter.add_output_flag("-g", gop)
+  converter.add_output_flag("-keyint_min", gop)
+  return converter.execute(timeout)
+
 class Converter(object):
   """
   A class to wrap around FFMpeg conversion from video to GIF.
@@ -21,10 +252,14 @@ class Converter(object):
     The input file. Can be absolute or relative to the cwd at execution.
   output_file : string
     The output file. Can be absolute or relative to the cwd at execution.
+    Converter.PIPE writes the output to ffmpeg's stdout instead, and execute() returns it;
+    an output format ("-f") must then be set.
   overwrite : boolean
     Whether or not to overwrite the output file (if it exists). If this is false,
     this will ask for input when the file exists.
   """
+  PIPE = "pipe:1"
+
   def __init__(self, input_file, output_file, overwrite = False):
     self.input_file = input_file
     self.output_file = output_file
@@ -85,16 +320,42 @@ class Converter(object):
         self.output_args["-vf"] = []
       self.output_args["-vf"].append(filter_string)
 
-  def execute(self):
+  def add_filter_string(self, filter_string):
+    """
+    Add a video filter exactly as written. Unlike add_filter, this allows filter graph
+    syntax, such as labelled pads and ';' separated chains.
+
+    Parameters
+    ----------
+    filter_string : string
+      The filter, or filter graph, to append to the "-vf" flag.
+    """
+    if "-vf" not in self.output_args:
+      self.output_args["-vf"] = []
+    self.output_args["-vf"].append(filter_string)
+
+  def piped(self):
+    """
+    Whether or not the output is written to stdout rather than a file.
+    """
+    return self.output_file == Converter.PIPE
+
+  def execute(self, timeout = None):
     """
     Executes the conversion using the supplied input and output flags.
 
+    Parameters
+    ----------
+    timeout : float
+      The number of seconds to let ffmpeg run for before killing it. None waits forever.
+
     Returns
     -------
     string
-      The output of the command.
+      The output of the command. When the output file is Converter.PIPE, this is the
+      converted data.
     """
-    if os.path.exists(self.output_file):
+    if not self.piped() and os.path.exists(self.output_file):
       if self.overwrite:
         os.remove(self.output_file)
       elif raw_input("Output file {0} exists. Overwrite? (Y/N): ".format(self.output_file)).lower().startswith("y"):
@@ -119,27 +380,171 @@ class Converter(object):
     ]
     logger.debug("Executing command {0}".format(" ".join(command)))
     p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    out, err = p.communicate()
+    timed_out = threading.Event()
+    def kill():
+      timed_out.set()
+      p.kill()
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer is not None:
+      timer.daemon = True
+      timer.start()
+    try:
+      out, err = p.communicate()
+    finally:
+      if timer is not None:
+        timer.cancel()
+    if timed_out.is_set():
+      if not self.piped() and os.path.exists(self.output_file):
+        os.remove(self.output_file)
+      raise RenderTimeout("FFMpeg did not finish within {0} second(s), killed.".format(timeout))
     if p.returncode != 0:
       raise IOError("FFMpeg returned an error code. Stderr was:\n{0}".format(err))
     return out
 
+  def submit(self, pool, timeout = None):
+    """
+    Queues the conversion on a render pool, without waiting for it.
+
+    Parameters
+    ----------
+    pool : RenderPool
+      The pool to run the conversion on.
+    timeout : float
+      The number of seconds to let ffmpeg run for. Defaults to the pool's timeout.
+
+    Returns
+    -------
+    dundergifflin.util.Job
+      The queued job. Call result() on it to wait for the conversion.
+    """
+    return pool.submit(self, timeout)
+
+class RenderTimeout(IOError):
+  """
+  Raised when ffmpeg is killed for running longer than allowed.
+  """
+  pass
+
+class RenderPool(WorkerPool):
+  """
+  A bounded pool of threads that each run one ffmpeg process at a time.
+
+  Conversions are queued with submit(), and run in the order they were submitted.
+  Each has until its timeout, counted from when it was submitted, to finish; any still
+  waiting for a place then fail, and any still running are killed.
+
+  As with any WorkerPool, each process gets its own threads and queue, but they all share one
+  semaphore created with the pool, so at most size ffmpeg processes run at once across the
+  parent and every process forked from it. A process killed while rendering does not give its
+  place back, so places are only waited on until the timeout, rather than forever.
+
+  Parameters
+  ----------
+  size : int
+    The number of conversions to run at once.
+  timeout : float
+    The default number of seconds to let each conversion run for. None waits forever.
+  """
+  KILL_GRACE = 10
+
+  def __init__(self, size = 2, timeout = 120):
+    super(RenderPool, self).__init__(size, "Render job")
+    self.timeout = timeout
+    self.slots = multiprocessing.BoundedSemaphore(self.size)
+
+  def _reset(self):
+    """
+    Internal. Creates a fresh queue and metrics, discarding anything inherited from a parent process.
+    """
+    super(RenderPool, self)._reset()
+    self.timeouts = 0
+
+  def submit(self, converter, timeout = None):
+    """
+    Queue a conversion.
+
+    Parameters
+    ----------
+    converter : Converter
+      The conversion to run.
+    timeout : float
+      The number of seconds to let the conversion take, including waiting for a place.
+      Defaults to the pool's timeout.
+
+    Returns
+    -------
+    dundergifflin.util.Job
+      The queued job. Call result() on it to wait for the output of ffmpeg. Waiting
+      KILL_GRACE seconds past the timeout leaves time for ffmpeg to be killed.
+    """
+    timeout = self.timeout if timeout is None else timeout
+    return super(RenderPool, self).submit(self._render, converter, timeout, time.time() + timeout if timeout else None)
+
+  def metrics(self):
+    """
+    Statistics about the jobs this pool has run in this process.
+
+    Returns
+    -------
+    dict
+      As WorkerPool.metrics(), where running includes jobs waiting for another process to
+      finish rendering, and:
+      timeouts : int
+        Jobs killed for running past their timeout.
+    """
+    metrics = super(RenderPool, self).metrics()
+    with self.lock:
+      metrics["timeouts"] = self.timeouts
+    return metrics
+
+  def _render(self, converter, timeout, deadline):
+    """
+    Internal. Runs one conversion, holding one of the shared slots, for whatever is left of its timeout.
+    """
+    if deadline is None:
+      self.slots.acquire()
+    elif not self.slots.acquire(True, max(0, deadline - time.time())):
+      raise RenderTimeout("Could not render {0} within {1} second(s), no render slot was free.".format(converter.output_file, timeout))
+    try:
+      if deadline is None:
+        return converter.execute()
+      if deadline <= time.time():
+        raise RenderTimeout("Could not render {0} within {1} second(s), no render slot was free in time.".format(converter.output_file, timeout))
+      return converter.execute(deadline - time.time())
+    finally:
+      self.slots.release()
+
+  def _finished(self, job):
+    """
+    Internal. Records a finished job in the metrics. Must hold the lock.
+    """
+    super(RenderPool, self)._finished(job)
+    if isinstance(job.exception, RenderTimeout):
+      self.timeouts += 1
+
 class SubtitleConverter(Converter):
   """
   A subclass of Converter used specifically for writing subtitles.
 
+  By default, GIFs are encoded with a palette generated from the clip itself (palettegen
+  and paletteuse, in one filter graph), rather than ffmpeg's default palette. If a maximum
+  size is given, the GIF is rendered again at lower widths and frame rates from SIZE_LADDER
+  until it fits, skipping steps predicted to be too large. The width, frame rate, size
+  and render time of each attempt are kept in attempts.
+
   Parameters
   ----------
   input_file : string
     The input file. Can be absolute or relative to the cwd at execution.
   output_file : string
     The output file. Can be absolute or relative to the cwd at execution.
+    Converter.PIPE returns the GIF from execute() instead of writing a file.
   overwrite : boolean
     Whether or not to overwrite the output file (if it exists). If this is false,
     this will ask for input when the file exists.
-  start : dundergifflin.util.Timestamp
+  start : dundergifflin.util.MillisecondTimestamp
     The timestamp the start the GIF from.
-  end : dundergifflin.util.Timestamp
+  end : dundergifflin.util.MillisecondTimestamp
     The timestamp to end the GIF at.
   text : string
     The text to display.
@@ -155,18 +560,88 @@ class SubtitleConverter(Converter):
     The offset for the base of the text, from the bottom, in pixels.
   text_stroke_width : int
     The thickness of the stroke around the text. Always black.
+  fps : int
+    The frame rate to reduce the GIF to. None keeps the source frame rate.
+  palette : boolean
+    Whether or not to generate a palette for the GIF.
+  max_size : int
+    The number of bytes the GIF should fit in. None renders once, at image_width.
+  text_stroke_method : string
+    How to draw the stroke. "border" uses one drawtext filter per line, with a border
+    of text_stroke_width. "shadow" is the original method, drawing the line once for
+    every shadow offset within text_stroke_width, which costs more the wider the stroke is.
   """
-  def __init__(self, input_file, output_file, overwrite, start, end, text, image_width, text_font, text_color, text_size_max, text_offset, text_stroke_width):
+  RENDER_VERSION = 3
+  TEXT_STROKE_METHODS = ["border", "shadow"]
+  SOURCE_FPS = 24
+  SIZE_LADDER = [
+    (1.0, None),
+    (1.0, 15),
+    (0.85, 12),
+    (0.7, 10),
+    (0.55, 8)
+  ]
+  PALETTE_FILTER = "split[frames][palette_frames];[palette_frames]palettegen=stats_mode=diff[palette];[frames][palette]paletteuse=dither=bayer:bayer_scale=3:diff_mode=rectangle"
+
+  def __init__(self, input_file, output_file, overwrite, start, end, text, image_width, text_font, text_color, text_size_max, text_offset, text_stroke_width, fps = None, palette = True, max_size = None, text_stroke_method = "border"):
     super(SubtitleConverter, self).__init__(input_file, output_file, overwrite)
-    
+    if text_stroke_method not in SubtitleConverter.TEXT_STROKE_METHODS:
+      raise ValueError("Unknown text stroke method '{0}', expected one of {1}.".format(text_stroke_method, ", ".join(SubtitleConverter.TEXT_STROKE_METHODS)))
+    self.text = text
+    self.image_width = int(image_width)
+    self.text_font = text_font
+    self.text_color = text_color
+    self.text_size_max = text_size_max
+    self.text_offset = text_offset
+    self.text_stroke_width = text_stroke_width
+    self.fps = fps
+    self.palette = palette
+    self.max_size = max_size
+    self.text_stroke_method = text_stroke_method
+    self.attempts = []
+
     self.add_input_flag("-ss", start)
     self.add_output_flag("-t", (end-start).total_seconds())
+    self.add_output_flag("-f", "gif")
+
+  def build_filters(self, image_width, fps = None):
+    """
+    Sets the video filters for rendering at a width and frame rate.
+
+    The text is scaled down in proportion to the width.
+
+    Parameters
+    ----------
+    image_width : int
+      The width of the image to generate.
+    fps : int
+      The frame rate to reduce the GIF to. None keeps the source frame rate.
+    """
+    self.output_args.pop("-vf", None)
+    scale = image_width / float(self.image_width)
+
+    if fps:
+      self.add_filter(fps = fps)
     self.add_filter(scale = "{0}:-1".format(image_width))
 
-    text_size = int(text_size_max-len(text)/10)
+    text_size = int((self.text_size_max-len(self.text)//10) * scale)
+    font_size = int((self.text_size_max-len(self.text)//5) * scale)
+    text_stroke_width = max(1, int(round(self.text_stroke_width * scale))) if self.text_stroke_width else 0
 
-    for line_offset, text_line in enumerate(reversed(text.splitlines())):
-      _text_offset = int(text_offset) + (line_offset * text_size)
+    for line_offset, text_line in enumerate(reversed(self.text.splitlines())):
+      _text_offset = int(int(self.text_offset) * scale) + (line_offset * text_size)
+      if self.text_stroke_method == "border":
+        self.add_filter(drawtext = {
+          "fontfile": self.text_font,
+          "text": text_line.strip().replace("'", "`"),
+          "x": "(w-text_w)/2",
+          "y": "(h-text_h-{0})".format(_text_offset),
+          "fontsize": font_size,
+          "fontcolor": self.text_color,
+          "borderw": text_stroke_width,
+          "bordercolor": "black"
+        })
+        continue
       for shadowx, shadowy in itertools.product(
         list(
           range(
@@ -177,12 +652,122 @@ class SubtitleConverter(Converter):
         repeat=2
       ):
         self.add_filter(drawtext = {
-          "fontfile": text_font,
+          "fontfile": self.text_font,
           "text": text_line.strip().replace("'", "`"),
           "x": "(w-text_w)/2",
           "y": "(h-text_h-{0})".format(_text_offset),
-          "fontsize": int(text_size_max-len(text)/5),
-          "fontcolor": text_color,
+          "fontsize": font_size,
+          "fontcolor": self.text_color,
           "shadowx": shadowx,
           "shadowy": shadowy
         })
+
+    if self.palette:
+      self.add_filter_string(SubtitleConverter.PALETTE_FILTER)
+
+  def candidates(self):
+    """
+    The widths and frame rates to try, in order.
+
+    Returns
+    -------
+    list
+      A list of (image_width, fps) tuples. Only the first, if there is no maximum size.
+    """
+    candidates = []
+    for width_scale, fps in SubtitleConverter.SIZE_LADDER:
+      if fps is None or (self.fps and self.fps < fps):
+        fps = self.fps
+      candidates.append((int(self.image_width * width_scale) // 2 * 2, fps))
+    candidates = unique(candidates)
+    return candidates if self.max_size else candidates[:1]
+
+  def execute(self, timeout = None):
+    """
+    Renders the GIF, lowering the width and frame rate until it fits in the maximum size.
+
+    If no attempt fits, the smallest is kept.
+
+    Parameters
+    ----------
+    timeout : float
+      The number of seconds to let the whole render run for, across every attempt. Each
+      ffmpeg attempt is killed once the time left runs out. None waits forever.
+
+    Returns
+    -------
+    string
+      The output of the last command; the GIF itself, when the output file is Converter.PIPE.
+    """
+    self.attempts = []
+    candidates = self.candidates()
+    deadline = time.time() + timeout if timeout else None
+    out = None
+    for i, (image_width, fps) in enumerate(candidates):
+      if self.attempts and i < len(candidates) - 1:
+        last_width, last_fps, last_size, last_seconds = self.attempts[-1]
+        predicted_size = last_size * (image_width / float(last_width)) ** 2 * (fps or SubtitleConverter.SOURCE_FPS) / float(last_fps or SubtitleConverter.SOURCE_FPS)
+        if predicted_size > self.max_size:
+          continue
+      if self.attempts and not self.piped():
+        os.remove(self.output_file)
+      self.build_filters(image_width, fps)
+      start = time.time()
+      if deadline is not None and start >= deadline:
+        raise RenderTimeout("Could not render {0} within {1} second(s), gave up after {2} attempt(s).".format(self.output_file, timeout, len(self.attempts)))
+      out = super(SubtitleConverter, self).execute(deadline - start if deadline is not None else None)
+      if self.piped():
+        size = len(out)
+      elif os.path.exists(self.output_file):
+        size = os.path.getsize(self.output_file)
+      else:
+        return out
+      self.attempts.append((image_width, fps, size, time.time() - start))
+      logger.debug("Rendered {0} at width {1}, {2} fps: {3} bytes in {4:.2f} second(s).".format(
+        self.output_file,
+        image_width,
+        fps or "source",
+        self.attempts[-1][2],
+        self.attempts[-1][3]
+      ))
+      if not self.max_size or self.attempts[-1][2] <= self.max_size:
+        return out
+    logger.warning("Could not render {0} in {1} bytes, keeping {2} bytes.".format(
+      self.output_file,
+      self.max_size,
+      self.attempts[-1][2]
+    ))
+    return out
+
+  @staticmethod
+  def settings_hash(image_width, text_font, text_color, text_size_max, text_offset, text_stroke_width, fps = None, palette = True, max_size = None, text_stroke_method = "border"):
+    """
+    Hashes the settings that change how a subtitle is rendered, to identify renders that can be reused.
+
+    RENDER_VERSION is part of the hash, and should be incremented whenever the filters
+    change, so renders from before the change are not reused.
+
+    Parameters are the same as the constructor's.
+
+    Returns
+    -------
+    string
+      The hex md5 of the settings.
+    """
+    return hashlib.md5(
+      "|".join([
+        "{0}".format(value) for value in [
+          SubtitleConverter.RENDER_VERSION,
+          image_width,
+          text_font,
+          text_color,
+          text_size_max,
+          text_offset,
+          text_stroke_width,
+          fps,
+          palette,
+          max_size,
+          text_stroke_method
+        ]
+      ]).encode("UTF-8")
+    ).hexdigest()
@@ -2,17 +2,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function
 import requests
+import requests.adapters
 import socket
 import subprocess
 import threading
 import time
 import six
 import datetime
-import base64
+import math
+import multiprocessing
 import os
+import uuid
 import json
 import traceback
-from dundergifflin.util import url_join, url_encode, logger
+from dundergifflin.util import url_join, url_encode, logger, WorkerPool
 from dundergifflin.exceptions import RequestException
 
 HTTP_ENDPOINT = "https://api.imgur.com/3"
@@ -61,6 +64,100 @@ class AuthorizationListener(threading.Thread):
     sock.close()
     self.received.set()    
 
+class MultipartBody(object):
+  """
+  A multipart/form-data request body that is read in chunks, so files are streamed into
+  the request rather than loaded into memory.
+
+  The length is known up front, so requests sends a Content-Length rather than chunking.
+
+  Parameters
+  ----------
+  fields : dict
+    Form field names mapped to their values.
+  files : dict
+    File field names mapped to (filename, source, content type) tuples. The source is either
+    bytes, or a seekable file-like object, which is read from its current position.
+  """
+  CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, fields, files):
+    self.boundary = uuid.uuid4().hex
+    self.parts = []
+    for name, value in six.iteritems(fields):
+      self.parts.append(
+        "--{0}\r\nContent-Disposition: form-data; name=\"{1}\"\r\n\r\n{2}\r\n".format(
+          self.boundary,
+          name,
+          value
+        ).encode("UTF-8")
+      )
+    for name, (filename, source, content_type) in six.iteritems(files):
+      self.parts.append(
+        "--{0}\r\nContent-Disposition: form-data; name=\"{1}\"; filename=\"{2}\"\r\nContent-Type: {3}\r\n\r\n".format(
+          self.boundary,
+          name,
+          filename,
+          content_type
+        ).encode("UTF-8")
+      )
+      if isinstance(source, (six.binary_type, bytearray)):
+        self.parts.append(bytes(source))
+      else:
+        position = source.tell()
+        source.seek(0, os.SEEK_END)
+        self.parts.append((source, position, source.tell() - position))
+        source.seek(position)
+      self.parts.append(b"\r\n")
+    self.parts.append("--{0}--\r\n".format(self.boundary).encode("UTF-8"))
+    self.length = sum([part[2] if isinstance(part, tuple) else len(part) for part in self.parts])
+    self.rewind()
+
+  def __len__(self):
+    return self.length
+
+  @property
+  def content_type(self):
+    """
+    The Content-Type header value for this body, including its boundary.
+    """
+    return "multipart/form-data; boundary={0}".format(self.boundary)
+
+  def rewind(self):
+    """
+    Returns to the start of the body, so it can be sent again.
+    """
+    self.index = 0
+    self.offset = 0
+    for part in self.parts:
+      if isinstance(part, tuple):
+        part[0].seek(part[1])
+
+  def read(self, size = -1):
+    """
+    Reads up to size bytes of the body, or all of the rest of it.
+    """
+    if size is None or size < 0:
+      size = self.length
+    chunks = []
+    while size > 0 and self.index < len(self.parts):
+      part = self.parts[self.index]
+      if isinstance(part, tuple):
+        chunk = part[0].read(min(size, part[2] - self.offset))
+        if not chunk and self.offset < part[2]:
+          raise IOError("File ended before {0} bytes were read.".format(part[2]))
+        part_length = part[2]
+      else:
+        chunk = part[self.offset:self.offset + size]
+        part_length = len(part)
+      self.offset += len(chunk)
+      size -= len(chunk)
+      chunks.append(chunk)
+      if self.offset >= part_length:
+        self.index += 1
+        self.offset = 0
+    return b"".join(chunks)
+
 class Imgur(object):
   """
   A context manager that handles an imgur client.
@@ -81,28 +178,214 @@ class Imgur(object):
     See README for more information.
   refresh_token : string
     If already authorized, this token will allow us to get a new oauth2 bearer token.
+  api_endpoint : string
+    The base URL of the imgur API.
+  auth_endpoint : string
+    The base URL of imgur's oauth2 endpoints.
+
+  Requests are sent through one requests.Session per process, so connections are kept alive
+  and reused. Requests that fail to connect or receive one of RETRY_STATUSES are retried up to
+  RETRIES times, waiting RETRY_BACKOFF seconds, doubling each time. Requests that time out
+  waiting for a response are not retried, since imgur may have taken the upload anyway.
+
+  The rate limit headers of each response are recorded in rate_limits. While any credit
+  (user, client, or post) is used up, requests wait for it to reset rather than fail, and
+  requests refused with a 429 are retried after the reset, up to RATE_LIMIT_RETRIES times.
+  When imgur does not say when a credit resets, RATE_LIMIT_WAIT seconds are waited. Credits
+  are counted per account, so rate_limits is kept in shared memory: processes forked after
+  the client is created see each other's responses, and wait together. Each request takes
+  a credit before it is sent, so concurrent requests do not all spend the last one.
   """
   AUTHORIZATION_TIMEOUT = 60
-  def __init__(self, client_id, client_secret, authorization_listen_address, authorization_listen_port, refresh_token = None):
+  REQUEST_TIMEOUT = 60
+  POOL_SIZE = 4
+  RETRIES = 3
+  RETRY_BACKOFF = 0.5
+  RETRY_STATUSES = [500, 502, 503, 504]
+  RATE_LIMIT_RETRIES = 5
+  RATE_LIMIT_WAIT = 60
+  RATE_LIMIT_KEYS = ["user", "client", "post", "retry"]
+
+  def __init__(self, client_id, client_secret, authorization_listen_address, authorization_listen_port, refresh_token = None, api_endpoint = HTTP_ENDPOINT, auth_endpoint = AUTH_ENDPOINT):
     self.client_id = client_id
     self.client_secret = client_secret
     self.authorization_listen_address = authorization_listen_address
     self.authorization_listen_port = authorization_listen_port
     self.refresh_token = refresh_token
+    self.api_endpoint = api_endpoint
+    self.auth_endpoint = auth_endpoint
+    self._session = None
+    self._pid = None
+    self.rate_limits = multiprocessing.Array("d", [float("nan")] * 3 * len(Imgur.RATE_LIMIT_KEYS))
+    self.session_lock = threading.Lock()
+    self.authorization_lock = threading.Lock()
 
   def __enter__(self):
     self._authorize()
     return self
 
   def __exit__(self, *args):
-    pass
+    if self._session is not None and self._pid == os.getpid():
+      self._session.close()
+    self._session = None
+
+  @property
+  def session(self):
+    """
+    The requests.Session for this process. Sessions are not shared across a fork, as their
+    pooled connections would be.
+    """
+    with self.session_lock:
+      if self._session is None or self._pid != os.getpid():
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = Imgur.POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._pid = os.getpid()
+      return self._session
+
+  def rate_limit_wait(self):
+    """
+    How long to wait before the next request, for any used up credit to reset.
+
+    Returns
+    -------
+    float
+      The number of seconds to wait. 0 if no credit is used up.
+    """
+    now = time.time()
+    waits = [
+      rate_limit["reset"] - now
+      for rate_limit in six.itervalues(self.credits())
+      if rate_limit["remaining"] <= 0
+    ]
+    return max([0] + waits)
+
+  def credits(self):
+    """
+    The credits remaining, as of the last response.
+
+    Returns
+    -------
+    dict
+      "user", "client", and "post" (for whichever imgur has reported), and "retry" after
+      a 429, mapped to dicts of:
+        remaining : int
+          The credits remaining.
+        limit : int
+          The credits available in total, or None if not reported.
+        reset : float
+          The epoch time the credits reset at.
+    """
+    with self.rate_limits.get_lock():
+      values = list(self.rate_limits)
+    credits = {}
+    for i, key in enumerate(Imgur.RATE_LIMIT_KEYS):
+      remaining, limit, reset = values[i * 3:i * 3 + 3]
+      if not math.isnan(remaining):
+        credits[key] = {
+          "remaining": int(remaining),
+          "limit": int(limit) if not math.isnan(limit) else None,
+          "reset": reset
+        }
+    return credits
+
+  def _reserve_credit(self):
+    """
+    Internal. Takes a credit for a request about to be sent.
+
+    A credit whose reset has passed is assumed to be back to its limit until the next
+    response says otherwise.
+
+    Returns
+    -------
+    float
+      The number of seconds to wait for used up credits to reset, in which case no credit
+      was taken. 0 if a credit was taken.
+    """
+    now = time.time()
+    with self.rate_limits.get_lock():
+      values = list(self.rate_limits)
+      waits = []
+      for i in range(0, len(values), 3):
+        remaining, limit, reset = values[i:i + 3]
+        if math.isnan(remaining):
+          continue
+        if reset <= now and not math.isnan(limit):
+          values[i:i + 3] = [limit, limit, now + Imgur.RATE_LIMIT_WAIT]
+        elif remaining <= 0 and reset > now:
+          waits.append(reset - now)
+      if waits:
+        return max(waits)
+      for i in range(0, len(values), 3):
+        if not math.isnan(values[i]) and values[i + 2] > now:
+          values[i] -= 1
+      self.rate_limits[:] = values
+    return 0
+
+  def _record_rate_limits(self, response):
+    """
+    Internal. Records the rate limit headers of a response.
+    """
+    now = time.time()
+    def header(name):
+      try:
+        return int(float(response.headers[name]))
+      except (KeyError, TypeError, ValueError):
+        return None
+    reported = [
+      ("user", header("X-RateLimit-UserRemaining"), header("X-RateLimit-UserLimit"), header("X-RateLimit-UserReset")),
+      ("client", header("X-RateLimit-ClientRemaining"), header("X-RateLimit-ClientLimit"), None),
+      ("post", header("X-Post-Rate-Limit-Remaining"), header("X-Post-Rate-Limit-Limit"), now + header("X-Post-Rate-Limit-Reset") if header("X-Post-Rate-Limit-Reset") is not None else None)
+    ]
+    if response.status_code == 429:
+      retry_after = header("Retry-After")
+      reported.append(("retry", 0, None, now + (retry_after if retry_after is not None else Imgur.RATE_LIMIT_WAIT)))
+    with self.rate_limits.get_lock():
+      for key, remaining, limit, reset in reported:
+        if remaining is not None:
+          i = Imgur.RATE_LIMIT_KEYS.index(key) * 3
+          if key != "retry" and self.rate_limits[i + 2] > now:
+            remaining = min(remaining, self.rate_limits[i])
+          self.rate_limits[i:i + 3] = [
+            remaining,
+            limit if limit is not None else float("nan"),
+            reset if reset is not None else now + Imgur.RATE_LIMIT_WAIT
+          ]
 
   def _post_request(self, url, headers, data):
     """
-    Internal. Sends a post request with the specified url, headers, and data. Will throw an exception
-    if the response status code is not a 200-range.
+    Internal. Sends a post request with the specified url, headers, and data, retrying with backoff
+    on connection errors and RETRY_STATUSES, but not on read timeouts. Will throw an exception if
+    the final response status code is not a 200-range.
     """
-    response = requests.post(url, headers = headers, data = data)
+    attempt = 0
+    rate_limited = 0
+    while True:
+      wait = self._reserve_credit()
+      while wait > 0:
+        logger.info("Waiting {0:.0f} second(s) for the imgur rate limit to reset.".format(wait))
+        time.sleep(wait)
+        wait = self._reserve_credit()
+      if hasattr(data, "rewind"):
+        data.rewind()
+      try:
+        response = self.session.post(url, headers = headers, data = data, timeout = Imgur.REQUEST_TIMEOUT)
+      except requests.exceptions.ConnectionError as ex:
+        if attempt == Imgur.RETRIES:
+          raise
+        logger.warning("POST to {0} failed, retrying.\n{1}(): {2}".format(url, type(ex).__name__, str(ex)))
+      else:
+        self._record_rate_limits(response)
+        if response.status_code == 429 and rate_limited < Imgur.RATE_LIMIT_RETRIES:
+          rate_limited += 1
+          logger.warning("POST to {0} was rate limited, retrying after the reset.".format(url))
+          continue
+        if response.status_code not in Imgur.RETRY_STATUSES or attempt == Imgur.RETRIES:
+          break
+        logger.warning("POST to {0} returned {1}, retrying.".format(url, response.status_code))
+      time.sleep(Imgur.RETRY_BACKOFF * (2 ** attempt))
+      attempt += 1
     if not (200 <= response.status_code < 300):
       try:
         response_data = response.json()
@@ -118,7 +401,7 @@ class Imgur(object):
     listener = AuthorizationListener(self.authorization_listen_address, self.authorization_listen_port)
     listener.start()
     print("Direct your browser to {0}?{1}".format(
-      url_join(AUTH_ENDPOINT, "authorize"), 
+      url_join(self.auth_endpoint, "authorize"), 
       url_encode(client_id = self.client_id, response_type = "code")
     ))
     start = datetime.datetime.utcnow()
@@ -148,7 +431,7 @@ class Imgur(object):
       
     authorization_code = self._get_user_authorization()
     response = self.post_request(
-      url_join(AUTH_ENDPOINT, "token"), 
+      url_join(self.auth_endpoint, "token"), 
       client_id = self.client_id, 
       client_secret = self.client_secret, 
       grant_type = "authorization_code", 
@@ -170,7 +453,7 @@ class Imgur(object):
     """
     logger.info("Refreshing imgur authorization.")
     response = self.post_request(
-      url_join(AUTH_ENDPOINT, "token"), 
+      url_join(self.auth_endpoint, "token"), 
       client_id = self.client_id, 
       client_secret = self.client_secret, 
       grant_type = "refresh_token", 
@@ -218,45 +501,141 @@ class Imgur(object):
     requests.Response
       The response from said URL.
     """
-    if datetime.datetime.utcnow() > self.expires:
-      self._refresh()
+    with self.authorization_lock:
+      if datetime.datetime.utcnow() > self.expires:
+        self._refresh()
     headers = {
       "Content-Type": "application/x-www-form-urlencoded",
       "Authorization": "Bearer {0}".format(self.access_token)
     }
     return self._post_request(url, headers, url_encode(**data))
 
-  def upload(self, path, title, description):
+  def authenticated_multipart_request(self, url, files, **data):
+    """
+    Send a POST request with multipart/form-data and the oauth2 bearer token.
+
+    Parameters
+    ----------
+    url : string
+      The URL to send the data to.
+    files : dict
+      Field names mapped to (filename, bytes or file-like object, content type) tuples.
+      File-like objects are streamed, as with MultipartBody.
+    data: **kwargs
+      A set of key/value pairs sent as form fields alongside the files.
+
+    Returns
+    -------
+    requests.Response
+      The response from said URL.
+    """
+    with self.authorization_lock:
+      if datetime.datetime.utcnow() > self.expires:
+        self._refresh()
+    body = MultipartBody(data, files)
+    headers = {
+      "Content-Type": body.content_type,
+      "Authorization": "Bearer {0}".format(self.access_token)
+    }
+    return self._post_request(url, headers, body)
+
+  def upload(self, image, title, description, name = None):
     """
     Uploads an image to imgur.
 
-    Will base64 encode the image data.
+    The image is sent as it is, in a multipart/form-data body, rather than base64 encoded.
+    Files are streamed from disk rather than read into memory.
 
     Parameters
     ----------
-    path : string
-      The path to the image file. Can be absolute or relative to the cwd at launch.
+    image : string or file
+      The path to the image file (absolute or relative to the cwd at launch), or a file-like
+      object to read it from, such as an io.BytesIO of the image data. Only objects with a
+      read() method are treated as files; image data itself must be wrapped in one.
     title : string
       The title of the image.
     description : string
       The description of the image.
+    name : string
+      The filename to give the image. Defaults to the name of the file, or "image.gif".
 
     Returns
     -------
     string
       The URL to the image, as returned from the imgur API.        
     """
-    with open(path, "rb") as image_file:
-      encoded_image = base64.b64encode(image_file.read())
+    image_file = None
+    if hasattr(image, "read"):
+      name = name or os.path.basename(getattr(image, "name", "image.gif"))
+    elif isinstance(image, six.string_types):
+      name = name or os.path.basename(image)
+      image = image_file = open(image, "rb")
+    else:
+      raise TypeError("Cannot upload {0}, expected a path or a file-like object.".format(type(image).__name__))
 
-    response = self.authenticated_post_request(
-      url_join(HTTP_ENDPOINT, "image"),
-      name = os.path.basename(path), 
-      description = description, 
-      title = title, 
-      image = encoded_image, 
-      type = "base64"
-    )
+    try:
+      response = self.authenticated_multipart_request(
+        url_join(self.api_endpoint, "image"),
+        {"image": (name or "image.gif", image, "image/gif")},
+        name = name or "image.gif", 
+        description = description, 
+        title = title, 
+        type = "file"
+      )
+    finally:
+      if image_file is not None:
+        image_file.close()
 
     response_data = response.json()
     return response_data["data"]["link"]
+
+class UploadExecutor(WorkerPool):
+  """
+  A bounded pool of threads that upload images through an Imgur client.
+
+  Uploads are queued with submit(), and at most size are in flight at once in each process.
+  The client waits out used up rate limits before each request, so queued uploads are held
+  until credits reset, rather than failing.
+
+  As with any WorkerPool, an executor created before forking can be used on either side of the
+  fork. The client's rate limits are shared by every process forked from where it was created.
+
+  Parameters
+  ----------
+  imgur : Imgur
+    The client to upload with.
+  size : int
+    The number of uploads to have in flight at once.
+  """
+  def __init__(self, imgur, size = 2):
+    super(UploadExecutor, self).__init__(size, "Upload")
+    self.imgur = imgur
+
+  def submit(self, image, title, description, name = None):
+    """
+    Queue an upload. Parameters are the same as Imgur.upload().
+
+    Returns
+    -------
+    dundergifflin.util.Job
+      The queued upload. Call result() on it to wait for the link.
+    """
+    return super(UploadExecutor, self).submit(self.imgur.upload, image, title, description, name)
+
+  def metrics(self):
+    """
+    Statistics about the uploads this executor has run in this process.
+
+    Returns
+    -------
+    dict
+      As WorkerPool.metrics(), where running includes uploads waiting on a rate limit, and:
+      rate_limit_wait : float
+        The seconds until used up credits reset, or 0.
+      credits : dict
+        The credits remaining, as from Imgur.credits().
+    """
+    metrics = super(UploadExecutor, self).metrics()
+    metrics["rate_limit_wait"] = self.imgur.rate_limit_wait()
+    metrics["credits"] = self.imgur.credits()
+    return metrics
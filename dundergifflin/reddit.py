@@ -7,26 +7,35 @@ import threading
 import time
 import traceback
 import multiprocessing
+import multiprocessing.pool
+import six
 
 class MentionCrawler(multiprocessing.Process):
   """
   A process that will crawl through a users' metnions.
 
+  Mentions are evaluated on a pool of concurrency threads, so a slow mention (such as one
+  waiting on a render) does not hold up the ones after it. The replies are handed back to
+  the crawling thread, which posts them, so only that thread ever talks to reddit.
+
   Parameters
   ----------
   reddit : praw.reddit
     The reddit instance
   mention_function : function(praw.Comment)
     The function to call on a mention that hasn't already been viewed.
+  concurrency : int
+    How many mentions to evaluate at once.
   """
   EVALUATION_INTERVAL = 30
-  def __init__(self, reddit, vote_function, mention_function, ignored_subreddits = []):
+  def __init__(self, reddit, vote_function, mention_function, ignored_subreddits = [], concurrency = 1):
     super(MentionCrawler, self).__init__()
     logger.debug("Creating mention crawler process.")
     self.reddit = reddit
     self.mention_function = mention_function
     self.vote_function = vote_function
     self.ignored_subreddits = [subreddit_name.lower() for subreddit_name in ignored_subreddits]
+    self.concurrency = max(1, int(concurrency))
     self.user = self.reddit.user.me()
     self.stopped = False
 
@@ -36,39 +45,103 @@ class MentionCrawler(multiprocessing.Process):
     """
     self.stopped = True
 
+  def evaluate(self, mention):
+    """
+    Calls the mention function against a mention, and queues the reply for the crawling thread.
+
+    Parameters
+    ----------
+    mention : praw.Comment
+      The mention to evaluate.
+    """
+    reply = None
+    try:
+      reply = self.mention_function(mention)
+    except Exception as ex:
+      logger.error("Caught exception evaluating mention ID '{0}'.\n{1}(): {2}\n{3}".format(
+        mention,
+        type(ex).__name__,
+        str(ex),
+        traceback.format_exc()
+      ))
+    self.replies.put((mention, reply))
+
+  def post_replies(self, wait = 0):
+    """
+    Posts the replies to evaluated mentions, waiting up to wait seconds for more to finish.
+
+    Parameters
+    ----------
+    wait : float
+      The number of seconds to keep waiting for replies for.
+    """
+    deadline = time.time() + wait
+    while True:
+      try:
+        mention, reply = self.replies.get(timeout = max(0, deadline - time.time())) if wait else self.replies.get_nowait()
+      except six.moves.queue.Empty:
+        return
+      self.pending.discard(mention.id)
+      if not reply:
+        continue
+      try:
+        logger.info("Replying to mention ID '{0}'.".format(mention))
+        mention.reply(reply)
+      except Exception as ex:
+        logger.error("Caught exception replying to mention ID '{0}'.\n{1}(): {2}\n{3}".format(
+          mention,
+          type(ex).__name__,
+          str(ex),
+          traceback.format_exc()
+        ))
+
   def run(self):
     """
     The processes "run" function.
     """
-    while not self.stopped:
-      for mention in self.reddit.inbox.mentions(limit = None):
-        logger.debug("Parsing mention ID {0} on subreddit '{1}'.".format(mention, mention.subreddit.display_name.lower()))
-        replied = False
+    self.replies = six.moves.queue.Queue()
+    self.pending = set()
+    pool = multiprocessing.pool.ThreadPool(self.concurrency)
+    try:
+      while not self.stopped:
         try:
-          if mention.subreddit.display_name.lower() in self.ignored_subreddits:
-            logger.debug("Ignoring mention in subreddit '{0}'.".format(mention.subreddit))
-            continue
-          mention.refresh()
-          for reply in mention.replies:
-            if reply.author is not None and reply.author.name == self.user.name:
-              logger.debug("Already replied to mention ID '{0}', ignoring.".format(mention))
-              replied = True
-              self.vote_function(reply)
-          if replied:
-            continue
-          reply = self.mention_function(mention)
-          if reply:
-            logger.info("Replying to mention ID '{0}'.".format(mention))
-            mention.reply(reply)
+          for mention in self.reddit.inbox.mentions(limit = None):
+            self.post_replies()
+            if mention.id in self.pending:
+              continue
+            logger.debug("Parsing mention ID {0} on subreddit '{1}'.".format(mention, mention.subreddit.display_name.lower()))
+            replied = False
+            try:
+              if mention.subreddit.display_name.lower() in self.ignored_subreddits:
+                logger.debug("Ignoring mention in subreddit '{0}'.".format(mention.subreddit))
+                continue
+              mention.refresh()
+              for reply in mention.replies:
+                if reply.author is not None and reply.author.name == self.user.name:
+                  logger.debug("Already replied to mention ID '{0}', ignoring.".format(mention))
+                  replied = True
+                  self.vote_function(reply)
+              if replied:
+                continue
+              self.pending.add(mention.id)
+              pool.apply_async(self.evaluate, (mention,))
+            except Exception as ex:
+              logger.error("Caught exception handling mention ID '{0}'.\n{1}(): {2}\n{3}".format(
+                mention,
+                type(ex).__name__,
+                str(ex),
+                traceback.format_exc()
+              ))
+              continue
         except Exception as ex:
-          logger.error("Caught exception handling mention ID '{0}'.\n{1}(): {2}\n{3}".format(
-            mention,
+          logger.error("Caught exception listing mentions.\n{0}(): {1}\n{2}".format(
             type(ex).__name__,
             str(ex),
-            traceback.format_exc(ex)
+            traceback.format_exc()
           ))
-          continue
-      time.sleep(MentionCrawler.EVALUATION_INTERVAL)
+        self.post_replies(MentionCrawler.EVALUATION_INTERVAL)
+    finally:
+      pool.terminate()
 
 class CommentCrawler(multiprocessing.Process):
   """
@@ -223,7 +296,7 @@ class CrawlerMonitor(threading.Thread):
         self.crawler.vote_crawler.start()
       if not self.crawler.mention_crawler.is_alive():
         logger.error("Mention crawler on client ID '{0}' stopped, restarting.".format(self.crawler.client_id))
-        self.crawler.mention_crawler = MentionCrawler(self.crawler.reddit, self.crawler.vote_function, self.crawler.mention_function, self.crawler.ignored_subreddits)
+        self.crawler.mention_crawler = MentionCrawler(self.crawler.reddit, self.crawler.vote_function, self.crawler.mention_function, self.crawler.ignored_subreddits, self.crawler.mention_concurrency)
         self.crawler.mention_crawler.start()
       for i, (subreddit_name, process) in enumerate(self.crawler.comment_crawlers):
         if not process.is_alive():
@@ -257,8 +330,10 @@ class RedditCrawler(object):
     The function to call against replies to your comments.
   subreddits : *list
     All of the subreddits to monitor.
+  mention_concurrency : int
+    How many mentions to evaluate at once. See MentionCrawler.
   """
-  def __init__(self, client_id, client_secret, username, password, user_agent, comment_function, vote_function, reply_function, mention_function, crawled_subreddits = [], ignored_subreddits = []):
+  def __init__(self, client_id, client_secret, username, password, user_agent, comment_function, vote_function, reply_function, mention_function, crawled_subreddits = [], ignored_subreddits = [], mention_concurrency = 1):
     logger.debug("Creating reddit crawler for client ID '{0}'. Will crawl subreddits {1}, and ignore subreddits {2}".format(client_id, crawled_subreddits, ignored_subreddits))
     self.username = username
     self.password = password
@@ -272,6 +347,7 @@ class RedditCrawler(object):
 
     self.crawled_subreddits = crawled_subreddits
     self.ignored_subreddits = ignored_subreddits
+    self.mention_concurrency = mention_concurrency
 
   def __enter__(self):
     logger.debug("Creating praw instance for client ID '{0}'.".format(self.client_id))
@@ -295,7 +371,7 @@ class RedditCrawler(object):
     self.vote_crawler = VoteCrawler(self.reddit, self.vote_function)
     self.vote_crawler.start()
 
-    self.mention_crawler = MentionCrawler(self.reddit, self.vote_function, self.mention_function, self.ignored_subreddits)
+    self.mention_crawler = MentionCrawler(self.reddit, self.vote_function, self.mention_function, self.ignored_subreddits, self.mention_concurrency)
     self.mention_crawler.start()
 
     self.monitor = CrawlerMonitor(self)
@@ -3,7 +3,115 @@
 from __future__ import unicode_literals, print_function
 import os
 import re
-from dundergifflin.util import Timestamp
+import sys
+import array
+import bisect
+import collections
+import six
+from dundergifflin.util import MillisecondTimestamp, logger
+
+TIMING_REGEX = re.compile(r"^(\d+):(\d+):(\d+)(?:[,.](\d+))?\s*-->\s*(\d+):(\d+):(\d+)(?:[,.](\d+))?")
+
+class SubtitleRecord(collections.namedtuple("SubtitleRecord", ["index", "start", "end", "text"])):
+  """
+  A compact subtitle, as yielded by iter_subtitles().
+
+  Parameters
+  ----------
+  index : int
+    The index of the subtitle in the file, or None if the block had none.
+  start : int
+    The start time of the subtitle, in milliseconds.
+  end : int
+    The end time of the subtitle, in milliseconds.
+  text : string
+    The text in the subtitle itself.
+  """
+  __slots__ = ()
+
+def _milliseconds(hours, minutes, seconds, fraction):
+  """
+  Internal. Converts the groups of TIMING_REGEX into milliseconds.
+  """
+  milliseconds = int(fraction.ljust(3, "0")[:3]) if fraction else 0
+  return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + milliseconds
+
+def _parse_block(lines, source):
+  """
+  Internal. Parses the lines of one subtitle block. Returns None for malformed blocks.
+  """
+  match = TIMING_REGEX.match(lines[0])
+  if match:
+    index, text_lines = None, lines[1:]
+  elif len(lines) > 1 and lines[0].isdigit():
+    match = TIMING_REGEX.match(lines[1])
+    index, text_lines = int(lines[0]), lines[2:]
+  if not match:
+    logger.warning("Skipping malformed subtitle block in '{0}': {1!r}".format(source, "\n".join(lines)))
+    return None
+  groups = match.groups()
+  return SubtitleRecord(
+    index,
+    _milliseconds(*groups[:4]),
+    _milliseconds(*groups[4:]),
+    "\n".join(text_lines)
+  )
+
+def iter_subtitles(path_or_fileobj, encoding = "UTF-8"):
+  """
+  Lazily parses a .srt subtitle file, yielding one SubtitleRecord per subtitle.
+
+  Only one block is held in memory at a time. Byte order marks and CRLF line endings are
+  accepted, and malformed blocks are logged and skipped rather than aborting the whole file.
+  A missing blank line between two subtitles is also tolerated.
+
+  Parameters
+  ----------
+  path_or_fileobj : string or file
+    The location of a .srt file, or an open file object (text or binary) to read from.
+  encoding : string
+    The encoding used to decode bytes read from the file. Undecodable bytes are replaced.
+
+  Returns
+  -------
+  generator
+    SubtitleRecord tuples, in the order they appear in the file.
+  """
+  if isinstance(path_or_fileobj, six.string_types):
+    source = path_or_fileobj
+    handle = open(path_or_fileobj, "rb")
+  else:
+    source = getattr(path_or_fileobj, "name", "<stream>")
+    handle = path_or_fileobj
+  try:
+    block = []
+    for line_number, line in enumerate(handle):
+      if isinstance(line, six.binary_type):
+        line = line.decode(encoding, "replace")
+      if line_number == 0:
+        line = line.lstrip("\ufeff")
+      line = line.strip()
+      if not line:
+        if block:
+          record = _parse_block(block, source)
+          if record is not None:
+            yield record
+          block = []
+        continue
+      if len(block) > 2 and block[-1].isdigit() and TIMING_REGEX.match(line):
+        record = _parse_block(block[:-1], source)
+        if record is not None:
+          yield record
+        block = block[-1:]
+      block.append(line)
+    if block:
+      record = _parse_block(block, source)
+      if record is not None:
+        yield record
+  finally:
+    if handle is not path_or_fileobj:
+      handle.close()
+
 
 class Subtitles(object):
   """
@@ -64,6 +172,168 @@ class Subtitles(object):
       The text in the subtitle itself.
     """
     def __init__(self, start, end, text):
-      self.start = Timestamp.from_string(start)
-      self.end = Timestamp.from_string(end)
+      self.start = MillisecondTimestamp.from_string(start)
+      self.end = MillisecondTimestamp.from_string(end)
       self.text = text
+
+class SubtitleColumns(object):
+  """
+  A compact, columnar store of an episode's subtitles.
+
+  Start and end times are held in integer millisecond arrays, and all text in a single
+  newline-joined string with an array of offsets into it, rather than one object per subtitle.
+  Since consecutive lines are adjacent in the text buffer, a window of lines concatenated
+  with newlines is a single slice.
+
+  Parameters
+  ----------
+  records : iterable
+    SubtitleRecord tuples (or any (index, start, end, text) tuples), such as those yielded by iter_subtitles().
+  """
+  def __init__(self, records = ()):
+    self.starts = array.array("i")
+    self.ends = array.array("i")
+    self.offsets = array.array("i", [0])
+    texts = []
+    for index, start, end, text in records:
+      self.starts.append(start)
+      self.ends.append(end)
+      self.offsets.append(self.offsets[-1] + len(text) + 1)
+      texts.append(text)
+    self.text = "".join([text + "\n" for text in texts])
+
+  @staticmethod
+  def from_file(path_or_fileobj, encoding = "UTF-8"):
+    """
+    Builds a store from a .srt file, using iter_subtitles().
+
+    Parameters
+    ----------
+    path_or_fileobj : string or file
+      The location of a .srt file, or an open file object.
+    encoding : string
+      The encoding used to decode bytes read from the file.
+    """
+    return SubtitleColumns(iter_subtitles(path_or_fileobj, encoding))
+
+  def __len__(self):
+    return len(self.starts)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(len(self))
+      if step != 1:
+        raise ValueError("SubtitleColumns does not support stepped slices.")
+      return SubtitleColumns([self[i] for i in range(start, stop)])
+    if key < 0:
+      key += len(self)
+    if not 0 <= key < len(self):
+      raise IndexError("Subtitle index out of range.")
+    return SubtitleRecord(key, self.starts[key], self.ends[key], self.text[self.offsets[key]:self.offsets[key+1]-1])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def window(self, start_index, end_index):
+    """
+    Concatenates a range of lines, as stored in the subtitles table.
+
+    Parameters
+    ----------
+    start_index : int
+      The index of the first line.
+    end_index : int
+      The index of the last line, inclusive.
+
+    Returns
+    -------
+    SubtitleRecord
+      The index is start_index, the start time that of the first line, the end time that of
+      the last line, and the text all lines joined with newlines.
+    """
+    if not 0 <= start_index <= end_index < len(self):
+      raise IndexError("Subtitle window {0}-{1} out of range.".format(start_index, end_index))
+    return SubtitleRecord(
+      start_index,
+      self.starts[start_index],
+      self.ends[end_index],
+      self.text[self.offsets[start_index]:self.offsets[end_index+1]-1]
+    )
+
+  def windows(self, concatenation_depth):
+    """
+    Generates every window of up to concatenation_depth lines.
+
+    Parameters
+    ----------
+    concatenation_depth : int
+      How many lines to concatenate together, at most.
+
+    Returns
+    -------
+    generator
+      Tuples of (start_index, end_index, start, end, text), all single lines first, then all
+      pairs of lines, and so on.
+    """
+    for j in range(concatenation_depth):
+      for i in range(len(self) - j):
+        yield (
+          i,
+          i + j,
+          self.starts[i],
+          self.ends[i+j],
+          self.text[self.offsets[i]:self.offsets[i+j+1]-1]
+        )
+
+  def index_at(self, milliseconds):
+    """
+    Finds the line displayed at a given time, with a binary search. Assumes lines are in order.
+
+    Parameters
+    ----------
+    milliseconds : int
+      The time to search for.
+
+    Returns
+    -------
+    int
+      The index of the line displayed at that time, or None if no line is displayed.
+    """
+    i = bisect.bisect_right(self.starts, int(milliseconds)) - 1
+    if i >= 0 and self.ends[i] >= milliseconds:
+      return i
+    return None
+
+  def indices_between(self, start, end):
+    """
+    Finds the lines that begin within a time range, with a binary search. Assumes lines are in order.
+
+    Parameters
+    ----------
+    start : int
+      The start of the range, in milliseconds.
+    end : int
+      The end of the range, in milliseconds, inclusive.
+
+    Returns
+    -------
+    range
+      The indices of the lines beginning within the range.
+    """
+    return range(bisect.bisect_left(self.starts, int(start)), bisect.bisect_right(self.starts, int(end)))
+
+  def nbytes(self):
+    """
+    The approximate memory used by this store.
+
+    Returns
+    -------
+    int
+      The size of the time and offset arrays and the text buffer, in bytes.
+    """
+    return sum([
+      column.itemsize * len(column)
+      for column
+      in [self.starts, self.ends, self.offsets]
+    ]) + sys.getsizeof(self.text)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+import collections
+
+from dundergifflin.util import logger
+
+class GifStore(object):
+  """
+  A content-addressed store of rendered GIFs on disk, bounded in size.
+
+  Files are named after the sha1 of their contents and kept under a two-character
+  prefix directory, so identical renders are only ever stored once. When the total size
+  of the store passes its limit, the least recently used files are removed; a file's
+  modification time is its last use, so the order survives restarts.
+
+  Several processes may share a store. Before evicting, the index is rebuilt from disk under
+  an exclusive lock on a file in the directory, so the size limit counts every process's files.
+
+  Parameters
+  ----------
+  directory : string
+    The directory to keep the store in. Will be created if it does not exist.
+  size : int
+    The maximum number of bytes to keep in the store.
+  """
+  EXTENSION = ".gif"
+  TEMPORARY_LIFETIME = 60 * 60
+  LOCK_FILENAME = ".lock"
+
+  def __init__(self, directory, size = 1024 * 1024 * 1024):
+    self.directory = directory
+    self.size = size
+    self.entries = collections.OrderedDict()
+    self.total_size = 0
+    self.lock = threading.Lock()
+    for path in [self.directory, os.path.join(self.directory, "tmp")]:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+    self._scan()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, digest):
+    return self.get(digest, touch = False) is not None
+
+  @staticmethod
+  def digest(path):
+    """
+    Determine the digest a file would be stored under.
+
+    Parameters
+    ----------
+    path : string
+      The path to the file.
+
+    Returns
+    -------
+    string
+      The hex sha1 of the file.
+    """
+    sha1_hash = hashlib.sha1()
+    with open(path, "rb") as handler:
+      for chunk in iter(lambda: handler.read(65536), b""):
+        sha1_hash.update(chunk)
+    return sha1_hash.hexdigest()
+
+  def path(self, digest):
+    """
+    The path a digest is stored at, whether or not it exists.
+
+    Parameters
+    ----------
+    digest : string
+      The hex sha1 of the file.
+
+    Returns
+    -------
+    string
+      The path to the file.
+    """
+    return os.path.join(self.directory, digest[:2], "{0}{1}".format(digest, GifStore.EXTENSION))
+
+  def temporary_path(self):
+    """
+    A unique path inside the store to render into, before calling put().
+
+    Being on the same filesystem means put() can move the file into place rather than copy it.
+
+    Returns
+    -------
+    string
+      A path that does not yet exist.
+    """
+    return os.path.join(self.directory, "tmp", "{0}{1}".format(uuid.uuid4().hex, GifStore.EXTENSION))
+
+  def get(self, digest, touch = True):
+    """
+    Look up a file in the store.
+
+    Parameters
+    ----------
+    digest : string
+      The hex sha1 of the file.
+    touch : boolean
+      Whether or not to mark the file as recently used.
+
+    Returns
+    -------
+    string
+      The path to the file, or None if it is not in the store.
+    """
+    if not digest:
+      return None
+    path = self.path(digest)
+    if not os.path.exists(path):
+      with self.lock:
+        self._forget(digest)
+      return None
+    if touch:
+      try:
+        os.utime(path, None)
+      except OSError:
+        return None
+      with self.lock:
+        if digest in self.entries:
+          self.entries[digest] = self.entries.pop(digest)
+        else:
+          self._remember(digest, os.path.getsize(path))
+    return path
+
+  def put(self, source, move = True):
+    """
+    Add a file to the store, evicting the least recently used files if needed.
+
+    Parameters
+    ----------
+    source : string
+      The path to the file to add.
+    move : boolean
+      Whether to move the file into the store, or leave it in place and copy it.
+
+    Returns
+    -------
+    string
+      The digest the file is stored under.
+    """
+    digest = GifStore.digest(source)
+    path = self.path(digest)
+    if os.path.exists(path):
+      if move:
+        os.remove(source)
+      self.get(digest)
+      return digest
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError as ex:
+        if ex.errno != errno.EEXIST:
+          raise
+    if move:
+      shutil.move(source, path)
+    else:
+      shutil.copyfile(source, path)
+    with self.lock:
+      self._remember(digest, os.path.getsize(path))
+    self._evict()
+    return digest
+
+  def put_data(self, data):
+    """
+    Add a file to the store from its contents, evicting the least recently used files if needed.
+
+    Nothing is written if the contents are already stored.
+
+    Parameters
+    ----------
+    data : bytes
+      The contents of the file.
+
+    Returns
+    -------
+    string
+      The digest the file is stored under.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    if self.get(digest) is not None:
+      return digest
+    temporary_path = self.temporary_path()
+    with open(temporary_path, "wb") as handler:
+      handler.write(data)
+    return self.put(temporary_path)
+
+  def remove(self, digest):
+    """
+    Remove a file from the store, if present.
+
+    Parameters
+    ----------
+    digest : string
+      The hex sha1 of the file.
+    """
+    with self.lock:
+      self._forget(digest)
+    try:
+      os.remove(self.path(digest))
+    except OSError as ex:
+      if ex.errno != errno.ENOENT:
+        raise
+
+  def _remember(self, digest, size):
+    """
+    Internal. Records a file as the most recently used. Must hold the lock.
+    """
+    self._forget(digest)
+    self.entries[digest] = size
+    self.total_size += size
+
+  def _forget(self, digest):
+    """
+    Internal. Removes a file from the index. Must hold the lock.
+    """
+    size = self.entries.pop(digest, None)
+    if size is not None:
+      self.total_size -= size
+
+  def _evict(self):
+    """
+    Internal. Removes least recently used files until the store fits.
+
+    Holds the lock file while it works, and re-indexes the files on disk first, so files
+    added by other processes count towards the size. Always keeps the most recently used
+    file, even if it alone is larger than the store.
+    """
+    with self.lock:
+      with open(os.path.join(self.directory, GifStore.LOCK_FILENAME), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self._index()
+        while self.total_size > self.size and len(self.entries) > 1:
+          digest, size = self.entries.popitem(last = False)
+          self.total_size -= size
+          logger.debug("Evicting {0} from GIF store ({1} bytes).".format(digest, size))
+          try:
+            os.remove(self.path(digest))
+          except OSError as ex:
+            if ex.errno != errno.ENOENT:
+              raise
+
+  def _index(self):
+    """
+    Internal. Rebuilds the index from the files on disk, oldest first. Must hold the lock.
+    """
+    found = []
+    for prefix in os.listdir(self.directory):
+      prefix_directory = os.path.join(self.directory, prefix)
+      if prefix == "tmp" or not os.path.isdir(prefix_directory):
+        continue
+      for filename in os.listdir(prefix_directory):
+        if not filename.endswith(GifStore.EXTENSION):
+          continue
+        try:
+          stat = os.stat(os.path.join(prefix_directory, filename))
+        except OSError as ex:
+          if ex.errno != errno.ENOENT:
+            raise
+          continue
+        found.append((stat.st_mtime, filename[:-len(GifStore.EXTENSION)], stat.st_size))
+    found.sort()
+    self.entries = collections.OrderedDict()
+    self.total_size = 0
+    for mtime, digest, size in found:
+      self._remember(digest, size)
+
+  def _scan(self):
+    """
+    Internal. Indexes the files already on disk, evicting any over the limit, and removes
+    temporary files abandoned for longer than TEMPORARY_LIFETIME seconds.
+    """
+    temporary_directory = os.path.join(self.directory, "tmp")
+    for filename in os.listdir(temporary_directory):
+      temporary_path = os.path.join(temporary_directory, filename)
+      try:
+        if os.path.getmtime(temporary_path) < time.time() - GifStore.TEMPORARY_LIFETIME:
+          os.remove(temporary_path)
+      except OSError as ex:
+        if ex.errno != errno.ENOENT:
+          raise
+    self._evict()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function
+import re
+import array
+import heapq
+import bisect
+import six
+
+WORD_REGEX = re.compile(r"[^\W_]+", re.UNICODE)
+
+def trigrams(text):
+  """
+  Extracts the set of trigrams of a string, the same way pg_trgm does.
+
+  The text is lowercased and split into words of alphanumeric characters. Each word is
+  padded with two spaces in front and one behind before being cut into trigrams.
+
+  Parameters
+  ----------
+  text : string
+    The text to extract trigrams from. Bytes are decoded as UTF-8.
+
+  Returns
+  -------
+  set
+    The unique trigrams in the text.
+  """
+  if isinstance(text, six.binary_type):
+    text = text.decode("UTF-8", "replace")
+  result = set()
+  for word in WORD_REGEX.findall(text.lower()):
+    padded = "  " + word + " "
+    for i in range(len(padded) - 2):
+      result.add(padded[i:i+3])
+  return result
+
+def normalize(text):
+  """
+  Normalizes text for use as a cache key: lowercased, with punctuation removed and
+  whitespace collapsed. Texts that normalize the same have the same trigrams, so they
+  get the same search results.
+
+  Parameters
+  ----------
+  text : string
+    The text to normalize. Bytes are decoded as UTF-8.
+
+  Returns
+  -------
+  string
+    The words of the text, lowercased and separated by single spaces.
+  """
+  if isinstance(text, six.binary_type):
+    text = text.decode("UTF-8", "replace")
+  return " ".join(WORD_REGEX.findall(text.lower()))
+
+def similarity(a, b):
+  """
+  The pg_trgm similarity between two trigram sets: shared trigrams over all trigrams.
+
+  Parameters
+  ----------
+  a : set
+    The trigrams of the first string.
+  b : set
+    The trigrams of the second string.
+
+  Returns
+  -------
+  float
+    Between 0 (nothing shared) and 1 (the same trigrams).
+  """
+  if not a or not b:
+    return 0.0
+  shared = len(a & b)
+  return shared / float(len(a) + len(b) - shared)
+
+class TrigramIndex(object):
+  """
+  An in-memory trigram inverted index, a stand-in for a pg_trgm GIST index.
+
+  Ranks rows the same way as ordering by pg_trgm's "<->" operator, filtered by the "%" operator
+  at the default similarity threshold.
+
+  To keep lookups fast, candidates are only gathered from the rarest query trigrams: a row
+  that shares none of them cannot reach the threshold. Rows are scored from the posting
+  lists alone; each row's trigram count is kept when it is added, and the trigrams it shares
+  with the query are counted while merging postings, so no row is ever re-tokenized. Posting
+  lists are sorted by row, so common trigrams (those of short, frequent words) are checked
+  by bisecting rather than scanning their whole list.
+
+  Parameters
+  ----------
+  rows : iterable
+    Tuples to index. The text to index is taken from the last element of each tuple.
+  threshold : float
+    The minimum similarity for a row to be returned. pg_trgm's default is 0.3.
+  """
+  def __init__(self, rows = (), threshold = 0.3):
+    self.threshold = threshold
+    self.rows = []
+    self.sizes = array.array("i")
+    self.postings = {}
+    for row in rows:
+      self.add(row)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def add(self, row):
+    """
+    Adds a row to the index.
+
+    Parameters
+    ----------
+    row : tuple
+      The row to add. The text to index is its last element.
+    """
+    row_id = len(self.rows)
+    row_trigrams = trigrams(row[-1])
+    self.rows.append(row)
+    self.sizes.append(len(row_trigrams))
+    for trigram in row_trigrams:
+      if trigram not in self.postings:
+        self.postings[trigram] = array.array("i")
+      self.postings[trigram].append(row_id)
+
+  def search(self, text, limit = 10):
+    """
+    Find the rows most similar to a line of text.
+
+    Parameters
+    ----------
+    text : string
+      The text to search for.
+    limit : int
+      The number of rows to return.
+
+    Returns
+    -------
+    list
+      Tuples of (row, likeness), in descending order of likeness.
+    """
+    query = trigrams(text)
+    if not query:
+      return []
+    minimum_shared = max(1, int(self.threshold * len(query)))
+    rarest = sorted(query, key = lambda trigram: len(self.postings.get(trigram, ())))
+    cutoff = len(query) - minimum_shared + 1
+    shared = {}
+    for trigram in rarest[:cutoff]:
+      for row_id in self.postings.get(trigram, ()):
+        shared[row_id] = shared.get(row_id, 0) + 1
+    if not shared:
+      return []
+    candidates = sorted(shared)
+    for trigram in rarest[cutoff:]:
+      posting = self.postings.get(trigram, ())
+      if len(candidates) * 16 < len(posting):
+        for row_id in candidates:
+          i = bisect.bisect_left(posting, row_id)
+          if i < len(posting) and posting[i] == row_id:
+            shared[row_id] += 1
+      else:
+        for row_id in posting:
+          if row_id in shared:
+            shared[row_id] += 1
+    scored = []
+    for row_id, count in shared.items():
+      likeness = count / float(len(query) + self.sizes[row_id] - count)
+      if likeness >= self.threshold:
+        scored.append((likeness, -row_id))
+    return [
+      (self.rows[-negative_row_id], likeness)
+      for likeness, negative_row_id
+      in heapq.nlargest(limit, scored)
+    ]
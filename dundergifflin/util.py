@@ -6,7 +6,12 @@ import sys
 import hashlib
 import six
 import os
+import re
+import time
 import errno
+import operator
+import threading
+import collections
 
 try:
   from urllib import urlencode
@@ -34,13 +39,13 @@ class Timestamp(object):
     The number of hours in this timestamp.
   """
   def __init__(self, milliseconds = 0, seconds = 0, minutes = 0, hours = 0):
-    if milliseconds > 1000:
+    if milliseconds >= 1000:
       seconds += milliseconds // 1000
       milliseconds = milliseconds % 1000
-    if seconds > 60:
+    if seconds >= 60:
       minutes += seconds // 60
       seconds = seconds % 60
-    if minutes > 60:
+    if minutes >= 60:
       hours += minutes // 60
       minutes = minutes % 60
     self.milliseconds = milliseconds
@@ -94,27 +99,486 @@ class Timestamp(object):
     return float(self.seconds + (self.minutes * 60) + (self.hours * 60 * 60)) + float(self.milliseconds / 1000.00)
 
   def __add__(self, b):
-    total_difference = self.total_seconds() + b.total_seconds()
-    sec_part = int(total_difference)
-    ms_part = int((float(total_difference) - total_difference) * 1000)
-    return Timestamp(ms_part, sec_part)
+    return Timestamp(int(round((self.total_seconds() + b.total_seconds()) * 1000)))
 
   def __sub__(self, b):
     total_difference = self.total_seconds() - b.total_seconds()
     if total_difference < 0:
       return Timestamp()
-    sec_part = int(total_difference)
-    ms_part = int((float(total_difference) - total_difference) * 1000)
-    return Timestamp(ms_part, sec_part)
+    return Timestamp(int(round(total_difference * 1000)))
 
   def __repr__(self):
-    return "{0:02d}:{1:02d}:{2:02d}.{3:<04d}".format(
+    return "{0:02d}:{1:02d}:{2:02d}.{3:03d}".format(
       self.hours,
       self.minutes,
       self.seconds,
       self.milliseconds
     )
 
+class MillisecondTimestamp(object):
+  """
+  A compact timestamp, backed by a single integer count of milliseconds.
+
+  Offers the same interface as Timestamp, but does not normalize or store separate
+  fields, and arithmetic and comparison are done on integers.
+
+  Parameters
+  ----------
+  total_milliseconds : int
+    The number of milliseconds in this timestamp.
+  """
+  __slots__ = ("total_milliseconds",)
+
+  STRING_REGEX = re.compile(r"^\s*(?:(?:(\d+):)?(\d+):)?(\d+)(?:[.,](\d+))?\s*$")
+
+  def __init__(self, total_milliseconds = 0):
+    self.total_milliseconds = int(total_milliseconds)
+
+  @staticmethod
+  def _text(string):
+    """
+    Internal. Converts a timestamp (or bytes read from a file) to unicode.
+    """
+    if isinstance(string, six.binary_type):
+      return string.decode("UTF-8")
+    return six.text_type(string)
+
+  @staticmethod
+  def _from_groups(hours, minutes, seconds, fraction):
+    """
+    Internal. Builds a timestamp from the groups of STRING_REGEX.
+    """
+    milliseconds = int(fraction.ljust(3, "0")[:3]) if fraction else 0
+    return MillisecondTimestamp(
+      ((int(hours or 0) * 60 + int(minutes or 0)) * 60 + int(seconds)) * 1000 + milliseconds
+    )
+
+  @staticmethod
+  def from_string(string):
+    """
+    Builds a timestamp object from a string.
+
+    Parameters
+    ----------
+    string : string
+      A string in the form of "HH:MM:SS.fff" (or "HH:MM:SS,fff"). Can omit from right to left.
+    """
+    match = MillisecondTimestamp.STRING_REGEX.match(MillisecondTimestamp._text(string))
+    if not match:
+      raise ValueError("Could not parse timestamp '{0}'.".format(string))
+    return MillisecondTimestamp._from_groups(*match.groups())
+
+  @staticmethod
+  def from_seconds(seconds):
+    """
+    Builds a timestamp object from a number of seconds.
+
+    Parameters
+    ----------
+    seconds : float or decimal.Decimal
+      The number of seconds, as stored in the subtitles table.
+    """
+    return MillisecondTimestamp(int(round(float(seconds) * 1000)))
+
+  @property
+  def hours(self):
+    return self.total_milliseconds // 3600000
+
+  @property
+  def minutes(self):
+    return (self.total_milliseconds // 60000) % 60
+
+  @property
+  def seconds(self):
+    return (self.total_milliseconds // 1000) % 60
+
+  @property
+  def milliseconds(self):
+    return self.total_milliseconds % 1000
+
+  def total_seconds(self):
+    """
+    The total seconds in a timestamp.
+
+    Returns
+    -------
+    float
+      The total number of seconds represented by a timestamp.
+    """
+    return self.total_milliseconds / 1000.0
+
+  def __add__(self, b):
+    return MillisecondTimestamp(self.total_milliseconds + int(b))
+
+  def __sub__(self, b):
+    return MillisecondTimestamp(max(0, self.total_milliseconds - int(b)))
+
+  def __int__(self):
+    return self.total_milliseconds
+
+  def _compare(self, b, comparison):
+    """
+    Internal. Compares with another MillisecondTimestamp, or defers to the other operand.
+    """
+    if not isinstance(b, MillisecondTimestamp):
+      return NotImplemented
+    return comparison(self.total_milliseconds, b.total_milliseconds)
+
+  def __eq__(self, b):
+    return self._compare(b, operator.eq)
+
+  def __ne__(self, b):
+    return self._compare(b, operator.ne)
+
+  def __lt__(self, b):
+    return self._compare(b, operator.lt)
+
+  def __le__(self, b):
+    return self._compare(b, operator.le)
+
+  def __gt__(self, b):
+    return self._compare(b, operator.gt)
+
+  def __ge__(self, b):
+    return self._compare(b, operator.ge)
+
+  def __hash__(self):
+    return hash(self.total_milliseconds)
+
+  def __repr__(self):
+    return "{0:02d}:{1:02d}:{2:02d}.{3:03d}".format(
+      self.hours,
+      self.minutes,
+      self.seconds,
+      self.milliseconds
+    )
+
+class LRUCache(object):
+  """
+  A bounded, thread-safe, least-recently-used cache, with optional expiry.
+
+  Counts hits and misses, so the effectiveness of a cache can be reported.
+
+  Parameters
+  ----------
+  size : int
+    The maximum number of entries. The least recently used entry is evicted past this.
+  ttl : float
+    The default number of seconds an entry is valid for. None means entries only leave
+    the cache through eviction or invalidation.
+  """
+  def __init__(self, size = 1000, ttl = None):
+    self.size = size
+    self.ttl = ttl
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default = None):
+    """
+    Retrieve a value from the cache. Expired entries are evicted when found.
+
+    Parameters
+    ----------
+    key : object
+      The hashable key to look up.
+    default : object
+      What to return on a miss.
+
+    Returns
+    -------
+    object
+      The cached value, or the default.
+    """
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+        self.misses += 1
+        return default
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, ttl = None):
+    """
+    Store a value in the cache.
+
+    Parameters
+    ----------
+    key : object
+      The hashable key to store the value under.
+    value : object
+      The value to store.
+    ttl : float
+      The number of seconds this entry is valid for, if different from the cache's default.
+    """
+    ttl = self.ttl if ttl is None else ttl
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (value, time.time() + ttl if ttl is not None else None)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last = False)
+
+  def invalidate(self, key):
+    """
+    Remove a key from the cache, if present.
+
+    Parameters
+    ----------
+    key : object
+      The hashable key to remove.
+    """
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    """
+    Remove every entry from the cache. Does not reset the hit and miss counters.
+    """
+    with self.lock:
+      self.entries.clear()
+
+  def hit_rate(self):
+    """
+    The fraction of lookups that were hits.
+
+    Returns
+    -------
+    float
+      Between 0 and 1. 0 if there have been no lookups.
+    """
+    lookups = self.hits + self.misses
+    return self.hits / float(lookups) if lookups else 0.0
+
+class Job(object):
+  """
+  A call queued on a WorkerPool, in the manner of a future.
+
+  Parameters
+  ----------
+  function : function
+    The function to call.
+  *args : list
+    The arguments to call it with.
+  """
+  def __init__(self, function, *args):
+    self.function = function
+    self.args = args
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+    self.output = None
+    self.exception = None
+    self._done = threading.Event()
+
+  def done(self):
+    """
+    Whether or not the job has finished, successfully or not.
+    """
+    return self._done.is_set()
+
+  def result(self, timeout = None):
+    """
+    Waits for the job to finish.
+
+    Parameters
+    ----------
+    timeout : float
+      The number of seconds to wait for. None waits forever.
+
+    Returns
+    -------
+    object
+      What the function returned.
+
+    Raises
+    ------
+    IOError
+      If the job does not finish within the timeout.
+    Exception
+      Whatever the function raised.
+    """
+    if not self._done.wait(timeout):
+      raise IOError("Job did not finish within {0} second(s).".format(timeout))
+    if self.exception is not None:
+      raise self.exception
+    return self.output
+
+  def _run(self):
+    """
+    Internal. Calls the function, recording its result.
+    """
+    self.started = time.time()
+    try:
+      self.output = self.function(*self.args)
+    except Exception as ex:
+      self.exception = ex
+    self.finished = time.time()
+    self._done.set()
+
+class WorkerPool(object):
+  """
+  A bounded pool of threads that run queued calls, in the order they were submitted.
+
+  The worker threads are started on the first submit() in each process, so a pool
+  created before forking can be used on either side of the fork. Each process gets its own
+  threads, queue, and metrics.
+
+  Subclasses can override _execute() to wrap each call, and _finished() to record more
+  metrics.
+
+  Parameters
+  ----------
+  size : int
+    The number of calls to run at once.
+  name : string
+    What the pool runs, for log messages.
+  """
+  LATENCY_SAMPLES = 100
+
+  def __init__(self, size = 2, name = "Job"):
+    self.size = max(1, int(size))
+    self.name = name
+    self.lock = threading.Lock()
+    self._pid = None
+    self._reset()
+
+  def _reset(self):
+    """
+    Internal. Creates a fresh queue and metrics, discarding anything inherited from a parent process.
+    """
+    self.queue = six.moves.queue.Queue()
+    self.threads = []
+    self.running = 0
+    self.completed = 0
+    self.failed = 0
+    self.waits = collections.deque(maxlen = WorkerPool.LATENCY_SAMPLES)
+    self.runs = collections.deque(maxlen = WorkerPool.LATENCY_SAMPLES)
+
+  def submit(self, function, *args):
+    """
+    Queue a call.
+
+    Parameters
+    ----------
+    function : function
+      The function to call.
+    *args : list
+      The arguments to call it with.
+
+    Returns
+    -------
+    Job
+      The queued job. Call result() on it to wait for what the function returns.
+    """
+    self._start()
+    job = Job(function, *args)
+    self.queue.put(job)
+    return job
+
+  def queue_depth(self):
+    """
+    The number of jobs waiting for a worker.
+
+    Returns
+    -------
+    int
+      The number of queued jobs, not counting running ones.
+    """
+    return self.queue.qsize()
+
+  def metrics(self):
+    """
+    Statistics about the jobs this pool has run in this process.
+
+    Returns
+    -------
+    dict
+      queued : int
+        Jobs waiting for a worker.
+      running : int
+        Jobs currently running.
+      completed : int
+        Jobs that have finished successfully.
+      failed : int
+        Jobs that have failed.
+      wait : float
+        The mean seconds recent jobs waited in the queue.
+      run : float
+        The mean seconds recent jobs took to run.
+    """
+    with self.lock:
+      return {
+        "queued": self.queue_depth(),
+        "running": self.running,
+        "completed": self.completed,
+        "failed": self.failed,
+        "wait": sum(self.waits) / len(self.waits) if self.waits else 0.0,
+        "run": sum(self.runs) / len(self.runs) if self.runs else 0.0
+      }
+
+  def _start(self):
+    """
+    Internal. Starts the worker threads, if they are not running in this process.
+    """
+    with self.lock:
+      if self._pid == os.getpid():
+        return
+      self._reset()
+      self._pid = os.getpid()
+      for i in range(self.size):
+        thread = threading.Thread(target = self._run)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+  def _execute(self, job):
+    """
+    Internal. Runs one job on a worker thread.
+    """
+    job._run()
+
+  def _finished(self, job):
+    """
+    Internal. Records a finished job in the metrics. Must hold the lock.
+    """
+    self.waits.append(job.started - job.submitted)
+    self.runs.append(job.finished - job.started)
+    if job.exception is None:
+      self.completed += 1
+    else:
+      self.failed += 1
+
+  def _run(self):
+    """
+    Internal. A worker thread's loop.
+    """
+    while True:
+      job = self.queue.get()
+      with self.lock:
+        self.running += 1
+      self._execute(job)
+      with self.lock:
+        self.running -= 1
+        self._finished(job)
+      if job.exception is not None:
+        logger.error("{0} failed after {1:.1f} second(s).\n{2}(): {3}".format(
+          self.name,
+          job.finished - job.started,
+          type(job.exception).__name__,
+          str(job.exception)
+        ))
+      else:
+        logger.debug("{0} finished in {1:.1f} second(s), after waiting {2:.1f} second(s).".format(
+          self.name,
+          job.finished - job.started,
+          job.started - job.submitted
+        ))
+
 def flatten(*lists):
   """
   Flattens multiple lists into one list.
@@ -137,6 +601,28 @@ def flatten(*lists):
       return_value.append(l)
   return return_value
 
+def unique(items):
+  """
+  Removes duplicates from a list, keeping the first occurrence of each item.
+
+  Parameters
+  ----------
+  items : iterable
+    Hashable items.
+
+  Returns
+  -------
+  list
+    The unique items, in their original order.
+  """
+  seen = set()
+  return_value = []
+  for item in items:
+    if item not in seen:
+      seen.add(item)
+      return_value.append(item)
+  return return_value
+
 def md5sum(path):
   """
   Determine the md5sum of a file.
@@ -157,6 +643,23 @@ def md5sum(path):
       md5_hash.update(chunk)
   return md5_hash.hexdigest()
 
+def stat_signature(path):
+  """
+  Get a cheap signature of a file, used to detect changes without reading it.
+
+  Parameters
+  ----------
+  path : string
+    The path to the file. Can be absolute or relative to the cwd at execution.
+
+  Returns
+  -------
+  tuple
+    The (mtime, size, inode) of the file.
+  """
+  stat = os.stat(path)
+  return (stat.st_mtime, stat.st_size, stat.st_ino)
+
 def url_join(*args):
   """
   Joins arguments together into a URL. Similar to os.path.join.
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import traceback
+import multiprocessing
+import multiprocessing.pool
+
+from dundergifflin.util import logger
+
+class WarmupWorker(multiprocessing.Process):
+  """
+  A low-priority process that periodically does work ahead of time, such as rendering
+  and uploading popular lines before anyone asks for them.
+
+  Each round, candidate_function is called for the items to work on, and work_function
+  is called against each of them, concurrency at a time. The process lowers its own
+  scheduling priority by niceness, and after each item, the thread that worked on it
+  sleeps long enough that it is only busy for cpu_budget of its time. This bounds
+  the work to roughly concurrency * cpu_budget processors, including any
+  subprocesses (such as ffmpeg) that work_function waits on.
+
+  Parameters
+  ----------
+  candidate_function : function() returns list
+    The function to call at the start of each round for the items to work on.
+  work_function : function(object)
+    The function to call against each item.
+  concurrency : int
+    How many items to work on at once.
+  cpu_budget : float
+    The fraction of time, between 0 and 1, each concurrent worker may spend working.
+  interval : int
+    The number of seconds between the start of each round.
+  niceness : int
+    How much to lower the priority of the process by.
+  """
+  def __init__(self, candidate_function, work_function, concurrency = 1, cpu_budget = 0.25, interval = 60 * 60, niceness = 10):
+    super(WarmupWorker, self).__init__()
+    logger.debug("Creating warm-up worker process.")
+    self.candidate_function = candidate_function
+    self.work_function = work_function
+    self.concurrency = max(1, int(concurrency))
+    self.cpu_budget = min(1.0, max(0.01, float(cpu_budget)))
+    self.interval = interval
+    self.niceness = niceness
+    self.daemon = True
+    self.stopped = False
+
+  def stop(self):
+    """
+    Marks the worker as stopped.
+    """
+    self.stopped = True
+
+  def work(self, item):
+    """
+    Calls the work function against one item, then sleeps off the rest of the budget.
+
+    Parameters
+    ----------
+    item : object
+      One of the items returned by the candidate function.
+
+    Returns
+    -------
+    boolean
+      Whether or not the work function succeeded.
+    """
+    start = time.time()
+    try:
+      self.work_function(item)
+      succeeded = True
+    except Exception as ex:
+      logger.error("Warm-up failed for {0}.\n{1}(): {2}\n{3}".format(
+        item,
+        type(ex).__name__,
+        str(ex),
+        traceback.format_exc()
+      ))
+      succeeded = False
+    elapsed = time.time() - start
+    time.sleep(elapsed * (1.0 - self.cpu_budget) / self.cpu_budget)
+    return succeeded
+
+  def run(self):
+    """
+    The processes "run" method. Works through the candidates every interval.
+    """
+    logger.info("Warm-up worker process executing.")
+    if self.niceness:
+      os.nice(self.niceness)
+    pool = multiprocessing.pool.ThreadPool(self.concurrency)
+    try:
+      while not self.stopped:
+        start = time.time()
+        try:
+          candidates = list(self.candidate_function())
+        except Exception as ex:
+          logger.error("Could not find warm-up candidates.\n{0}(): {1}\n{2}".format(
+            type(ex).__name__,
+            str(ex),
+            traceback.format_exc()
+          ))
+          candidates = []
+        if candidates:
+          logger.info("Warming up {0} item(s).".format(len(candidates)))
+          succeeded = sum(pool.imap_unordered(self.work, candidates))
+          logger.info("Warmed up {0} of {1} item(s) in {2:.1f} second(s).".format(succeeded, len(candidates), time.time() - start))
+        time.sleep(max(0, self.interval - (time.time() - start)))
+    finally:
+      pool.terminate()
@@ -4,6 +4,7 @@ from __future__ import unicode_literals, print_function
 
 import sys
 import os
+import io
 import itertools
 import re
 import time
@@ -12,13 +13,17 @@ import dundergifflin
 import logging
 import six
 import random
+import threading
+import hashlib
 
-from dundergifflin.ffmpeg import SubtitleConverter
+from dundergifflin.ffmpeg import SubtitleConverter, RenderPool, keyframe_window, extract_clip, prune_clips, find_proxy
 from dundergifflin.config import Configuration
-from dundergifflin.util import Timestamp, logger
+from dundergifflin.util import MillisecondTimestamp, stat_signature, logger
 from dundergifflin.database import DunderDatabase
 from dundergifflin.reddit import RedditCrawler
-from dundergifflin.imgur import Imgur
+from dundergifflin.imgur import Imgur, UploadExecutor, HTTP_ENDPOINT
+from dundergifflin.store import GifStore
+from dundergifflin.warmup import WarmupWorker
 from dundergifflin.smtp_alert import SMTPAlert
 
 body_search_regex = re.compile(r"[«‹»›„‚“‟‘‛”’\"❛❜❟❝❞❮❯⹂〝〞〟＂<>\[\]](.*?)[«‹»›„‚“‟‘‛”’\"❛❜❟❝❞❮❯⹂〝〞〟＂<>\[\]]")
@@ -38,10 +43,16 @@ if not os.path.exists(configuration_file):
   sys.stderr.flush()
   sys.exit(5)
 
+def episode_path(season, episode):
+  return os.path.join(configuration_directory, "media", "office", "S{0:02d}".format(season), "E{0:02d}.mkv".format(episode))
+
+def render_source(season, episode):
+  return find_proxy(episode_path(season, episode)) or episode_path(season, episode)
+
 class OfficeConverter(SubtitleConverter):
-  def __init__(self, season, episode, output_file, start, end, text):
+  def __init__(self, season, episode, output_file, start, end, text, input_file = None):
     super(OfficeConverter, self).__init__(
-      os.path.join(configuration_directory, "media", "office", "S{0:02d}".format(season), "E{0:02d}.mkv".format(episode)),
+      input_file if input_file is not None else render_source(season, episode),
       output_file,
       True,
       start,
@@ -52,7 +63,11 @@ class OfficeConverter(SubtitleConverter):
       configuration.TEXT_COLOR,
       configuration.TEXT_SIZE_MAX,
       configuration.TEXT_OFFSET,
-      configuration.TEXT_STROKE_WIDTH
+      configuration.TEXT_STROKE_WIDTH,
+      configuration.IMAGE_FPS or None,
+      configuration.IMAGE_PALETTE,
+      configuration.IMAGE_MAX_SIZE or None,
+      configuration.TEXT_STROKE_METHOD
     )
 
 class OfficeConfiguration(Configuration):
@@ -77,14 +92,53 @@ class OfficeConfiguration(Configuration):
     "REDDIT_IGNORED_SUBREDDITS",
     "REDDIT_MINIMUM_LIKENESS"
   ]
+  DEFAULTS = {
+    "IMAGE_FPS": 0,
+    "IMAGE_PALETTE": True,
+    "IMAGE_MAX_SIZE": 0,
+    "TEXT_STROKE_METHOD": "border",
+    "DATABASE_CRAWL_WORKERS": 1,
+    "DATABASE_SEARCH_BACKEND": "postgres",
+    "DATABASE_POOL_SIZE": 0,
+    "RENDER_CACHE_DIRECTORY": os.path.join(configuration_directory, "renders"),
+    "RENDER_CACHE_SIZE": 1024 * 1024 * 1024,
+    "RENDER_WORKERS": 2,
+    "RENDER_TIMEOUT": 120,
+    "CLIP_DIRECTORY": os.path.join(configuration_directory, "clips"),
+    "CLIP_CACHE_SIZE": 1024 * 1024 * 1024,
+    "IMGUR_API_ENDPOINT": HTTP_ENDPOINT,
+    "IMGUR_UPLOAD_WORKERS": 2,
+    "REDDIT_MENTION_WORKERS": 2,
+    "WARMUP_COUNT": 0,
+    "WARMUP_CONCURRENCY": 1,
+    "WARMUP_CPU_BUDGET": 0.25,
+    "WARMUP_INTERVAL": 60 * 60,
+    "WARMUP_NICENESS": 10
+  }
   def __init__(self, configuration_file):
     super(OfficeConfiguration, self).__init__(configuration_file)
     for required_key in OfficeConfiguration.REQUIRED_KEYS:
       if not hasattr(self, required_key):
         raise Exception("Required key '{0}' missing from configuration.".format(required_key))
+    for default_key, default_value in six.iteritems(OfficeConfiguration.DEFAULTS):
+      if not hasattr(self, default_key):
+        setattr(self, default_key, default_value)
     
 configuration = OfficeConfiguration(configuration_file)
 
+render_settings_hash = SubtitleConverter.settings_hash(
+  configuration.IMAGE_WIDTH,
+  configuration.TEXT_FONT,
+  configuration.TEXT_COLOR,
+  configuration.TEXT_SIZE_MAX,
+  configuration.TEXT_OFFSET,
+  configuration.TEXT_STROKE_WIDTH,
+  configuration.IMAGE_FPS or None,
+  configuration.IMAGE_PALETTE,
+  configuration.IMAGE_MAX_SIZE or None,
+  configuration.TEXT_STROKE_METHOD
+)
+
 def format_comment(url, text, season, episode, start_index, end_index, comment_count, comment_score, uses, likeness, episode_title):
   return """>[{0:s}]({1:s})
 
@@ -118,6 +172,13 @@ def main(conn = None, logger = None):
     configuration.EMAIL_ALERT_USE_TLS
   )
 
+  status_lock = threading.Lock()
+
+  def send_status(status):
+    if conn is not None:
+      with status_lock:
+        conn.send(status)
+
   try:
     with DunderDatabase(
       configuration.DATABASE_HOST,
@@ -126,28 +187,51 @@ def main(conn = None, logger = None):
       configuration.DATABASE_USER,
       configuration.DATABASE_PASSWORD,
       os.path.join(configuration_directory, "media", "office"),
-      configuration.DATABASE_CONCATENATION_DEPTH
+      configuration.DATABASE_CONCATENATION_DEPTH,
+      crawl_workers = configuration.DATABASE_CRAWL_WORKERS,
+      search_backend = configuration.DATABASE_SEARCH_BACKEND,
+      pool_size = configuration.DATABASE_POOL_SIZE
     ) as database:
 
+      gif_store = GifStore(configuration.RENDER_CACHE_DIRECTORY, configuration.RENDER_CACHE_SIZE) if configuration.RENDER_CACHE_SIZE > 0 else None
+      render_pool = RenderPool(configuration.RENDER_WORKERS, configuration.RENDER_TIMEOUT)
+
       with Imgur(
         configuration.IMGUR_CLIENT_ID, 
         configuration.IMGUR_CLIENT_SECRET,
         configuration.IMGUR_AUTHORIZATION_LISTEN_ADDRESS,
         configuration.IMGUR_AUTHORIZATION_LISTEN_PORT,
-        database.get_key("imgur_refresh_token")[0]
+        database.get_key("imgur_refresh_token")[0],
+        api_endpoint = configuration.IMGUR_API_ENDPOINT
       ) as imgur:
 
         database.upsert_key("imgur_refresh_token", imgur.refresh_token)
 
+        upload_executor = UploadExecutor(imgur, configuration.IMGUR_UPLOAD_WORKERS)
+
+        mention_workers = configuration.REDDIT_MENTION_WORKERS
+        if mention_workers > 1 and mention_workers > configuration.DATABASE_POOL_SIZE - 1:
+          mention_workers = max(1, configuration.DATABASE_POOL_SIZE - 1)
+          logger.warning("REDDIT_MENTION_WORKERS needs a DATABASE_POOL_SIZE of one connection per worker, plus one for flushing buffered writes. Evaluating {0:d} mention(s) at a time.".format(mention_workers))
+
+        warmup_concurrency = configuration.WARMUP_CONCURRENCY
+        if warmup_concurrency > 1 and warmup_concurrency > configuration.DATABASE_POOL_SIZE - 1:
+          warmup_concurrency = max(1, configuration.DATABASE_POOL_SIZE - 1)
+          logger.warning("WARMUP_CONCURRENCY needs a DATABASE_POOL_SIZE of one connection per worker, plus one for flushing buffered writes. Warming up {0:d} subtitle(s) at a time.".format(warmup_concurrency))
+
         def find_filter_subtitles(check_text, minimum_likeness = 0.2):
           if len(check_text) < configuration.REDDIT_MINIMUM_LENGTH:
             return []
-          logger.info("Checking for text '{0}'".format(check_text))
-          found_subtitles = database.find_subtitles(check_text)
-          for match in body_search_regex.findall(check_text):
-            if len(match) > configuration.REDDIT_MINIMUM_LENGTH:
-              logger.info("Checking for text '{0}'".format(match))
-              found_subtitles.extend(database.find_subtitles(match))
+          check_texts = [check_text] + [
+            match
+            for match in body_search_regex.findall(check_text)
+            if len(match) > configuration.REDDIT_MINIMUM_LENGTH
+          ]
+          for text in check_texts:
+            logger.info("Checking for text '{0}'".format(text))
+          found_subtitles = []
+          for text, text_subtitles in six.iteritems(database.find_subtitles_many(check_texts)):
+            found_subtitles.extend(text_subtitles)
           arr = [
             found_subtitle
             for found_subtitle in found_subtitles
@@ -158,35 +242,120 @@ def main(conn = None, logger = None):
           arr.reverse()
           return arr
 
-        def convert_upload(comment, season, episode, start_index, end_index, start_time, end_time, text, likeness, comment_count, comment_score):
-          file_path = "s{0:02d}_e{1:02d}_l{2:d}_l{2:d}.gif".format(season, episode, start_index, end_index)
-
-          OfficeConverter(
-            season, 
-            episode, 
-            file_path,
-            Timestamp.from_string(str(start_time)), 
-            Timestamp.from_string(str(end_time)), 
-            text
-          ).execute()
-
-          url = imgur.upload(
-            file_path,
+        def clip_input(season, episode, start_time, end_time, cut = False):
+          video_path = render_source(season, episode)
+          try:
+            signature = stat_signature(video_path)
+          except OSError:
+            return video_path, 0
+          keyframes = database.get_keyframes(video_path, probe = cut, signature = signature)
+          if not keyframes:
+            return video_path, 0
+
+          clip_start, clip_end = keyframe_window(keyframes, int(round(float(start_time) * 1000)), int(round(float(end_time) * 1000)))
+          clip_path = os.path.join(
+            configuration.CLIP_DIRECTORY,
+            "S{0:02d}".format(season),
+            "{0}_{1}_{2:d}_{3}.mkv".format(
+              os.path.splitext(os.path.basename(video_path))[0],
+              hashlib.sha1("{0}:{1}:{2}".format(*signature).encode("UTF-8")).hexdigest()[:12],
+              clip_start,
+              clip_end if clip_end is not None else "end"
+            )
+          )
+
+          try:
+            os.utime(clip_path, None)
+          except OSError:
+            if not cut:
+              return video_path, 0
+            if not os.path.isdir(os.path.dirname(clip_path)):
+              os.makedirs(os.path.dirname(clip_path))
+            partial_path = "{0}.{1:d}.{2:d}.mkv".format(clip_path[:-4], os.getpid(), threading.current_thread().ident)
+            logger.info("Cutting clip {0}.".format(clip_path))
+            extract_clip(video_path, partial_path, clip_start, clip_end, configuration.RENDER_TIMEOUT)
+            os.rename(partial_path, clip_path)
+            prune_clips(configuration.CLIP_DIRECTORY, configuration.CLIP_CACHE_SIZE)
+
+          return clip_path, clip_start / 1000.0
+
+        def render_upload(season, episode, start_index, end_index, start_time, end_time, text, description, cut = False):
+          render = database.get_render(season, episode, start_index, end_index, render_settings_hash)
+          digest, url = render if render else (None, None)
+
+          if url:
+            logger.info("Reusing upload of S{0:02d}E{1:02d} lines {2:d}-{3:d}.".format(season, episode, start_index, end_index))
+            return url
+
+          image = gif_store.get(digest) if gif_store is not None else None
+          rendered = None
+
+          if image is None:
+            input_file, offset = clip_input(season, episode, start_time, end_time, cut)
+
+            rendered = OfficeConverter(
+              season, 
+              episode, 
+              OfficeConverter.PIPE,
+              MillisecondTimestamp.from_seconds(float(start_time) - offset), 
+              MillisecondTimestamp.from_seconds(float(end_time) - offset), 
+              text,
+              input_file
+            ).submit(render_pool).result(configuration.RENDER_TIMEOUT + RenderPool.KILL_GRACE if configuration.RENDER_TIMEOUT else None)
+            image = io.BytesIO(rendered)
+
+            logger.debug("Render pool metrics: {0}".format(render_pool.metrics()))
+          else:
+            logger.info("Reusing render of S{0:02d}E{1:02d} lines {2:d}-{3:d}.".format(season, episode, start_index, end_index))
+
+          upload = upload_executor.submit(
+            image,
             "The Office, Season {0:02d}, Episode {1:02d}".format(season, episode),
-            comment.permalink
+            description,
+            "s{0:02d}_e{1:02d}_l{2:d}_l{3:d}.gif".format(season, episode, start_index, end_index)
           )
 
-          os.remove(file_path)
+          if rendered is not None and gif_store is not None:
+            digest = gif_store.put_data(rendered)
+            database.upsert_render(season, episode, start_index, end_index, render_settings_hash, digest = digest)
+
+          url = upload.result()
+          logger.debug("Upload executor metrics: {0}".format(upload_executor.metrics()))
+
+          database.upsert_render(season, episode, start_index, end_index, render_settings_hash, link = url)
 
           return url
 
+        def convert_upload(comment, season, episode, start_index, end_index, start_time, end_time, text, likeness, comment_count, comment_score):
+          return render_upload(season, episode, start_index, end_index, start_time, end_time, text, comment.permalink)
+
+        def warmup_candidates():
+          return database.get_popular_subtitles(configuration.WARMUP_COUNT, render_settings_hash)
+
+        def warmup_function(subtitle):
+          season, episode, start_index, end_index, start_time, end_time, text = subtitle
+          if isinstance(text, six.binary_type):
+            text = text.decode("UTF-8")
+          logger.info("Warming up subtitle S{0:02d}E{1:02d} \"{2:s}\".".format(season, episode, text))
+          render_upload(season, episode, start_index, end_index, start_time, end_time, text, "", cut = True)
+
+        def start_warmup():
+          worker = WarmupWorker(
+            warmup_candidates,
+            warmup_function,
+            warmup_concurrency,
+            configuration.WARMUP_CPU_BUDGET,
+            configuration.WARMUP_INTERVAL,
+            configuration.WARMUP_NICENESS
+          )
+          worker.start()
+          return worker
+
         def comment_function(comment):
-          if conn is not None:
-            conn.send("comment_evaluated")
+          send_status("comment_evaluated")
 
         def mention_function(comment):
-          if conn is not None:
-            conn.send("mention_evaluated")
+          send_status("mention_evaluated")
 
           try:
             body = re.sub("/u/{0}".format(configuration.REDDIT_USERNAME), "", comment.body, flags = re.IGNORECASE).strip()
@@ -221,13 +390,11 @@ def main(conn = None, logger = None):
 
               if author is not None:
                 logger.debug("Incrementing uses for author '{0}'.".format(author.name))
-                database.increment_user_uses(author.name)
-                uses = database.get_user_uses(author.name)
+                uses = database.increment_user_uses(author.name)
               else:
                 uses = None
 
-              if conn is not None:
-                conn.send("comment_made")
+              send_status("comment_made")
 
               return format_comment(
                 url, 
@@ -252,8 +419,7 @@ def main(conn = None, logger = None):
             raise ex
 
         def vote_function(comment):
-          if conn is not None:
-            conn.send("vote_evaluated")
+          send_status("vote_evaluated")
           if comment.body.strip().startswith("Sorry"):
             return
           for line in comment.body.splitlines():
@@ -264,7 +430,7 @@ def main(conn = None, logger = None):
               line_1 = int(m.group("line_1")) - 1
               line_2 = int(m.group("line_2")) - 1
               logger.info("Upserting comment ID '{0}' into comment database. (season {1}, episode {2}, lines {3}-{4}, score {5})".format(comment, season, episode, line_1, line_2, comment.score))
-              database.upsert_comment(str(comment), comment.score, season, episode, line_1, line_2)
+              database.buffer_comment(str(comment), comment.score, season, episode, line_1, line_2)
               return
             m = comment_search_regex_1.search(line)
             if m:
@@ -272,17 +438,15 @@ def main(conn = None, logger = None):
               episode = int(m.group("episode"))
               line = int(m.group("line")) - 1
               logger.info("Upserting comment ID '{0}' into comment database. (season {1}, episode {2}, line {3}, score {4})".format(comment, season, episode, line, comment.score))
-              database.upsert_comment(str(comment), comment.score, season, episode, line, line)
+              database.buffer_comment(str(comment), comment.score, season, episode, line, line)
               return
           logger.error("Could not parse information from comment ID '{0}'. Body:\n{1}".format(comment, comment.body))
 
         def reply_function(comment):
-          if conn is not None:
-            conn.send("reply_evaluated")
+          send_status("reply_evaluated")
           if comment.author is not None:
             if comment.body.lower().find("ignore me") != -1:
-              if conn is not None:
-                conn.send("user_ignored")
+              send_status("user_ignored")
               logger.info("Ignoring user '{0}' by request.".format(comment.author.name))
               database.ignore_user(comment.author.name)
             
@@ -297,11 +461,21 @@ def main(conn = None, logger = None):
           reply_function,
           mention_function,
           [subreddit for subreddit in configuration.REDDIT_CRAWLED_SUBREDDITS.split(",") if subreddit],
-          [subreddit for subreddit in configuration.REDDIT_IGNORED_SUBREDDITS.split(",") if subreddit]
+          [subreddit for subreddit in configuration.REDDIT_IGNORED_SUBREDDITS.split(",") if subreddit],
+          mention_workers
         ) as crawler:
 
-          while True:
-            time.sleep(60)
+          warmup_worker = start_warmup() if configuration.WARMUP_COUNT > 0 else None
+
+          try:
+            while True:
+              time.sleep(60)
+              if warmup_worker is not None and not warmup_worker.is_alive():
+                logger.error("Warm-up worker stopped, restarting.")
+                warmup_worker = start_warmup()
+          finally:
+            if warmup_worker is not None:
+              warmup_worker.terminate()
 
   except Exception as ex:
     alerter.send("Receieved an exception during normal operation.\n\n{0}(): {1}\n\n{2}".format(
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks TrigramIndex against pg_trgm: trigram extraction against show_trgm(), and the pruned
+candidate search against brute-force similarity over every row of a fixture corpus.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+from __future__ import unicode_literals, print_function
+import os
+import io
+import random
+import unittest
+
+from dundergifflin.trigram import TrigramIndex, trigrams, similarity
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "lines.txt")
+
+COMMON_WORDS = ["the", "a", "i", "to", "you"]
+RARE_LINES = ["The xylophonist.", "A xylophonist, you say?", "Xylophonists to the left", "xylophone"]
+
+def load_corpus(generated = 5000, seed = 0):
+  """
+  The fixture lines, followed by lines of words drawn from them. Most generated lines also
+  end in a common word, and a few lines of a rare word are added last, so a query for the
+  rare word with a common one has few candidates next to a long posting list to bisect.
+  """
+  with io.open(FIXTURE, encoding = "UTF-8") as handler:
+    lines = [line.strip() for line in handler if line.strip()]
+  words = sorted(set(word for line in lines for word in line.split()))
+  generator = random.Random(seed)
+  for i in range(generated):
+    line = [generator.choice(words) for j in range(generator.randint(1, 8))]
+    if generator.random() < 0.9:
+      line.append(generator.choice(COMMON_WORDS))
+    lines.append(" ".join(line))
+  lines.extend(RARE_LINES)
+  return [(i, line) for i, line in enumerate(lines)]
+
+def brute_force(rows, row_trigrams, text, threshold):
+  """
+  Every row at or above the threshold, as ordering by similarity would, ties by row order.
+  """
+  query = trigrams(text)
+  scored = []
+  for row, candidate in zip(rows, row_trigrams):
+    likeness = similarity(query, candidate)
+    if likeness >= threshold:
+      scored.append((row, likeness))
+  return sorted(scored, key = lambda scored_row: (-scored_row[1], scored_row[0][0]))
+
+class TrigramTest(unittest.TestCase):
+  def test_show_trgm(self):
+    """
+    Trigrams match pg_trgm's show_trgm() output.
+    """
+    self.assertEqual(trigrams("word"), set(["  w", " wo", "wor", "ord", "rd "]))
+    self.assertEqual(trigrams("aaa"), set(["  a", " aa", "aaa", "aa "]))
+    self.assertEqual(trigrams("Cat"), trigrams("cat"))
+    self.assertEqual(
+      trigrams("That's a_b"),
+      set(["  t", " th", "tha", "hat", "at ", "  s", " s ", "  a", " a ", "  b", " b "])
+    )
+    self.assertEqual(trigrams("route 66"), set(["  r", " ro", "rou", "out", "ute", "te ", "  6", " 66", "66 "]))
+    self.assertEqual(trigrams(b"caf\xc3\xa9"), set(["  c", " ca", "caf", "af\xe9", "f\xe9 "]))
+    self.assertEqual(trigrams("?!"), set())
+
+  def test_similarity(self):
+    """
+    Similarity matches pg_trgm's similarity().
+    """
+    self.assertAlmostEqual(similarity(trigrams("word"), trigrams("two words")), 0.363636, places = 6)
+    self.assertEqual(similarity(trigrams("word"), trigrams("word")), 1.0)
+    self.assertEqual(similarity(trigrams("word"), trigrams("")), 0.0)
+
+  def test_search_matches_brute_force(self):
+    """
+    The pruned search returns exactly the rows, order and likeness of a full scan.
+    """
+    rows = load_corpus()
+    row_trigrams = [trigrams(line) for i, line in rows]
+    index = TrigramIndex(rows)
+    generator = random.Random(1)
+    queries = [line for i, line in rows[:50]]
+    queries += [" ".join(line.split()[:3]) for i, line in rows[:50]]
+    queries += [line for i, line in generator.sample(rows[50:], 100)]
+    queries += ["that's what", "assistant to the regional manager", "the", "jim", "xyzzy", "a"]
+    queries += ["the xylophonist", "xylophonist a", "you xylophonists", "xylophone to the"]
+    for query in queries:
+      expected = brute_force(rows, row_trigrams, query, index.threshold)
+      for limit in [1, 10, len(rows)]:
+        self.assertEqual(index.search(query, limit), expected[:limit], query)
+
+  def test_search_threshold(self):
+    """
+    Other thresholds, as set with pg_trgm.similarity_threshold, also match a full scan.
+    """
+    rows = load_corpus(500)
+    row_trigrams = [trigrams(line) for i, line in rows]
+    for threshold in [0.1, 0.5, 0.9]:
+      index = TrigramIndex(rows, threshold)
+      for i, line in rows[:30]:
+        self.assertEqual(index.search(line, len(rows)), brute_force(rows, row_trigrams, line, threshold), line)
+
+if __name__ == "__main__":
+  unittest.main()